@@ -0,0 +1 @@
+"""Offline benchmarks of the monitors against a local Instagram stand-in."""
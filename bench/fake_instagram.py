@@ -0,0 +1,571 @@
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from collections import defaultdict
+from collections.abc import Iterator
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+from instaloader.instaloader import Instaloader
+from instaloader.nodeiterator import FrozenNodeIterator
+from instaloader.structures import Highlight, Post, Profile, Story, StoryItem
+
+from src.login.request_governor import GovernedRateController
+from src.monitor import ProfileCache
+
+# Every synthetic timeline starts here, item n of a sequence is n minutes later
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+# Page sizes of the GraphQL queries being imitated
+FOLLOWERS_PAGE_SIZE = 50
+POSTS_PAGE_SIZE = 12
+
+_MEDIA_BLOCK = random.Random(0).randbytes(64 * 1024)
+
+
+def _media_content(url: str, size: int) -> Iterator[bytes]:
+    """The `size` bytes of the media at `url`, the same for the same url only."""
+    name = urlparse(url).path.encode()
+    block = name + _MEDIA_BLOCK[len(name) :]
+    while size > 0:
+        yield block[:size]
+        size -= len(block)
+
+
+def _date(minutes: float) -> datetime:
+    return (EPOCH + timedelta(minutes=minutes)).astimezone()
+
+
+@dataclass
+class WorldConfig:
+    """Shape of every synthetic profile and how it changes between two fetches."""
+
+    followers: int = 200
+    following: int = 200
+    # Fraction of the followers replaced on every fetch of the profile
+    churn: float = 0.01
+    highlights: int = 3
+    highlight_items: int = 5
+    stories: int = 5
+    # Story items posted (and expired) between two fetches
+    new_stories: int = 1
+    posts: int = 12
+    new_posts: int = 0
+    media_bytes: int = 100 * 1024
+    # Fraction of the media that is the same file as other profiles' (reposts, shared highlights)
+    shared_media: float = 0.0
+    media_url: str = "http://127.0.0.1:8000"
+    seed: int = 0
+
+
+@dataclass(frozen=True)
+class FakeUser:
+    userid: int
+    username: str
+
+
+class FakeStoryItem:
+    def __init__(self, owner_id: int, mediaid: int, minutes: float, url: str):
+        self.owner_id = owner_id
+        self.mediaid = mediaid
+        self.date_local = _date(minutes)
+        self.date = self.date_local
+        self.date_utc = self.date_local.astimezone(timezone.utc).replace(tzinfo=None)
+        self.expiring_utc = self.date_utc + timedelta(hours=24)
+        self.url = url
+        self.caption = None
+        self.caption_mentions: list[str] = []
+        self.is_video = False
+        self.video_url = None
+
+
+class FakeStory:
+    def __init__(self, owner_id: int, items: list[FakeStoryItem]):
+        self.owner_id = owner_id
+        self.unique_id = owner_id
+        self._items = items
+        self.itemcount = len(items)
+        self.last_seen_utc = None
+        self.latest_media_utc = max(item.date_utc for item in items)
+
+    def get_items(self) -> Iterator[FakeStoryItem]:
+        return iter(self._items)
+
+
+class FakeHighlight:
+    def __init__(
+        self, context: "FakeContext", unique_id: int, items: list[FakeStoryItem]
+    ):
+        self._context = context
+        self.unique_id = unique_id
+        self.title = f"highlight {unique_id}"
+        self.cover_url = items[0].url if items else None
+        self.itemcount = len(items)
+        self._items = items
+
+    def get_items(self) -> Iterator[FakeStoryItem]:
+        self._context.request("iphone")
+        return iter(self._items)
+
+
+class FakePost:
+    def __init__(self, owner_id: int, mediaid: int, minutes: float, url: str):
+        self.owner_id = owner_id
+        self.mediaid = mediaid
+        self.shortcode = f"P{mediaid}"
+        self.date_local = _date(minutes)
+        self.date_utc = self.date_local.astimezone(timezone.utc).replace(tzinfo=None)
+        self.url = url
+
+
+class FakeNodeIterator:
+    """Pages through `nodes` like a `NodeIterator`, one request per page."""
+
+    def __init__(
+        self, context: "FakeContext", nodes: list, page_size: int, query_type: str
+    ):
+        self._context = context
+        self._nodes = nodes
+        self._page_size = page_size
+        self._query_type = query_type
+        self._index = 0
+        self._pages = 0
+        self._first_item = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # An empty list still costs the request of its first page
+        needed_pages = max(min(self._index, len(self._nodes) - 1), 0)
+        while self._pages <= needed_pages // self._page_size:
+            self._context.request(self._query_type)
+            self._pages += 1
+        if self._index >= len(self._nodes):
+            raise StopIteration
+
+        node = self._nodes[self._index]
+        self._index += 1
+        if self._first_item is None:
+            self._first_item = node
+        return node
+
+    @property
+    def first_item(self):
+        return self._first_item
+
+    def freeze(self) -> FrozenNodeIterator:
+        values = dict.fromkeys(FrozenNodeIterator._fields)
+        values.update(total_index=self._index, best_before=None)
+        return FrozenNodeIterator(**values)
+
+    def thaw(self, frozen: FrozenNodeIterator) -> None:
+        # The page holding the next node is fetched again
+        self._index = frozen.total_index
+        self._pages = self._index // self._page_size
+
+
+class FakeProfile:
+    def __init__(
+        self,
+        context: "FakeContext",
+        userid: int,
+        username: str,
+        followers: list[FakeUser],
+        following: list[FakeUser],
+        posts: list[FakePost],
+        profile_pic_url: str,
+    ):
+        self._context = context
+        self.userid = userid
+        self.username = username
+        self.biography = f"Synthetic profile {username}"
+        self.followers = len(followers)
+        self.followees = len(following)
+        self.mediacount = len(posts)
+        self.profile_pic_url = profile_pic_url
+        self.profile_pic_url_no_iphone = profile_pic_url
+        self._followers = followers
+        self._following = following
+        self._posts = posts
+
+    def get_followers(self) -> FakeNodeIterator:
+        return FakeNodeIterator(
+            self._context, self._followers, FOLLOWERS_PAGE_SIZE, "graphql"
+        )
+
+    def get_followees(self) -> FakeNodeIterator:
+        return FakeNodeIterator(
+            self._context, self._following, FOLLOWERS_PAGE_SIZE, "graphql"
+        )
+
+    def get_posts(self) -> FakeNodeIterator:
+        return FakeNodeIterator(self._context, self._posts, POSTS_PAGE_SIZE, "graphql")
+
+    def get_tagged_posts(self) -> FakeNodeIterator:
+        # The synthetic profiles are never tagged, listing them still costs a request
+        return FakeNodeIterator(self._context, [], POSTS_PAGE_SIZE, "graphql")
+
+
+class _ProfileState:
+    def __init__(self, username: str, config: WorldConfig):
+        self.username = username
+        self.random = random.Random(f"{config.seed}-{username}")
+        self.userid = self.random.randrange(10**10, 10**11)
+        self.followers = set(self.random.sample(range(1, 10_000_000), config.followers))
+        # About half of the followed accounts follow back
+        mutual = min(config.following // 2, config.followers)
+        self.following = set(self.random.sample(sorted(self.followers), mutual))
+        while len(self.following) < config.following:
+            self.following.add(self.random.randrange(1, 10_000_000))
+        self.fetches = 0
+
+
+class SyntheticWorld:
+    """
+    The synthetic accounts served by every `FakeContext`, created on first lookup.
+
+    Each fetch of a profile moves its timeline forward: `churn` of the followers are replaced,
+    `new_stories` story items are posted (and as many of the oldest expire) and `new_posts`
+    posts are added. Everything is derived from the username and `seed`, so two benchmarks
+    with the same configuration serve the same data.
+    """
+
+    def __init__(self, config: WorldConfig) -> None:
+        self.config = config
+        self._lock = threading.Lock()
+        self._profiles: dict[str, _ProfileState] = {}
+        self._by_userid: dict[int, _ProfileState] = {}
+
+    def _state(self, username: str) -> _ProfileState:
+        state = self._profiles.get(username)
+        if state is None:
+            state = self._profiles[username] = _ProfileState(username, self.config)
+            self._by_userid[state.userid] = state
+        return state
+
+    def _advance(self, state: _ProfileState) -> None:
+        replaced = math.ceil(len(state.followers) * self.config.churn)
+        if state.fetches and replaced:
+            for userid in state.random.sample(sorted(state.followers), replaced):
+                state.followers.discard(userid)
+            while len(state.followers) < self.config.followers:
+                state.followers.add(state.random.randrange(1, 10_000_000))
+        state.fetches += 1
+
+    def media_url(self, name: str) -> str:
+        config = self.config
+        checksum = zlib.crc32(name.encode())
+        if checksum % 1000 < config.shared_media * 1000:
+            name = f"shared_{checksum % 20}"
+        return f"{config.media_url}/media/{name}.jpg?size={config.media_bytes}"
+
+    def profile(self, context: "FakeContext", username: str) -> FakeProfile:
+        config = self.config
+        with self._lock:
+            state = self._state(username)
+            self._advance(state)
+            followers = [
+                FakeUser(userid, f"user{userid}") for userid in state.followers
+            ]
+            following = [
+                FakeUser(userid, f"user{userid}") for userid in state.following
+            ]
+            generation = state.fetches - 1
+
+        newest_post = config.posts + generation * config.new_posts
+        posts = [
+            FakePost(
+                state.userid,
+                state.userid * 100_000 + number,
+                number * 60,
+                self.media_url(f"{state.userid}_post_{number}"),
+            )
+            for number in range(newest_post - 1, -1, -1)
+        ]
+        return FakeProfile(
+            context,
+            state.userid,
+            state.username,
+            followers,
+            following,
+            posts,
+            # Signed like the real urls, the query changes on every request
+            f"{self.media_url(f'{state.userid}_profile_pic')}&oh={generation}",
+        )
+
+    def story(self, userid: int) -> FakeStory | None:
+        with self._lock:
+            state = self._by_userid.get(userid)
+        if state is None or not self.config.stories:
+            return None
+        generation = max(state.fetches - 1, 0)
+        first = generation * self.config.new_stories
+        items = [
+            FakeStoryItem(
+                userid,
+                userid * 100_000 + 50_000 + number,
+                number,
+                self.media_url(f"{userid}_story_{number}"),
+            )
+            for number in range(first, first + self.config.stories)
+        ]
+        return FakeStory(userid, items)
+
+    def highlights(
+        self, context: "FakeContext", userid: int
+    ) -> Iterator[FakeHighlight]:
+        for highlight in range(self.config.highlights):
+            unique_id = userid * 100 + highlight
+            items = [
+                FakeStoryItem(
+                    userid,
+                    unique_id * 1000 + item,
+                    # Highlight items are a year older than the stories
+                    -365 * 24 * 60 + highlight * self.config.highlight_items + item,
+                    self.media_url(f"{unique_id}_highlight_{item}"),
+                )
+                for item in range(self.config.highlight_items)
+            ]
+            yield FakeHighlight(context, unique_id, items)
+
+
+class FakeContext:
+    """
+    Stand-in for `InstaloaderContext`: every simulated request goes through the installed rate
+    controller, takes `latency_seconds` and is answered with a 429 with probability
+    `rate_limit_probability`, after which it is retried like Instaloader retries it.
+    """
+
+    def __init__(
+        self,
+        world: SyntheticWorld,
+        username: str = "benchmark",
+        latency_seconds: float = 0.02,
+        rate_limit_probability: float = 0,
+    ) -> None:
+        self.world = world
+        self.username = username
+        self.user_agent = "instagram-monitor-benchmark"
+        self.is_logged_in = True
+        self.latency_seconds = latency_seconds
+        self.rate_limit_probability = rate_limit_probability
+        self._rate_controller = None
+
+        self._lock = threading.Lock()
+        self._random = random.Random(world.config.seed)
+        # query type -> requests made, including the ones answered with a 429
+        self.requests: dict[str, int] = defaultdict(int)
+        self.rate_limited = 0
+
+    def request(self, query_type: str) -> None:
+        while True:
+            controller = self._rate_controller
+            if isinstance(controller, GovernedRateController):
+                # Only the governor, Instaloader's own sliding windows would make every
+                # benchmark take as long as the real rate limit
+                controller.governor.acquire(query_type)
+
+            time.sleep(self.latency_seconds)
+            with self._lock:
+                self.requests[query_type] += 1
+                rate_limited = self._random.random() < self.rate_limit_probability
+                if rate_limited:
+                    self.rate_limited += 1
+            if not rate_limited:
+                return
+            if controller is not None:
+                controller.handle_429(query_type)
+
+    def profile(self, username: str) -> FakeProfile:
+        self.request("graphql")
+        return self.world.profile(self, username)
+
+
+class FakeInstaloader:
+    """
+    The part of the `Instaloader` API used by the monitors, served from a `SyntheticWorld`.
+
+    Story and highlight items point at the `MediaServer`, so they go through the real
+    `DownloadPipeline`. Posts and profile pictures are written directly, like Instaloader
+    writes them without going through the pipeline.
+    """
+
+    def __init__(self, context: FakeContext) -> None:
+        self.context = context
+        self.download_videos = True
+        self.download_video_thumbnails = True
+        self.save_metadata = True
+        self.storyitem_metadata_txt_pattern = ""
+
+    def test_login(self) -> str:
+        self.context.request("graphql")
+        return self.context.username
+
+    def format_filename(self, item, target=None) -> str:
+        return f"{item.date_utc:%Y-%m-%d_%H-%M-%S}_UTC"
+
+    def save_metadata_json(self, filename: str, structure) -> None:
+        with open(f"{filename}.json", "w", encoding="utf-8") as file:
+            json.dump(
+                {"id": structure.mediaid, "date": structure.date_utc.isoformat()}, file
+            )
+
+    def _write_media(self, filename: str, url: str) -> None:
+        size = self.context.world.config.media_bytes
+        with open(filename, "wb") as file:
+            for chunk in _media_content(url, size):
+                file.write(chunk)
+
+    def download_pic(self, filename: str, url: str, mtime: datetime) -> bool:
+        self._write_media(f"{filename}.jpg", url)
+        return True
+
+    def get_highlights(self, user) -> Iterator[FakeHighlight]:
+        self.context.request("iphone")
+        return self.context.world.highlights(self.context, user)
+
+    def get_stories(self, userids: list[int]) -> Iterator[FakeStory]:
+        # Instagram serves the reels of up to 100 users per request
+        for start in range(0, len(userids), 100):
+            self.context.request("iphone")
+            for userid in userids[start : start + 100]:
+                story = self.context.world.story(userid)
+                if story is not None:
+                    yield story
+
+    def posts_download_loop(
+        self,
+        posts,
+        target,
+        fast_update=False,
+        post_filter=None,
+        max_count=None,
+        total_count=None,
+        owner_profile=None,
+        takewhile=None,
+        possibly_pinned=0,
+    ) -> None:
+        Path(target).mkdir(parents=True, exist_ok=True)
+        for number, post in enumerate(posts):
+            if takewhile is not None and not takewhile(post):
+                if number < possibly_pinned:
+                    continue
+                break
+            filename = str(Path(target) / self.format_filename(post))
+            self._write_media(f"{filename}.jpg", post.url)
+            if self.save_metadata:
+                self.save_metadata_json(filename, post)
+
+
+def _public_attributes(obj) -> set[str]:
+    return {name for name in dir(obj) if not name.startswith("_")}
+
+
+def check_fake_api() -> None:
+    """
+    Make sure the fakes only expose what the installed Instaloader has, so the monitors can't
+    read an attribute in the benchmark that real runs don't have.
+
+    Raises:
+        AttributeError: Naming every public attribute of a fake missing from its real class.
+    """
+    world = SyntheticWorld(
+        WorldConfig(
+            followers=1, following=1, highlights=1, highlight_items=1, stories=1, posts=1
+        )
+    )
+    context = FakeContext(world, latency_seconds=0)
+    profile = context.profile("api-check")
+    story = world.story(profile.userid)
+    highlight = next(iter(world.highlights(context, profile.userid)))
+
+    # Instance attributes of Instaloader are only set by its constructor
+    fakes = [
+        (profile, Profile),
+        (profile._followers[0], Profile),
+        (profile._posts[0], Post),
+        (story, Story),
+        (story._items[0], StoryItem),
+        (highlight, Highlight),
+        (FakeInstaloader(context), Instaloader(quiet=True)),
+    ]
+    missing = [
+        f"{type(fake).__name__}.{name}"
+        for fake, real in fakes
+        for name in sorted(_public_attributes(fake) - _public_attributes(real))
+    ]
+    if missing:
+        raise AttributeError(
+            "The fakes expose attributes the installed Instaloader doesn't have: "
+            + ", ".join(missing)
+        )
+
+
+class FakeProfileCache(ProfileCache):
+    """`ProfileCache` resolving usernames against the `FakeContext` it is given."""
+
+    def get(self, context: FakeContext, username: str, userid: int | None = None):
+        profile = self._cached(context, self.userid(username) or userid)
+        if profile is not None:
+            return profile
+        return self._store(context.profile(username))
+
+
+class _MediaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        size = int(query.get("size", ["0"])[0])
+        time.sleep(self.server.latency_seconds)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        for chunk in _media_content(self.path, size):
+            self.wfile.write(chunk)
+
+        with self.server.lock:
+            self.server.served += 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MediaServer:
+    """Local HTTP server answering `/media/<name>.jpg?size=N` with N bytes."""
+
+    def __init__(self, latency_seconds: float = 0.01) -> None:
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _MediaHandler)
+        self._server.daemon_threads = True
+        self._server.latency_seconds = latency_seconds
+        self._server.lock = threading.Lock()
+        self._server.served = 0
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="media-server", daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def served(self) -> int:
+        return self._server.served
+
+    def start(self) -> "MediaServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
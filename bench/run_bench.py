@@ -0,0 +1,457 @@
+"""
+Benchmark the monitors against a local Instagram stand-in.
+
+Every scenario monitors N synthetic profiles (1, 50 and 500 by default) for `--runs` runs each
+through the real `MonitorManager`, `InstagramMonitor`, `RequestGovernor` and `DownloadPipeline`,
+with Instaloader replaced by `bench.fake_instagram`. Story and highlight media is downloaded
+from a local HTTP server. Each scenario runs in a fresh process and reports the wall time, the
+duration of the runs, the requests made, the bytes written and the peak RSS.
+
+    python -m bench.run_bench --save-baseline bench/baseline.json
+    python -m bench.run_bench --baseline bench/baseline.json
+
+With `--baseline`, every metric is compared with the saved results and the exit code is 1
+when one of them got worse by more than `--tolerance`.
+"""
+
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from src.login import RequestGovernor
+from src.monitor import BlobStore, DownloadPipeline, MonitorManager
+
+from .fake_instagram import (
+    FakeContext,
+    FakeInstaloader,
+    FakeProfileCache,
+    MediaServer,
+    SyntheticWorld,
+    WorldConfig,
+    check_fake_api,
+)
+
+logger = logging.getLogger(__name__)
+
+# Metrics compared with the baseline, lower is better for all of them
+METRICS = (
+    "wall_seconds",
+    "run_mean_seconds",
+    "run_p95_seconds",
+    "requests",
+    "written_bytes",
+    "output_bytes",
+    "peak_rss_kb",
+)
+
+# Options that don't change the results. Scenarios are compared one by one, every other
+# option should match the baseline's
+_NOT_COMPARED = (
+    "profiles",
+    "save_baseline",
+    "baseline",
+    "tolerance",
+    "keep_output",
+    "log_level",
+)
+
+
+def _written_bytes() -> int | None:
+    """Bytes this process passed to write() so far, None where /proc isn't available."""
+    try:
+        with open("/proc/self/io", "r", encoding="utf-8") as file:
+            for line in file:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _directory_size(path: Path) -> int:
+    # Hardlinked files take the space of one
+    sizes = {}
+    for file in path.rglob("*"):
+        if file.is_file():
+            stat = file.stat()
+            sizes[stat.st_dev, stat.st_ino] = stat.st_size
+    return sum(sizes.values())
+
+
+def _monitor_args(args: argparse.Namespace) -> argparse.Namespace:
+    """The `main.py` options read by the monitors."""
+    return argparse.Namespace(
+        download_highlights=True,
+        download_stories=True,
+        batch_stories=False,
+        snapshot_store=args.snapshot_store,
+        history_mode=args.history_mode,
+        base_interval=96,
+        fast_path=args.fast_path,
+        full_audit_hours=24,
+        adaptive=False,
+        adaptive_max_hours=24,
+        concurrent_phases=args.concurrent_phases,
+    )
+
+
+def run_scenario(profiles: int, args: argparse.Namespace, media_url: str) -> dict:
+    """Monitor `profiles` synthetic profiles for `args.runs` runs each, in the working directory."""
+    logging.getLogger().setLevel(args.log_level)
+
+    world = SyntheticWorld(
+        WorldConfig(
+            followers=args.followers,
+            following=args.following,
+            churn=args.churn,
+            highlights=args.highlights,
+            highlight_items=args.highlight_items,
+            stories=args.stories,
+            new_stories=args.new_stories,
+            posts=args.posts,
+            new_posts=args.new_posts,
+            media_bytes=args.media_kb * 1024,
+            shared_media=args.shared_media,
+            media_url=media_url,
+        )
+    )
+    context = FakeContext(
+        world,
+        latency_seconds=args.latency_ms / 1000,
+        rate_limit_probability=args.rate_limit_probability,
+    )
+    insta_loader = FakeInstaloader(context)
+    governor = RequestGovernor(
+        requests_per_minute=args.requests_per_minute,
+        burst=args.burst,
+        backoff_seconds=args.backoff_seconds,
+        max_backoff_seconds=args.max_backoff_seconds,
+    )
+    governor.install(insta_loader)
+
+    usernames = [f"profile{number:04d}" for number in range(profiles)]
+    durations: list[float] = []
+    failures = 0
+    runs: dict[str, int] = dict.fromkeys(usernames, 0)
+    lock = threading.Lock()
+    done = threading.Event()
+    monitor_manager: MonitorManager | None = None
+
+    def on_result(username, ok, duration, requests, error):
+        nonlocal failures
+        with lock:
+            durations.append(duration)
+            failures += not ok
+            runs[username] += 1
+            if runs[username] == args.runs:
+                # Keep the monitor for stop_all, just don't run it again
+                monitor_manager.scheduler.remove(monitor_manager.monitors[username].job)
+                if all(count >= args.runs for count in runs.values()):
+                    done.set()
+
+    written_before = _written_bytes()
+    started = time.monotonic()
+    monitor_manager = MonitorManager(
+        governor,
+        DownloadPipeline(
+            insta_loader,
+            max_workers=args.download_workers,
+            per_host_limit=args.downloads_per_host,
+            blob_store=BlobStore() if args.blob_store else None,
+        ),
+        FakeProfileCache(ttl_seconds=0),
+        max_workers=args.workers,
+        on_result=on_result,
+    )
+    try:
+        for username in usernames:
+            # A zero interval runs a profile again about a second after its last run
+            monitor_manager.add_monitor(
+                username, insta_loader, 0, _monitor_args(args)
+            )
+        if not done.wait(args.timeout):
+            raise TimeoutError(f"{profiles} profiles didn't finish in {args.timeout}s")
+        wall_seconds = time.monotonic() - started
+    finally:
+        monitor_manager.stop_all()
+
+    written_after = _written_bytes()
+    durations.sort()
+    return {
+        "profiles": profiles,
+        "runs": len(durations),
+        "failed_runs": failures,
+        "wall_seconds": wall_seconds,
+        "run_mean_seconds": statistics.fmean(durations),
+        "run_p95_seconds": durations[math.ceil(0.95 * len(durations)) - 1],
+        "run_max_seconds": durations[-1],
+        "requests": sum(context.requests.values()),
+        "requests_by_type": dict(context.requests),
+        "rate_limited": context.rate_limited,
+        "written_bytes": (
+            written_after - written_before if written_before is not None else None
+        ),
+        "output_bytes": _directory_size(Path("output")),
+        # Kilobytes on Linux
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _run_in_directory(profiles: int, args: argparse.Namespace, media_url: str) -> dict:
+    work_dir = tempfile.mkdtemp(prefix=f"bench-{profiles}-")
+    os.chdir(work_dir)
+    try:
+        return run_scenario(profiles, args, media_url)
+    finally:
+        if args.keep_output:
+            logger.info("Output of %d profiles kept in %s", profiles, work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_benchmarks(args: argparse.Namespace) -> dict[str, dict]:
+    media_server = MediaServer(latency_seconds=args.media_latency_ms / 1000).start()
+    results = {}
+    try:
+        for profiles in args.profiles:
+            # A fresh process per scenario, so the peak RSS isn't carried over
+            with ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                result = executor.submit(
+                    _run_in_directory, profiles, args, media_server.url
+                ).result()
+            results[str(profiles)] = result
+            logger.info(
+                "%d profiles: %d runs in %.1fs, %d requests",
+                profiles,
+                result["runs"],
+                result["wall_seconds"],
+                result["requests"],
+            )
+    finally:
+        media_server.stop()
+    return results
+
+
+def _format(metric: str, value) -> str:
+    if value is None:
+        return "-"
+    if metric.endswith("_seconds"):
+        return f"{value:.3f}s"
+    if metric.endswith("_bytes"):
+        return f"{value / 1024 / 1024:.1f}MB"
+    if metric.endswith("_kb"):
+        return f"{value / 1024:.1f}MB"
+    return str(value)
+
+
+def print_results(results: dict[str, dict]) -> None:
+    print(f"{'profiles':>8}  " + "  ".join(f"{metric:>17}" for metric in METRICS))
+    for profiles, result in results.items():
+        print(
+            f"{profiles:>8}  "
+            + "  ".join(
+                f"{_format(metric, result.get(metric)):>17}" for metric in METRICS
+            )
+        )
+
+
+def compare(results: dict[str, dict], baseline: dict, tolerance: float) -> bool:
+    """Print every metric next to its baseline value. Returns whether nothing regressed."""
+    ok = True
+    for profiles, result in results.items():
+        previous = baseline["results"].get(profiles)
+        if previous is None:
+            print(f"{profiles} profiles: not in the baseline")
+            continue
+
+        print(f"{profiles} profiles:")
+        for metric in METRICS:
+            value, before = result.get(metric), previous.get(metric)
+            if value is None or not before:
+                continue
+            change = (value - before) / before
+            regressed = change > tolerance
+            ok = ok and not regressed
+            print(
+                f"  {metric:>17}  {_format(metric, before):>12} -> "
+                f"{_format(metric, value):>12}  {change:+7.1%}"
+                + ("  REGRESSED" if regressed else "")
+            )
+    return ok
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the monitors against synthetic Instagram profiles."
+    )
+    parser.add_argument(
+        "--profiles",
+        type=int,
+        nargs="+",
+        default=[1, 50, 500],
+        help="Number of monitored profiles of each scenario.",
+    )
+    parser.add_argument(
+        "--runs", type=int, default=2, help="Runs of every profile per scenario."
+    )
+    parser.add_argument("--followers", type=int, default=200)
+    parser.add_argument("--following", type=int, default=200)
+    parser.add_argument(
+        "--churn",
+        type=float,
+        default=0.01,
+        help="Fraction of the followers replaced between two runs.",
+    )
+    parser.add_argument("--highlights", type=int, default=3)
+    parser.add_argument("--highlight-items", type=int, default=5)
+    parser.add_argument("--stories", type=int, default=5)
+    parser.add_argument(
+        "--new-stories",
+        type=int,
+        default=1,
+        help="Story items posted between two runs.",
+    )
+    parser.add_argument("--posts", type=int, default=12)
+    parser.add_argument(
+        "--new-posts", type=int, default=0, help="Posts added between two runs."
+    )
+    parser.add_argument(
+        "--media-kb", type=int, default=100, help="Size of every media file."
+    )
+    parser.add_argument(
+        "--shared-media",
+        type=float,
+        default=0,
+        help="Fraction of the media that is the same file in several profiles.",
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=20,
+        help="Latency of every simulated Instagram request.",
+    )
+    parser.add_argument(
+        "--media-latency-ms",
+        type=float,
+        default=10,
+        help="Latency of every media download.",
+    )
+    parser.add_argument(
+        "--rate-limit-probability",
+        type=float,
+        default=0,
+        help="Probability of a request being answered with a 429.",
+    )
+    parser.add_argument(
+        "--backoff-seconds",
+        type=float,
+        default=1,
+        help="Backoff of the request governor after a 429.",
+    )
+    parser.add_argument(
+        "--max-backoff-seconds",
+        type=float,
+        default=10,
+        help="Longest backoff of the request governor after repeated 429s.",
+    )
+    parser.add_argument("--requests-per-minute", type=float, default=1_000_000)
+    parser.add_argument("--burst", type=int, default=1_000_000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--download-workers", type=int, default=8)
+    parser.add_argument("--downloads-per-host", type=int, default=4)
+    parser.add_argument(
+        "--snapshot-store", choices=["sqlite", "json"], default="sqlite"
+    )
+    parser.add_argument("--history-mode", choices=["full", "delta"], default="full")
+    parser.add_argument("--fast-path", action="store_true", default=False)
+    parser.add_argument("--concurrent-phases", action="store_true", default=False)
+    parser.add_argument(
+        "--blob-store",
+        action="store_true",
+        default=False,
+        help="Store media in output/blobs, deduplicated across profiles.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=3600,
+        help="Seconds a scenario may take before it is aborted.",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        type=Path,
+        default=None,
+        help="Write the results to this file.",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=None,
+        help="Compare the results with the ones saved in this file.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="With --baseline, relative increase of a metric counted as a regression.",
+    )
+    parser.add_argument(
+        "--keep-output",
+        action="store_true",
+        default=False,
+        help="Keep the output directory of every scenario.",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="WARNING",
+        help="Log level of the monitors while benchmarking.",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> int:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+    args = parse_args(argv)
+    check_fake_api()
+    results = run_benchmarks(args)
+    print_results(results)
+
+    config = {
+        key: value for key, value in vars(args).items() if key not in _NOT_COMPARED
+    }
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w", encoding="utf-8") as file:
+            json.dump({"config": config, "results": results}, file, indent=4)
+        logger.info("Saved baseline to %s", args.save_baseline)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+        differences = {
+            key: (baseline["config"].get(key), value)
+            for key, value in config.items()
+            if baseline["config"].get(key) != value
+        }
+        if differences:
+            logger.warning("Baseline was made with different options: %s", differences)
+        if not compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,39 +1,461 @@
 import argparse
 import logging
 import signal
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
 
-from src.login import LoginManager
-from src.monitor import MonitorManager
+from src.login import LoginManager, RequestGovernor, SessionCache, SessionPool
+from src.metrics import REGISTRY, MetricsServer
+from src.monitor import (
+    BlobStore,
+    DownloadPipeline,
+    MetadataLog,
+    MonitorManager,
+    ProfileCache,
+    RunProfiler,
+    ScheduledJob,
+    ShardCoordinator,
+    ShardReporter,
+    StoryPoller,
+    StorySchedule,
+    profile_data_dir,
+)
+from src.query import PERIODS, HistoryIndex
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
 
 
+def export_metadata(usernames):
+    for username in usernames:
+        data_dir = profile_data_dir(username)
+        if not data_dir.exists():
+            logging.warning("No data found for %s, skipping", username)
+            continue
+
+        metadata_log = MetadataLog.for_data_dir(data_dir)
+        metadata_log.compact()
+        metadata_log.export(data_dir / "metadata.json")
+        metadata_log.close()
+        logging.info("Exported metadata for %s to %s", username, data_dir)
+
+
+def query_time(value: str, end: bool = False) -> str:
+    """A snapshot timestamp from `YYYY-MM-DD[ HH:MM:SS]` or a relative `7d`, `12h` or `2w`."""
+    units = {"h": "hours", "d": "days", "w": "weeks"}
+    if value[:-1].isdigit() and value[-1] in units:
+        since = datetime.now() - timedelta(**{units[value[-1]]: int(value[:-1])})
+        return since.strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        datetime.strptime(value, "%Y-%m-%d")
+        # A whole day, up to its end when it closes the range
+        return f"{value} 23:59:59" if end else f"{value} 00:00:00"
+    except ValueError:
+        pass
+    try:
+        datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"{value!r} is not YYYY-MM-DD, 'YYYY-MM-DD HH:MM:SS' or like 7d, 12h, 2w"
+        )
+    return value
+
+
+def query_history(argv: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog="main.py query",
+        description="Answer questions about a monitored profile's history from an index "
+        "kept next to its data, updated with the runs made since the last query.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_command(name: str, help: str) -> argparse.ArgumentParser:
+        command = commands.add_parser(name, help=help, description=help)
+        command.add_argument("username", help="Monitored username.")
+        return command
+
+    def add_range(command: argparse.ArgumentParser) -> None:
+        command.add_argument(
+            "--since",
+            type=query_time,
+            default=None,
+            help="Start of the range: YYYY-MM-DD, 'YYYY-MM-DD HH:MM:SS' or 7d, 12h, 2w ago.",
+        )
+        command.add_argument(
+            "--until",
+            type=lambda value: query_time(value, end=True),
+            default=None,
+            help="End of the range, in the same formats as --since.",
+        )
+
+    churn = add_command("churn", "Followers (or following) gained and lost per period.")
+    churn.add_argument(
+        "--kind", choices=["followers", "following"], default="followers"
+    )
+    churn.add_argument("--by", choices=list(PERIODS), default="day")
+    add_range(churn)
+
+    changes = add_command(
+        "changes", "Accounts that followed or unfollowed (or were (un)followed)."
+    )
+    changes.add_argument(
+        "--kind", choices=["followers", "following"], default="followers"
+    )
+    changes.add_argument(
+        "--only",
+        choices=["added", "removed"],
+        default=None,
+        help="Only list accounts that were added or that were removed.",
+    )
+    add_range(changes)
+
+    seen = add_command(
+        "seen", "When an account was first and last seen following or being followed."
+    )
+    seen.add_argument("account", help="Username or userid of the account.")
+
+    not_following_back = add_command(
+        "not-following-back",
+        "Followed accounts that started or stopped not following back.",
+    )
+    not_following_back.add_argument(
+        "--current",
+        action="store_true",
+        default=False,
+        help="List the accounts not following back now instead of the changes.",
+    )
+    add_range(not_following_back)
+
+    activity = add_command("activity", "Story or highlight items per period.")
+    activity.add_argument(
+        "--category", choices=["stories", "highlights"], default="stories"
+    )
+    activity.add_argument("--by", choices=list(PERIODS), default="day")
+    add_range(activity)
+
+    args = parser.parse_args(argv)
+
+    data_dir = profile_data_dir(args.username)
+    if not data_dir.exists():
+        parser.exit(1, f"No data found for {args.username}\n")
+
+    index = HistoryIndex(data_dir)
+    try:
+        index.update()
+    except FileNotFoundError as e:
+        index.close()
+        parser.exit(1, f"{e}\n")
+
+    try:
+        if args.command == "churn":
+            rows = index.churn(args.kind, args.since, args.until, args.by)
+            print(f"{args.by:<10} {'gained':>8} {'lost':>8}")
+            for period, gained, lost in rows:
+                print(f"{period:<10} {gained:>8} {lost:>8}")
+            gained = sum(row[1] for row in rows)
+            lost = sum(row[2] for row in rows)
+            print(f"{'total':<10} {gained:>8} {lost:>8} ({gained - lost:+d})")
+
+        elif args.command == "activity":
+            print(f"{args.by:<10} {'items':>8}")
+            for period, items in index.activity(
+                args.category, args.since, args.until, args.by
+            ):
+                print(f"{period:<10} {items:>8}")
+
+        elif args.command == "seen":
+            userid = index.userid(args.account)
+            spans = index.spans(userid) if userid is not None else []
+            if not spans:
+                print(f"{args.account} never showed up in {args.username}'s history")
+            for kind, first_seen, last_seen, ended in spans:
+                print(
+                    f"{kind:<20} first seen {first_seen}, last seen {last_seen}"
+                    + (f", gone at {ended}" if ended else ", still there")
+                )
+
+        elif args.command == "not-following-back" and args.current:
+            for userid, username, first_seen in index.current("not_following_back"):
+                print(f"{username or userid}  since {first_seen}")
+
+        else:
+            if args.command == "changes":
+                kind, only = args.kind, args.only
+            else:
+                kind, only = "not_following_back", None
+            for timestamp, change, userid, username in index.changes(
+                kind, args.since, args.until, only
+            ):
+                sign = "+" if change == "added" else "-"
+                print(f"{timestamp}  {sign} {username or userid}")
+    finally:
+        index.close()
+
+
+def gc_blobs(argv: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog="main.py gc-blobs",
+        description="Remove the blobs of --blob-store that no profile directory links to.",
+    )
+    parser.add_argument(
+        "--grace-hours",
+        type=float,
+        default=1,
+        help="Keep blobs orphaned less than this many hours ago.",
+    )
+    args = parser.parse_args(argv)
+
+    blobs_dir = Path("output", "blobs")
+    if not blobs_dir.is_dir():
+        parser.exit(1, f"No blob store in {blobs_dir}\n")
+    BlobStore(blobs_dir).gc(grace_seconds=args.grace_hours * 3600)
+
+
+@contextmanager
+def open_sessions(login_manager: LoginManager, args: argparse.Namespace):
+    """Yield the default Instaloader and the request governor or session pool to use."""
+    if args.session_pool:
+        pool = SessionPool(
+            login_manager,
+            cookiefiles=args.cookiefile,
+            credentials=login_manager.load_pool_credentials_from_env(),
+            requests_per_minute=args.requests_per_minute,
+            burst=args.burst,
+            eviction_seconds=args.session_eviction_minutes * 60,
+        ).open()
+        yield pool.sessions[0].instaloader, pool
+        return
+
+    governor = RequestGovernor(
+        requests_per_minute=args.requests_per_minute, burst=args.burst
+    )
+    with login_manager.session() as insta_loader:
+        # Every monitor shares the session, so they also share its request budget
+        governor.install(insta_loader)
+        if login_manager.needs_validation:
+            # Restored from the cache without a round-trip, check it on first use instead
+            governor.before_first_request = lambda: login_manager.validate_session(
+                insta_loader
+            )
+        yield insta_loader, governor
+
+
+def create_run_profiler(args: argparse.Namespace) -> RunProfiler | None:
+    if not args.profile_run and args.profile_slower_than is None:
+        return None
+
+    # username:N, the same username can be given several times
+    runs: dict[str, set[int]] = {}
+    for username_run in args.profile_run:
+        username, run_number = username_run.rsplit(":", 1)
+        runs.setdefault(username, set()).add(int(run_number))
+    return RunProfiler(runs, args.profile_slower_than)
+
+
+def build_monitor_manager(
+    insta_loader,
+    governor: RequestGovernor | SessionPool,
+    args: argparse.Namespace,
+    story_schedule_file: Path = Path("output", "story_schedule.json"),
+    on_result=None,
+) -> MonitorManager:
+    download_pipeline = DownloadPipeline(
+        insta_loader,
+        max_workers=args.download_workers,
+        per_host_limit=args.downloads_per_host,
+        blob_store=BlobStore(Path("output", "blobs")) if args.blob_store else None,
+    )
+    story_schedule = None
+    if args.story_budget is not None:
+        # Each request covers up to a batch of profiles
+        story_schedule = StorySchedule(
+            story_schedule_file,
+            polls_per_day=args.story_budget * args.story_batch_size,
+            margin_seconds=args.story_margin * 60,
+        )
+
+    story_poller = None
+    if args.batch_stories:
+        story_poller = StoryPoller(
+            insta_loader,
+            governor,
+            args.story_interval,
+            batch_size=args.story_batch_size,
+            jitter_seconds=args.jitter,
+            schedule=story_schedule,
+        )
+
+    monitor_manager = MonitorManager(
+        governor,
+        download_pipeline,
+        ProfileCache(ttl_seconds=args.profile_cache_ttl),
+        max_workers=args.workers,
+        jitter_seconds=args.jitter,
+        story_poller=story_poller,
+        on_result=on_result,
+        run_profiler=create_run_profiler(args),
+    )
+
+    if isinstance(governor, SessionPool):
+        monitor_manager.add_job(
+            ScheduledJob(
+                "session-health",
+                governor.check_health,
+                args.health_check_minutes * 60,
+            ),
+            delay=args.health_check_minutes * 60,
+        )
+
+    return monitor_manager
+
+
+@contextmanager
+def serve_metrics(
+    monitor_manager: MonitorManager, args: argparse.Namespace, shard: int | None = None
+):
+    """Expose the metrics on --metrics-port and in --metrics-file while the block runs."""
+    server = None
+    if args.metrics_port is not None:
+        # Every shard listens on a port of its own
+        port = args.metrics_port + (shard or 0)
+        server = MetricsServer(port).start()
+
+    metrics_file = args.metrics_file
+    if metrics_file is not None:
+        if shard is not None:
+            metrics_file = metrics_file.with_name(
+                f"{metrics_file.stem}-{shard}{metrics_file.suffix}"
+            )
+        monitor_manager.add_job(
+            ScheduledJob(
+                "metrics-textfile",
+                lambda: REGISTRY.write_textfile(metrics_file),
+                args.metrics_interval,
+            )
+        )
+
+    try:
+        yield
+    finally:
+        if server is not None:
+            server.stop()
+        if metrics_file is not None:
+            REGISTRY.write_textfile(metrics_file)
+
+
+def create_login_manager(args: argparse.Namespace) -> LoginManager:
+    return LoginManager(
+        args.cookiefile[0] if args.cookiefile else None,
+        session_cache=SessionCache() if args.session_cache else None,
+    )
+
+
+def monitor_shard(shard, usernames_intervals, args, reports, stop_event):
+    """Worker process of --shards: monitor its usernames until the coordinator stops it."""
+    # Ctrl-C reaches every process, only the coordinator handles it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    reporter = ShardReporter(shard, reports)
+
+    # Interrupting the main thread does nothing with SIGINT ignored, stop the worker instead
+    login_failed = threading.Event()
+    login_manager = create_login_manager(args)
+
+    def on_login_failure(exc):
+        reporter.fatal(str(exc))
+        login_failed.set()
+
+    login_manager.on_login_failure = on_login_failure
+
+    with open_sessions(login_manager, args) as (insta_loader, governor):
+        monitor_manager = build_monitor_manager(
+            insta_loader,
+            governor,
+            args,
+            story_schedule_file=Path("output", f"story_schedule-{shard}.json"),
+            on_result=reporter.result,
+        )
+        try:
+            with serve_metrics(monitor_manager, args, shard):
+                for username, interval in usernames_intervals.items():
+                    monitor_manager.add_monitor(username, insta_loader, interval, args)
+
+                while not (
+                    stop_event.wait(args.heartbeat_seconds) or login_failed.is_set()
+                ):
+                    reporter.heartbeat(
+                        len(monitor_manager.monitors), monitor_manager.request_usage()
+                    )
+        finally:
+            monitor_manager.stop_all()
+
+    if login_failed.is_set():
+        sys.exit(1)
+
+
+def run_sharded(usernames_intervals, args: argparse.Namespace):
+    # Without a session pool every shard logs in to the same account, split its budget
+    if not args.session_pool:
+        args.requests_per_minute /= args.shards
+        args.burst = max(args.burst // args.shards, 1)
+
+    coordinator = ShardCoordinator(
+        monitor_shard,
+        usernames_intervals,
+        args,
+        args.shards,
+        heartbeat_seconds=args.heartbeat_seconds,
+    )
+    coordinator.start()
+    try:
+        coordinator.run()
+    except KeyboardInterrupt:
+        logging.info("KeyboardInterrupt recieved. Stopping shards...")
+    finally:
+        coordinator.stop()
+
+
 # TODO: background the thread
 def main(usernames_intervals, args: argparse.Namespace):
-    login_manager = LoginManager()
-    monitor_manager = MonitorManager()
+    login_manager = create_login_manager(args)
+    monitor_manager: MonitorManager | None = None
+
+    def stop_monitors():
+        if monitor_manager is not None:
+            monitor_manager.stop_all()
 
     def signal_handler(sig, frame):
         logging.info("Exiting gracefully...")
-        monitor_manager.stop_all()
+        stop_monitors()
         raise SystemExit
 
     signal.signal(signal.SIGINT, signal_handler)
 
     try:
-        with login_manager.session() as insta_loader:
-            for username, interval in usernames_intervals.items():
-                monitor_manager.add_monitor(username, insta_loader, interval, args)
+        with open_sessions(login_manager, args) as (insta_loader, governor):
+            monitor_manager = build_monitor_manager(insta_loader, governor, args)
+
+            with serve_metrics(monitor_manager, args):
+                for username, interval in usernames_intervals.items():
+                    monitor_manager.add_monitor(username, insta_loader, interval, args)
 
-            input("Press Enter to quit...")
-            signal.raise_signal(signal.SIGINT)
+                input("Press Enter to quit...")
+                signal.raise_signal(signal.SIGINT)
     except KeyboardInterrupt:
         logging.info("KeyboardInterrupt recieved. Exiting...")
-        monitor_manager.stop_all()
+        stop_monitors()
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["query"]:
+        query_history(sys.argv[2:])
+        sys.exit()
+    if sys.argv[1:2] == ["gc-blobs"]:
+        gc_blobs(sys.argv[2:])
+        sys.exit()
+
     parser = argparse.ArgumentParser(
         description="Run Instagram monitors for specified usernames."
     )
@@ -59,8 +481,241 @@ if __name__ == "__main__":
         default=True,
         help="Skip downloading stories.",
     )
+    parser.add_argument(
+        "--snapshot-store",
+        choices=["sqlite", "json"],
+        default="sqlite",
+        help="Where profile snapshots are stored: an append-only SQLite database (default) "
+        "or the legacy data.json file.",
+    )
+    parser.add_argument(
+        "--history-mode",
+        choices=["full", "delta"],
+        default="full",
+        help="Store the complete followers/following lists in every snapshot (full) or only "
+        "the userids added and removed between runs (delta, sqlite store only).",
+    )
+    parser.add_argument(
+        "--base-interval",
+        type=int,
+        default=96,
+        help="In delta history mode, write a full followers/following base every N runs.",
+    )
+    parser.add_argument(
+        "--fast-path",
+        action="store_true",
+        default=False,
+        help="Only enumerate followers/following when the profile's counts, bio or profile "
+        "picture changed since the last snapshot.",
+    )
+    parser.add_argument(
+        "--full-audit-hours",
+        type=float,
+        default=24,
+        help="With --fast-path, still enumerate everything at least this often (in hours).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Maximum number of monitors running at the same time.",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=30,
+        help="Delay each run by up to this many seconds to spread out requests.",
+    )
+    parser.add_argument(
+        "--requests-per-minute",
+        type=float,
+        default=20,
+        help="Sustained request rate shared by all monitors.",
+    )
+    parser.add_argument(
+        "--burst",
+        type=int,
+        default=10,
+        help="Number of requests that may be made back to back before rate limiting.",
+    )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        default=8,
+        help="Number of story/highlight items downloaded at the same time.",
+    )
+    parser.add_argument(
+        "--downloads-per-host",
+        type=int,
+        default=4,
+        help="Maximum concurrent downloads from a single media host.",
+    )
+    parser.add_argument(
+        "--batch-stories",
+        action="store_true",
+        default=False,
+        help="Poll the stories of all usernames together in batched requests instead of "
+        "once per username and run.",
+    )
+    parser.add_argument(
+        "--story-interval",
+        type=float,
+        default=60,
+        help="With --batch-stories, minutes between story polls.",
+    )
+    parser.add_argument(
+        "--story-batch-size",
+        type=int,
+        default=50,
+        help="With --batch-stories, number of profiles whose stories are fetched per request.",
+    )
+    parser.add_argument(
+        "--story-budget",
+        type=float,
+        default=None,
+        help="Schedule story polls by expiry and posting rate within this many story requests "
+        "per day, polling every profile at least once per 24 hours minus --story-margin when "
+        "the budget allows it. Implies --batch-stories.",
+    )
+    parser.add_argument(
+        "--story-margin",
+        type=float,
+        default=60,
+        help="With --story-budget, minutes kept between a profile's next poll and the expiry "
+        "of a story posted right after its last poll.",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        default=False,
+        help="Learn a separate interval for the followers, stories, highlights and posts of each "
+        "username from how often they change, between the username's interval and "
+        "--adaptive-max-hours.",
+    )
+    parser.add_argument(
+        "--adaptive-max-hours",
+        type=float,
+        default=24,
+        help="With --adaptive, longest interval between two runs of a phase.",
+    )
+    parser.add_argument(
+        "--concurrent-phases",
+        action="store_true",
+        default=False,
+        help="Fetch the highlights, stories, followers and posts of a username at the same "
+        "time instead of one after the other.",
+    )
+    parser.add_argument(
+        "--cookiefile",
+        action="append",
+        default=[],
+        help="Firefox cookies.sqlite file (or a directory to search) to log in with. Can be "
+        "given several times with --session-pool.",
+    )
+    parser.add_argument(
+        "--no-session-cache",
+        action="store_false",
+        dest="session_cache",
+        default=True,
+        help="Always search for the cookie file and log in again on startup instead of "
+        "reusing the session saved in output/sessions.",
+    )
+    parser.add_argument(
+        "--session-pool",
+        action="store_true",
+        default=False,
+        help="Spread the usernames over every session from --cookiefile and the "
+        "INSTAGRAM_USERNAME[_N]/INSTAGRAM_PASSWORD[_N] environment variables, each with "
+        "its own request budget.",
+    )
+    parser.add_argument(
+        "--session-eviction-minutes",
+        type=float,
+        default=30,
+        help="With --session-pool, minutes a session stays out of rotation after a 429, a "
+        "checkpoint or a failed health check.",
+    )
+    parser.add_argument(
+        "--health-check-minutes",
+        type=float,
+        default=30,
+        help="With --session-pool, minutes between login checks of every session.",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="Run the usernames in this many worker processes, each with its own session. A "
+        "username always runs in the same worker.",
+    )
+    parser.add_argument(
+        "--heartbeat-seconds",
+        type=float,
+        default=60,
+        help="With --shards, seconds between the health reports of each worker.",
+    )
+    parser.add_argument(
+        "--profile-cache-ttl",
+        type=float,
+        default=300,
+        help="Seconds a resolved profile is reused before it is fetched again.",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics. With --shards, shard "
+        "N listens on PORT + N.",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=Path,
+        default=None,
+        help="Write Prometheus metrics to this file for node_exporter's textfile "
+        "collector. With --shards, every shard writes its own file.",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=60,
+        help="With --metrics-file, seconds between two writes of the file.",
+    )
+    parser.add_argument(
+        "--profile-run",
+        metavar="USERNAME:N",
+        action="append",
+        default=[],
+        help="Capture a cProfile and tracemalloc profile of the Nth run of USERNAME (counted "
+        "from 1 since startup) in output/<username>_data/profiles and log the hottest "
+        "functions and allocation sites. Can be given several times.",
+    )
+    parser.add_argument(
+        "--profile-slower-than",
+        type=float,
+        default=None,
+        help="Capture a profile of every run taking longer than this many seconds. Every run "
+        "is profiled to catch them, which slows all of them down.",
+    )
+    parser.add_argument(
+        "--blob-store",
+        action="store_true",
+        default=False,
+        help="Store every media file once in output/blobs by its content hash and hardlink it "
+        "into the profile directories, so media shared between profiles and runs takes the "
+        "space of one copy. Remove the blobs nothing links to with 'main.py gc-blobs'.",
+    )
+    parser.add_argument(
+        "--export-metadata",
+        action="store_true",
+        default=False,
+        help="Compact the metadata log of each username, write it out as metadata.json "
+        "and exit without monitoring.",
+    )
 
     args = parser.parse_args()
+    if args.story_budget is not None:
+        # The scheduled polls replace the stories phase of each run
+        args.batch_stories = True
 
     # Parse usernames and intervals
     usernames_intervals = {}
@@ -68,4 +723,9 @@ if __name__ == "__main__":
         username, interval = ui.split(":")
         usernames_intervals[username] = int(interval)
 
-    main(usernames_intervals, args)
+    if args.export_metadata:
+        export_metadata(usernames_intervals)
+    elif args.shards > 1:
+        run_sharded(usernames_intervals, args)
+    else:
+        main(usernames_intervals, args)
@@ -1 +1,4 @@
 from .login_manager import LoginManager
+from .request_governor import RequestGovernor
+from .session_cache import SessionCache
+from .session_pool import PooledSession, SessionPool
@@ -1,19 +1,24 @@
+import _thread
 import fnmatch
 import logging
 import warnings
 from collections import OrderedDict
+from collections.abc import Callable
 from contextlib import contextmanager
 from os import PathLike, getenv
 from pathlib import Path
 from sqlite3 import OperationalError, connect
 
 from dotenv import load_dotenv
+from instaloader.exceptions import InstaloaderException, LoginRequiredException
 from instaloader.instaloader import (
     ConnectionException,
     Instaloader,
     TwoFactorAuthRequiredException,
 )
 
+from .session_cache import SessionCache, cookiefile_mtime
+
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
@@ -26,12 +31,42 @@ class NoCookiesFileFoundWarning(UserWarning):
 
 
 class LoginManager:
-    def __init__(self, cookiefile: PathLike | None = None) -> None:
+    def __init__(
+        self,
+        cookiefile: PathLike | None = None,
+        session_cache: SessionCache | None = None,
+    ) -> None:
         self.cookiefile = cookiefile if cookiefile else None
         self.cookiefile_string = str(self.cookiefile)
         self.instaloader = Instaloader()
 
+        # Sessions restored from the cache are only checked when first used
+        self.session_cache = session_cache
+        self._unverified_source: str | None = None
+        # Set once an expired cached session couldn't be logged in again
+        self._login_failure: LoginRequiredException | None = None
+        # Called with that failure to stop the process, interrupts the main thread if None
+        self.on_login_failure: Callable[[LoginRequiredException], None] | None = None
+
+    @property
+    def needs_validation(self) -> bool:
+        """Whether the session was restored from the cache and hasn't been checked yet."""
+        return self._unverified_source is not None
+
     def get_cookiefile(self, custom_path=None):
+        if self.session_cache is None:
+            return self._find_cookiefile(custom_path)
+
+        cached = self.session_cache.cookiefile(str(custom_path))
+        if cached is not None:
+            return cached
+
+        cookiefile = self._find_cookiefile(custom_path)
+        if isinstance(cookiefile, Path):
+            self.session_cache.set_cookiefile(str(custom_path), cookiefile)
+        return cookiefile
+
+    def _find_cookiefile(self, custom_path=None):
         matching_files = []
         if custom_path:
             search_path = Path(custom_path).expanduser()
@@ -111,26 +146,65 @@ class LoginManager:
             )
         return cookie_data
 
-    def import_session(self):
-        logging.info("Using cookies from %s", self.cookiefile_string)
+    def login_with_cookiefile(self, cookiefile: PathLike | str) -> Instaloader | None:
+        """
+        Create an Instaloader logged in with the Instagram cookies of a Firefox cookie database.
 
-        self.cookiefile_string = str(self.get_cookiefile(self.cookiefile))
+        Returns:
+            The Instaloader, or None if the cookies are not logged in.
+        """
+        # Initialize Instaloader
+        instaloader = Instaloader(max_connection_attempts=1)
+
+        # Test login
+        username = self._load_cookies(instaloader, cookiefile)
+        if not username:
+            return None
+
+        logging.info("Imported session cookie for %s.", username)
+        instaloader.context.username = username
+
+        return instaloader
+
+    def _load_cookies(
+        self, instaloader: Instaloader, cookiefile: PathLike | str
+    ) -> str | None:
+        """Load the cookies of `cookiefile` into `instaloader`, returns who they log in as."""
         # connect to the database
-        conn = connect(self.cookiefile_string)
+        conn = connect(str(cookiefile))
 
-        try:
-            # Fetch cookie data from the database
-            cookie_data = self._get_cookie_data_from_db(conn)
+        # Fetch cookie data from the database
+        cookie_data = self._get_cookie_data_from_db(conn)
+
+        # update session cookies
+        instaloader.context._session.cookies.update(cookie_data)
+        conn.close()
+
+        return instaloader.test_login()
 
-            # Initialize Instaloader
-            instaloader = Instaloader(max_connection_attempts=1)
+    def login_with_credentials(self, username: str, password: str) -> Instaloader:
+        instaloader = Instaloader()
+        instaloader.login(username, password)
+        logging.info("Logged in as %s", username)
+        return instaloader
+
+    def import_session(self):
+        logging.info("Using cookies from %s", self.cookiefile_string)
+
+        self.cookiefile_string = str(self.get_cookiefile(self.cookiefile))
 
-            # update session cookies
-            instaloader.context._session.cookies.update(cookie_data)
+        # Reuse the saved session as long as Firefox didn't touch the cookies since
+        mtime = None
+        if self.session_cache is not None:
+            mtime = cookiefile_mtime(self.cookiefile_string)
+            instaloader = self.session_cache.load(self.cookiefile_string, mtime)
+            if instaloader is not None:
+                self._unverified_source = self.cookiefile_string
+                return instaloader
 
-            # Test login
-            username = instaloader.test_login()
-            if not username:
+        try:
+            instaloader = self.login_with_cookiefile(self.cookiefile_string)
+            if instaloader is None:
                 logging.error(
                     "Not logged in. Are you logged in successfully in Firefox?"
                 )
@@ -138,9 +212,8 @@ class LoginManager:
                     "Not logged in. Are you logged in successfully in Firefox?"
                 )
 
-            logging.info("Imported session cookie for %s.", username)
-            instaloader.context.username = username
-
+            if self.session_cache is not None:
+                self.session_cache.save(self.cookiefile_string, instaloader, mtime)
             return instaloader
 
         except (ConnectionException, OperationalError) as exc:
@@ -160,6 +233,94 @@ class LoginManager:
             )
         return username, password
 
+    def load_pool_credentials_from_env(self) -> list[tuple[str, str]]:
+        """
+        Credentials for a session pool: INSTAGRAM_USERNAME/INSTAGRAM_PASSWORD followed by
+        INSTAGRAM_USERNAME_2/INSTAGRAM_PASSWORD_2 and so on, until one is missing.
+        """
+        load_dotenv()
+        credentials = []
+        suffixes = [""] + [f"_{number}" for number in range(2, 100)]
+        for suffix in suffixes:
+            username = getenv(f"INSTAGRAM_USERNAME{suffix}")
+            password = getenv(f"INSTAGRAM_PASSWORD{suffix}")
+            if not username or not password:
+                # The unnumbered pair is optional
+                if suffix:
+                    break
+                continue
+            credentials.append((username, password))
+        return credentials
+
+    def validate_session(self, instaloader: Instaloader) -> None:
+        """
+        Check a session restored from the cache, meant to run right before its first request.
+
+        An expired session is dropped from the cache and logged in again in place, so a rate
+        controller installed on it stays: with the cookie file it came from (Firefox may have
+        refreshed them) and otherwise with the credentials from the environment. If neither
+        works, `on_login_failure` is called (or the main thread interrupted) to stop the process
+        and this raises LoginRequiredException every time it is called, so no request goes out
+        on the expired session in the meantime.
+        """
+        if self._login_failure is not None:
+            raise self._login_failure
+
+        source = self._unverified_source
+        if source is None:
+            return
+
+        if instaloader.test_login():
+            self._unverified_source = None
+            logging.info("Cached session of %s is valid.", instaloader.context.username)
+            return
+
+        logging.warning("Cached session from %s expired.", source)
+        self._unverified_source = None
+        self.session_cache.invalidate(source)
+        if self._login_again(instaloader, source):
+            return
+
+        self._login_failure = LoginRequiredException(
+            "Cached session expired and logging in again failed, log in to Instagram in "
+            "Firefox or set INSTAGRAM_USERNAME and INSTAGRAM_PASSWORD."
+        )
+        logging.critical("%s Stopping.", self._login_failure)
+        if self.on_login_failure is not None:
+            self.on_login_failure(self._login_failure)
+        else:
+            # Runs on a monitor thread, the main thread is the one that can stop everything
+            _thread.interrupt_main()
+        raise self._login_failure
+
+    def _login_again(self, instaloader: Instaloader, source: str) -> bool:
+        """Log `instaloader` in again after its cached session from `source` expired."""
+        if not source.startswith("credentials:"):
+            try:
+                username = self._load_cookies(instaloader, source)
+            except (InstaloaderException, OperationalError) as exc:
+                logging.warning("Failed to import session from %s: %s", source, exc)
+                username = None
+            if username:
+                logging.info("Imported session cookie for %s.", username)
+                instaloader.context.username = username
+                self.session_cache.save(source, instaloader, cookiefile_mtime(source))
+                return True
+
+        load_dotenv()
+        username = getenv("INSTAGRAM_USERNAME")
+        password = getenv("INSTAGRAM_PASSWORD")
+        if not username or not password:
+            return False
+        try:
+            instaloader.login(username, password)
+        except InstaloaderException as exc:
+            logging.error("Failed to log in as %s: %s", username, exc)
+            return False
+        logging.info("Logged in as %s", username)
+        self.session_cache.save(f"credentials:{username}", instaloader)
+        return True
+
     @contextmanager
     def session(self):
         def login_and_yield_instaloader():
@@ -173,9 +334,20 @@ class LoginManager:
                 logging.info("Trying to login in with environment variables.")
                 username, password = self.load_credentials_from_env()
 
+                # A full login is what triggers checkpoints, avoid it when possible
+                source = f"credentials:{username}"
+                if self.session_cache is not None:
+                    instaloader = self.session_cache.load(source)
+                    if instaloader is not None:
+                        self._unverified_source = source
+                        self.instaloader = instaloader
+                        return self.instaloader
+
                 try:
                     self.instaloader.login(username, password)
                     logging.info("Logged in as %s", username)
+                    if self.session_cache is not None:
+                        self.session_cache.save(source, self.instaloader)
                     return self.instaloader
 
                 except TwoFactorAuthRequiredException as te:
@@ -0,0 +1,274 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Callable
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from instaloader.instaloader import Instaloader
+from instaloader.instaloadercontext import InstaloaderContext, RateController
+
+from src.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+REQUESTS = REGISTRY.counter(
+    "instagram_monitor_requests_total",
+    "Instagram requests let through the governor.",
+    ("session", "monitor", "query_type"),
+)
+REQUEST_WAIT = REGISTRY.histogram(
+    "instagram_monitor_request_wait_seconds",
+    "Seconds a request waited for the backoff and the rate limit.",
+    ("session",),
+)
+FAILURES = REGISTRY.counter(
+    "instagram_monitor_failures_total",
+    "429s and connection errors that started or extended the shared backoff.",
+    ("session", "reason"),
+)
+TOKENS = REGISTRY.gauge(
+    "instagram_monitor_rate_limit_tokens",
+    "Requests that can still be made back to back, 0 while requests are throttled.",
+    ("session",),
+)
+RATE_LIMIT = REGISTRY.gauge(
+    "instagram_monitor_rate_limit_requests_per_minute",
+    "Configured sustained request rate.",
+    ("session",),
+)
+BACKOFF = REGISTRY.gauge(
+    "instagram_monitor_backoff_seconds",
+    "Length of the shared backoff in progress, 0 outside of one.",
+    ("session",),
+)
+
+
+class TokenBucket:
+    def __init__(self, requests_per_minute: float, burst: int) -> None:
+        self.rate = requests_per_minute / 60
+        self.capacity = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take one token, blocking until one is available. Returns the seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+
+            time.sleep(delay)
+            waited += delay
+
+    def available(self) -> float:
+        with self._lock:
+            elapsed = time.monotonic() - self._updated
+            return min(self.capacity, self._tokens + elapsed * self.rate)
+
+
+class RequestGovernor:
+    """
+    Request budget shared by every monitor using the same Instagram session.
+
+    Every request takes a token from a token bucket. A 429 or a connection error puts all
+    monitors in a shared exponential backoff instead of each one retrying on its own, the backoff
+    starts over from `backoff_seconds` once a request made after it went through. Requests are
+    accounted to the monitor running in the current context (see `monitor`) so the budget used
+    by each profile can be reported. Threads started with a copy of that context, like the
+    phases of a monitor run, are accounted to the same monitor.
+
+    The requests, waits and failures are also recorded in the metrics under the `name` of the
+    session the governor belongs to.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = 20,
+        burst: int = 10,
+        backoff_seconds: float = 60,
+        max_backoff_seconds: float = 30 * 60,
+        on_rate_limited: Callable[[], None] | None = None,
+        name: str = "default",
+    ) -> None:
+        self.name = name
+        self.bucket = TokenBucket(requests_per_minute, burst)
+        RATE_LIMIT.set(requests_per_minute, session=name)
+        # Called on every 429, e.g. to move monitors to another session
+        self.on_rate_limited = on_rate_limited
+        # Run before requests are let through until it succeeds once, e.g. to check a cached
+        # session
+        self.before_first_request: Callable[[], None] | None = None
+        self._first_request_lock = threading.RLock()
+        self._in_first_request_hook = False
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+        self._lock = threading.Lock()
+        self._backoff_until = 0.0
+        self._failures = 0
+        self._last_failure = 0.0
+        # When the current thread's last request was let through, it is known to have gone
+        # through once the thread makes its next request without a failure in between
+        self._thread_requests = threading.local()
+        self._monitor: ContextVar[str | None] = ContextVar(
+            f"governed_monitor_{id(self)}", default=None
+        )
+
+        # monitor name -> {"requests": ..., "waited_seconds": ..., <query type>: ...}
+        self._usage: dict[str, dict[str, float]] = defaultdict(
+            lambda: defaultdict(float)
+        )
+
+    def install(self, instaloader: Instaloader) -> Instaloader:
+        """Route the requests of `instaloader` through this governor."""
+        instaloader.context._rate_controller = GovernedRateController(
+            instaloader.context, self
+        )
+        return instaloader
+
+    @contextmanager
+    def monitor(self, name: str):
+        """
+        Account the requests made in the current context to the monitor `name`.
+
+        Yields None, a `SessionPool` yields the session to use instead.
+        """
+        token = self._monitor.set(name)
+        try:
+            yield
+        finally:
+            self._monitor.reset(token)
+
+    @property
+    def current_monitor(self) -> str:
+        return self._monitor.get() or "unassigned"
+
+    def acquire(self, query_type: str) -> None:
+        """Block until a request of `query_type` may be made."""
+        if self.before_first_request is not None:
+            self._run_before_first_request()
+
+        previous_request = getattr(self._thread_requests, "started", None)
+        if previous_request is not None:
+            self.report_success(previous_request)
+
+        waited = self.wait_for_backoff()
+        waited += self.bucket.acquire()
+
+        with self._lock:
+            usage = self._usage[self.current_monitor]
+            usage["requests"] += 1
+            usage[query_type] += 1
+            usage["waited_seconds"] += waited
+
+        REQUESTS.inc(
+            session=self.name, monitor=self.current_monitor, query_type=query_type
+        )
+        REQUEST_WAIT.observe(waited, session=self.name)
+        TOKENS.set(self.bucket.available(), session=self.name)
+        self._thread_requests.started = time.monotonic()
+
+    def _run_before_first_request(self) -> None:
+        # Requests from other threads wait for the hook to finish, requests made by the hook
+        # itself re-enter the lock and get through
+        with self._first_request_lock:
+            hook = self.before_first_request
+            if hook is None or self._in_first_request_hook:
+                return
+            self._in_first_request_hook = True
+            try:
+                hook()
+                # A hook that raised runs again before the next request
+                self.before_first_request = None
+            finally:
+                self._in_first_request_hook = False
+
+    def wait_for_backoff(self) -> float:
+        waited = 0.0
+        while True:
+            with self._lock:
+                delay = self._backoff_until - time.monotonic()
+            if delay <= 0:
+                if waited:
+                    BACKOFF.set(0, session=self.name)
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    def report_failure(self, reason: str) -> None:
+        """Start or extend the shared backoff after a 429 or a connection error."""
+        with self._lock:
+            now = time.monotonic()
+            # Forget old failures once things have been quiet for a while
+            if now - self._last_failure > self.max_backoff_seconds:
+                self._failures = 0
+            self._failures += 1
+            self._last_failure = now
+
+            backoff = min(
+                self.backoff_seconds * 2 ** (self._failures - 1),
+                self.max_backoff_seconds,
+            )
+            self._backoff_until = max(self._backoff_until, now + backoff)
+
+        # "429 Too Many Requests (graphql)", "Connection error: ..." -> the kind of failure
+        FAILURES.inc(session=self.name, reason=reason.split(":")[0].split(" (")[0])
+        BACKOFF.set(backoff, session=self.name)
+        logger.warning(
+            "%s for %s, pausing all requests for %d seconds",
+            reason,
+            self.current_monitor,
+            backoff,
+        )
+
+    def report_success(self, started: float) -> None:
+        """
+        Reset the backoff after a request let through at `started` went through, if it was made
+        after the backoff and the last failure.
+        """
+        with self._lock:
+            if (
+                self._failures
+                and started >= self._backoff_until
+                and started > self._last_failure
+            ):
+                logger.info(
+                    "Requests go through again, resetting the backoff after %d failures",
+                    self._failures,
+                )
+                self._failures = 0
+
+    def usage(self) -> dict[str, dict[str, float]]:
+        with self._lock:
+            return {name: dict(usage) for name, usage in self._usage.items()}
+
+
+class GovernedRateController(RateController):
+    """Instaloader rate controller that also goes through the shared `RequestGovernor`."""
+
+    def __init__(self, context: InstaloaderContext, governor: RequestGovernor) -> None:
+        super().__init__(context)
+        self.governor = governor
+
+    def wait_before_query(self, query_type: str) -> None:
+        self.governor.acquire(query_type)
+        # Keep Instaloader's own per query type sliding windows as well
+        super().wait_before_query(query_type)
+
+    def handle_429(self, query_type: str) -> None:
+        self.governor.report_failure(f"429 Too Many Requests ({query_type})")
+        if self.governor.on_rate_limited is not None:
+            self.governor.on_rate_limited()
+        self.governor.wait_for_backoff()
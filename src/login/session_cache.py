@@ -0,0 +1,107 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+from instaloader.instaloader import Instaloader
+
+logger = logging.getLogger(__name__)
+
+SESSION_CACHE_DIR = Path("output", "sessions")
+
+
+def cookiefile_mtime(cookiefile: Path | str) -> float:
+    """Last change to a Firefox cookie database, including its write-ahead log."""
+    cookiefile = Path(cookiefile)
+    mtimes = [cookiefile.stat().st_mtime]
+    wal_file = cookiefile.with_name(cookiefile.name + "-wal")
+    if wal_file.exists():
+        mtimes.append(wal_file.stat().st_mtime)
+    return max(mtimes)
+
+
+class SessionCache:
+    """
+    Resolved cookie database paths and saved Instaloader sessions, so a restart neither walks
+    the Firefox profiles nor logs in again.
+
+    Sessions are saved with `Instaloader.save_session_to_file` under the source they were made
+    from (a cookie database or a username) along with the source's mtime. A cookie session is
+    only reused while the cookie database hasn't changed since it was saved.
+    """
+
+    def __init__(self, cache_dir: Path = SESSION_CACHE_DIR) -> None:
+        self.cache_dir = cache_dir
+        self.index_file = cache_dir / "index.json"
+        self._lock = threading.Lock()
+
+        # {"cookiefiles": {search path: cookie db}, "sessions": {source: {...}}}
+        self._index: dict[str, dict] = {"cookiefiles": {}, "sessions": {}}
+        if self.index_file.exists():
+            try:
+                with open(self.index_file, "r", encoding="utf-8") as file:
+                    self._index = json.load(file)
+            except json.JSONDecodeError as exc:
+                logger.warning("Ignoring unreadable session cache index: %s", exc)
+
+    def _save_index(self) -> None:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Shards share the cache, each one writes through its own temporary file
+        temp_file = self.index_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(temp_file, "w", encoding="utf-8") as file:
+            json.dump(self._index, file, indent=4)
+        os.replace(temp_file, self.index_file)
+
+    def cookiefile(self, search_path: str) -> Path | None:
+        with self._lock:
+            cached = self._index["cookiefiles"].get(search_path)
+        if cached is None or not Path(cached).is_file():
+            return None
+        return Path(cached)
+
+    def set_cookiefile(self, search_path: str, cookiefile: Path) -> None:
+        with self._lock:
+            self._index["cookiefiles"][search_path] = str(cookiefile)
+            self._save_index()
+
+    def load(self, source: str, mtime: float | None = None) -> Instaloader | None:
+        """
+        Restore the session saved for `source`, if `source` hasn't changed since. The session
+        is not checked against Instagram.
+        """
+        with self._lock:
+            entry = self._index["sessions"].get(source)
+        if entry is None or entry["mtime"] != mtime:
+            return None
+
+        session_file = self.cache_dir / entry["session_file"]
+        if not session_file.exists():
+            return None
+
+        instaloader = Instaloader(max_connection_attempts=1)
+        instaloader.load_session_from_file(entry["username"], str(session_file))
+        logger.info("Reusing cached session of %s from %s", entry["username"], source)
+        return instaloader
+
+    def save(self, source: str, instaloader: Instaloader, mtime: float | None = None):
+        username = instaloader.context.username
+        session_file = self.cache_dir / f"session-{username}"
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        instaloader.save_session_to_file(str(session_file))
+        # The session file holds the login cookies
+        os.chmod(session_file, 0o600)
+
+        with self._lock:
+            self._index["sessions"][source] = {
+                "username": username,
+                "mtime": mtime,
+                "session_file": session_file.name,
+            }
+            self._save_index()
+
+    def invalidate(self, source: str) -> None:
+        with self._lock:
+            if self._index["sessions"].pop(source, None) is not None:
+                self._save_index()
@@ -0,0 +1,214 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from sqlite3 import OperationalError
+
+from instaloader.exceptions import (
+    ConnectionException,
+    InstaloaderException,
+    LoginRequiredException,
+)
+from instaloader.instaloader import Instaloader
+
+from .login_manager import LoginManager
+from .request_governor import RequestGovernor
+
+logger = logging.getLogger(__name__)
+
+# Failure reasons that mean the account itself is blocked, not just throttled
+_CHECKPOINT_MARKERS = ("checkpoint", "login required", "redirected to login")
+
+
+@dataclass
+class PooledSession:
+    name: str
+    instaloader: Instaloader
+    governor: RequestGovernor
+    # Out of rotation until this monotonic time
+    evicted_until: float = 0
+    monitors: set[str] = field(default_factory=set)
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.evicted_until
+
+
+class SessionPool:
+    """
+    Several logged in Instagram sessions that monitors are spread across.
+
+    Sessions are loaded from Firefox cookie databases and username/password pairs and checked
+    with `test_login`. Each session has its own `RequestGovernor`, so every account keeps to its
+    own rate limit and the total capacity grows with the number of sessions. A monitor sticks to
+    its session until that session is taken out of rotation, after a 429, a checkpoint or a
+    failed health check, then it moves to the least loaded available session.
+
+    The pool can be used where a `RequestGovernor` is expected: `monitor` yields the session the
+    monitor should use, `report_failure` and `usage` apply to the sessions.
+    """
+
+    def __init__(
+        self,
+        login_manager: LoginManager,
+        cookiefiles: list[str] | None = None,
+        credentials: list[tuple[str, str]] | None = None,
+        requests_per_minute: float = 20,
+        burst: int = 10,
+        eviction_seconds: float = 30 * 60,
+    ) -> None:
+        self.login_manager = login_manager
+        self.cookiefiles = cookiefiles or []
+        self.credentials = credentials or []
+        self.requests_per_minute = requests_per_minute
+        self.burst = burst
+        self.eviction_seconds = eviction_seconds
+
+        self.sessions: list[PooledSession] = []
+        self._lock = threading.Lock()
+        self._current: ContextVar[PooledSession | None] = ContextVar(
+            f"pooled_session_{id(self)}", default=None
+        )
+
+    def open(self) -> "SessionPool":
+        """Log in every session source, keeping the ones that pass `test_login`."""
+        sources = [
+            (str(cookiefile), lambda path=cookiefile: self._login_cookiefile(path))
+            for cookiefile in self.cookiefiles
+        ] + [
+            (
+                username,
+                lambda username=username, password=password: (
+                    self.login_manager.login_with_credentials(username, password)
+                ),
+            )
+            for username, password in self.credentials
+        ]
+
+        for source, login in sources:
+            try:
+                instaloader = login()
+            except (InstaloaderException, OperationalError, FileNotFoundError) as exc:
+                logger.error("Could not log in with %s: %s", source, exc)
+                continue
+            if instaloader is None:
+                logger.error("Cookies in %s are not logged in", source)
+                continue
+            self.add(instaloader.context.username, instaloader)
+
+        if not self.sessions:
+            raise SystemExit("No session of the pool could log in.")
+        logger.info("Session pool ready with %d sessions", len(self.sessions))
+        return self
+
+    def _login_cookiefile(self, cookiefile) -> Instaloader | None:
+        return self.login_manager.login_with_cookiefile(
+            self.login_manager.get_cookiefile(cookiefile)
+        )
+
+    def add(self, name: str, instaloader: Instaloader) -> PooledSession:
+        governor = RequestGovernor(
+            requests_per_minute=self.requests_per_minute,
+            burst=self.burst,
+            on_rate_limited=lambda: self.evict(session, "429 Too Many Requests"),
+            name=name,
+        )
+        governor.install(instaloader)
+        session = PooledSession(name, instaloader, governor)
+        with self._lock:
+            self.sessions.append(session)
+        return session
+
+    def session_for(self, name: str) -> PooledSession:
+        """The session the monitor `name` should use for its next run."""
+        with self._lock:
+            for session in self.sessions:
+                if name in session.monitors:
+                    if session.available:
+                        return session
+                    session.monitors.discard(name)
+
+            available = [session for session in self.sessions if session.available]
+            if available:
+                session = min(available, key=lambda session: len(session.monitors))
+            else:
+                # Everything is out of rotation, use the one coming back first, its governor
+                # makes the requests wait out the backoff
+                session = min(self.sessions, key=lambda session: session.evicted_until)
+                logger.warning(
+                    "No session available for %s, using %s", name, session.name
+                )
+            session.monitors.add(name)
+            return session
+
+    @contextmanager
+    def monitor(self, name: str):
+        """Account the requests in the current context to `name`, yields its session."""
+        session = self.session_for(name)
+        token = self._current.set(session)
+        try:
+            with session.governor.monitor(name):
+                yield session
+        finally:
+            self._current.reset(token)
+
+    def evict(self, session: PooledSession, reason: str) -> None:
+        with self._lock:
+            session.evicted_until = time.monotonic() + self.eviction_seconds
+            monitors = len(session.monitors)
+        logger.warning(
+            "Taking session %s out of rotation for %d seconds (%s), moving its %d monitors",
+            session.name,
+            self.eviction_seconds,
+            reason,
+            monitors,
+        )
+
+    def report_failure(self, reason: str) -> None:
+        session = self._current.get()
+        if session is None:
+            return
+        session.governor.report_failure(reason)
+        if any(marker in reason.lower() for marker in _CHECKPOINT_MARKERS):
+            self.evict(session, reason)
+
+    def check_health(self) -> None:
+        """Run `test_login` on every session and take the ones that fail out of rotation."""
+        for session in list(self.sessions):
+            # Don't spend requests on sessions that are still serving an eviction
+            if not session.available:
+                continue
+            try:
+                with session.governor.monitor("health-check"):
+                    username = session.instaloader.test_login()
+            except (ConnectionException, LoginRequiredException) as exc:
+                self.evict(session, f"health check failed: {exc}")
+                continue
+            if not username:
+                self.evict(session, "health check failed: not logged in")
+
+    def usage(self) -> dict[str, dict[str, float]]:
+        """Usage per monitor summed over every session."""
+        total: dict[str, dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        for session in self.sessions:
+            for name, usage in session.governor.usage().items():
+                for key, value in usage.items():
+                    total[name][key] += value
+        return {name: dict(usage) for name, usage in total.items()}
+
+    def session_usage(self) -> dict[str, dict[str, float]]:
+        """Requests made through each session, and whether it is in rotation."""
+        return {
+            session.name: {
+                "requests": sum(
+                    usage.get("requests", 0)
+                    for usage in session.governor.usage().values()
+                ),
+                "monitors": len(session.monitors),
+                "available": session.available,
+            }
+            for session in self.sessions
+        }
@@ -0,0 +1,2 @@
+from .registry import REGISTRY, Counter, Gauge, Histogram, MetricsRegistry
+from .server import MetricsServer
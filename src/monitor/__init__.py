@@ -1 +1,11 @@
+from .blob_store import BlobStore
+from .download_pipeline import DownloadPipeline
+from .metadata_log import MetadataLog
+from .monitor import profile_data_dir
 from .monitor_manager import MonitorManager
+from .profile_cache import ProfileCache
+from .run_profiler import RunProfiler
+from .scheduler import ScheduledJob
+from .sharding import HashRing, ShardCoordinator, ShardReporter
+from .story_poller import StoryPoller
+from .story_schedule import StorySchedule
@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+from collections.abc import Iterable
+from pathlib import Path
+
+from .scheduler import ScheduledJob
+
+PHASES = ("followers", "stories", "highlights", "posts")
+
+# Stories must still be polled before a story posted after the last poll expires
+MAX_STORY_INTERVAL = 23 * 60 * 60
+
+
+class AdaptiveIntervals:
+    """
+    Per phase polling intervals of one profile, learned from how often each phase finds
+    changes.
+
+    A phase that finds a change has its interval halved, a phase that finds nothing has it
+    stretched by `growth`, always within [`min_seconds`, `max_seconds`]. Dormant accounts end up
+    polled every `max_seconds` while active ones stay close to `min_seconds`. Only `phases` (the
+    ones enabled for the profile) are scheduled. The intervals and the observed change counts
+    are kept in `state_file` so they survive restarts.
+    """
+
+    def __init__(
+        self,
+        state_file: Path,
+        min_seconds: float,
+        max_seconds: float,
+        phases: Iterable[str] = PHASES,
+        growth: float = 1.5,
+    ) -> None:
+        self.state_file = state_file
+        self.phases = tuple(phases)
+        self.min_seconds = min_seconds
+        self.max_seconds = max(max_seconds, min_seconds)
+        self.growth = growth
+        self._lock = threading.Lock()
+
+        # phase -> {"interval": ..., "last_run": ..., "runs": ..., "changes": ...}
+        self._phases: dict[str, dict] = {}
+        if state_file.exists():
+            with open(state_file, "r", encoding="utf-8") as file:
+                self._phases = json.load(file)
+        for phase in PHASES:
+            self._phases.setdefault(
+                phase,
+                {"interval": min_seconds, "last_run": None, "runs": 0, "changes": 0},
+            )
+
+    def _bounds(self, phase: str) -> tuple[float, float]:
+        if phase == "stories":
+            return min(self.min_seconds, MAX_STORY_INTERVAL), min(
+                self.max_seconds, MAX_STORY_INTERVAL
+            )
+        return self.min_seconds, self.max_seconds
+
+    def interval(self, phase: str) -> float:
+        low, high = self._bounds(phase)
+        with self._lock:
+            return min(max(self._phases[phase]["interval"], low), high)
+
+    def next_run(self, phase: str) -> float:
+        with self._lock:
+            last_run = self._phases[phase]["last_run"]
+        if last_run is None:
+            return 0
+        return last_run + self.interval(phase)
+
+    def due_phases(self, now: float | None = None) -> set[str]:
+        # A little slack so a phase due just after this run doesn't need a run of its own
+        now = (now or time.time()) + 60
+        return {phase for phase in self.phases if self.next_run(phase) <= now}
+
+    def seconds_until_next(self, now: float | None = None) -> float:
+        now = now or time.time()
+        return max(min(self.next_run(phase) for phase in self.phases) - now, 0)
+
+    def record(self, phase: str, changed: bool, ran_at: float) -> None:
+        """Record a run of `phase` and adapt its interval to whether it found changes."""
+        low, high = self._bounds(phase)
+        with self._lock:
+            state = self._phases[phase]
+            state["last_run"] = ran_at
+            state["runs"] += 1
+            if changed:
+                state["changes"] += 1
+                interval = state["interval"] / 2
+            else:
+                interval = state["interval"] * self.growth
+            state["interval"] = min(max(interval, low), high)
+
+    def record_failure(self, ran_at: float) -> None:
+        """
+        Record a failed run: the phases that were due wait a full interval again, so a profile
+        that keeps failing (deleted, private, erroring) is not polled more often than one that
+        works. The intervals themselves are left alone.
+        """
+        due = self.due_phases(ran_at)
+        with self._lock:
+            for phase in due:
+                self._phases[phase]["last_run"] = ran_at
+
+    def save(self) -> None:
+        with self._lock:
+            temp_file = self.state_file.with_suffix(".tmp")
+            with open(temp_file, "w", encoding="utf-8") as file:
+                json.dump(self._phases, file, indent=4)
+            os.replace(temp_file, self.state_file)
+
+    def summary(self) -> dict[str, dict]:
+        """Current interval (minutes) and observed change ratio of each phase."""
+        summary = {}
+        for phase in self.phases:
+            with self._lock:
+                state = dict(self._phases[phase])
+            change_ratio = state["changes"] / state["runs"] if state["runs"] else None
+            summary[phase] = {
+                "interval_minutes": round(self.interval(phase) / 60, 1),
+                "change_ratio": change_ratio,
+            }
+        return summary
+
+
+class AdaptiveJob(ScheduledJob):
+    """Monitor job that wakes up when the next phase of its profile is due."""
+
+    # Never run more often than this, even if a phase was due during the last run
+    MIN_DELAY = 60
+
+    def __init__(self, intervals: AdaptiveIntervals, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.intervals = intervals
+
+    def next_delay(self) -> float:
+        # The scheduler adds the delay to the slot of the run that just finished
+        return time.monotonic() - self.due_at + max(
+            self.intervals.seconds_until_next(), self.MIN_DELAY
+        )
@@ -0,0 +1,165 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from src.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DEDUPLICATED = REGISTRY.counter(
+    "instagram_monitor_blob_deduplicated_total",
+    "Media files replaced by a link to an identical blob already in the blob store.",
+)
+DEDUPLICATED_BYTES = REGISTRY.counter(
+    "instagram_monitor_blob_deduplicated_bytes_total",
+    "Bytes of media not stored again thanks to the blob store.",
+)
+
+# Files written by Instaloader that are media, the json and txt metadata differs per post
+MEDIA_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp", ".heic", ".mp4"}
+
+
+class BlobStore:
+    """
+    Content-addressed store of media files shared by every profile, under `root`.
+
+    A media file is stored once as `<root>/<sha256[:2]>/<sha256>` and the files in the profile
+    directories are hardlinks to it: the first file with some content becomes the blob by being
+    linked into the store, later files with the same content (reposts, highlights shared between
+    profiles, an unchanged profile picture) are replaced by a link to that blob. A blob no file
+    links to anymore has a link count of 1 and is removed by `gc`.
+
+    Hardlinks need the profile directories and the store on the same filesystem. Files that
+    can't be linked are left where they are, they are just not deduplicated. Reflinks are not
+    used, a reflinked copy can't be told apart from an unrelated file so it would look orphaned
+    to `gc`. Linked files share their modification time.
+    """
+
+    def __init__(self, root: Path = Path("output", "blobs")) -> None:
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        self._warned = False
+        self._lock = threading.Lock()
+
+    def blob_path(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / sha256
+
+    def add(self, path: Path, sha256: str | None = None) -> Path | None:
+        """
+        Store the file at `path`, hashing it unless its `sha256` was computed while it was
+        written, and turn `path` into a link to the blob.
+
+        Returns:
+            The blob, None when `path` could not be linked into the store.
+        """
+        if sha256 is None:
+            sha256 = _hash_file(path)
+        blob = self.blob_path(sha256)
+        blob.parent.mkdir(exist_ok=True)
+
+        try:
+            # Atomic across threads and shards, the first file with this content wins
+            os.link(path, blob)
+            return blob
+        except FileExistsError:
+            pass
+        except OSError as e:
+            self._warn_unlinkable(path, e)
+            return None
+
+        temp_link = path.with_name(f".{path.name}.{threading.get_ident()}.link")
+        try:
+            if os.path.samefile(path, blob):
+                return blob
+            size = path.stat().st_size
+            os.link(blob, temp_link)
+        except OSError as e:
+            # EMLINK once a blob is linked from very many files, or gc just removed it
+            self._warn_unlinkable(path, e)
+            return None
+        os.replace(temp_link, path)
+
+        DEDUPLICATED.inc()
+        DEDUPLICATED_BYTES.inc(size)
+        return blob
+
+    def add_directory(self, directory: Path) -> int:
+        """
+        Store the media files of `directory` (not its subdirectories) that aren't links to a
+        blob yet.
+
+        Returns:
+            The number of files that were added.
+        """
+        if not directory.is_dir():
+            return 0
+
+        added = 0
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if (
+                    entry.is_file(follow_symlinks=False)
+                    and Path(entry.name).suffix.lower() in MEDIA_SUFFIXES
+                    # A linked file has a second link in the store
+                    and entry.stat(follow_symlinks=False).st_nlink == 1
+                    and self.add(Path(entry.path)) is not None
+                ):
+                    added += 1
+        return added
+
+    def _warn_unlinkable(self, path: Path, error: OSError) -> None:
+        # Usually the same for every file (another filesystem), only warn once
+        with self._lock:
+            warned, self._warned = self._warned, True
+        (logger.debug if warned else logger.warning)(
+            "Could not link %s into the blob store at %s, it is kept as a separate "
+            "file: %s",
+            path,
+            self.root,
+            error,
+        )
+
+    def gc(self, grace_seconds: float = 3600) -> tuple[int, int]:
+        """
+        Remove the blobs no profile directory links to anymore.
+
+        Blobs orphaned in the last `grace_seconds` are kept, a monitor downloading the same
+        media again can still link to them.
+
+        Returns:
+            The number of blobs removed and the bytes freed.
+        """
+        cutoff = time.time() - grace_seconds
+        removed = freed = 0
+
+        for blob in self.root.glob("??/*"):
+            try:
+                stat = blob.stat()
+                # Dropping a link updates the ctime
+                if stat.st_nlink > 1 or stat.st_ctime > cutoff:
+                    continue
+                blob.unlink()
+            except FileNotFoundError:
+                continue
+            removed += 1
+            freed += stat.st_size
+
+        logger.info(
+            "Removed %d orphaned blobs from %s, freeing %d bytes",
+            removed,
+            self.root,
+            freed,
+        )
+        return removed, freed
+
+
+def _hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,175 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import urlparse
+
+import requests
+from instaloader.instaloader import Instaloader, _ArbitraryItemFormatter
+from instaloader.structures import StoryItem
+from requests.adapters import HTTPAdapter
+
+from src.metrics import REGISTRY
+
+from .blob_store import BlobStore
+
+logger = logging.getLogger(__name__)
+
+DOWNLOADS = REGISTRY.counter(
+    "instagram_monitor_downloads_total",
+    "Story and highlight media downloads by result (ok or error).",
+    ("result",),
+)
+DOWNLOAD_BYTES = REGISTRY.counter(
+    "instagram_monitor_download_bytes_total",
+    "Bytes of story and highlight media written.",
+)
+DOWNLOAD_SECONDS = REGISTRY.histogram(
+    "instagram_monitor_download_seconds",
+    "Seconds taken by each media download, including the wait for its host.",
+)
+
+
+class DownloadPipeline:
+    """
+    Bounded-concurrency download stage for story and highlight items, shared by all monitors.
+
+    Items are fetched by a pool of `max_workers` threads over one pooled HTTP session, with at
+    most `per_host_limit` concurrent downloads per CDN host. Files are named like
+    `Instaloader.download_storyitem` names them. Every file is hashed while it is downloaded, so
+    neither the media index nor the `blob_store` have to read it back. With a `blob_store` every
+    file is stored in it, a file already in the store is replaced by a link to it.
+    """
+
+    def __init__(
+        self,
+        instaloader: Instaloader,
+        max_workers: int = 8,
+        per_host_limit: int = 4,
+        blob_store: BlobStore | None = None,
+    ) -> None:
+        self.L = instaloader
+        self.per_host_limit = per_host_limit
+        self.blob_store = blob_store
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="download"
+        )
+        self._host_semaphores: dict[str, threading.BoundedSemaphore] = {}
+        self._host_lock = threading.Lock()
+
+        # Instaloader opens a new session for every media request, reuse connections instead
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = self.L.context.user_agent
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def download_items(
+        self, items: Iterable[tuple[StoryItem, Path]]
+    ) -> list[list[tuple[Path, str | None]]]:
+        """
+        Download every (item, target directory) pair concurrently and wait for all of them.
+
+        Returns:
+            The files written for each item with their sha256, in the order of `items`. The
+            sha256 is None for a file that was already there.
+
+        Raises:
+            The first exception raised by a download, once every download has finished.
+        """
+        futures = [
+            self._executor.submit(self.download_item, item, target)
+            for item, target in items
+        ]
+        wait(futures)
+
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+        return [future.result() for future in futures]
+
+    def download_item(
+        self, item: StoryItem, target: Path
+    ) -> list[tuple[Path, str | None]]:
+        filename = str(target / self.L.format_filename(item, target=target))
+        mtime = item.date_local
+        files = []
+
+        video_url = item.video_url if item.is_video else None
+
+        if video_url and self.L.download_videos:
+            files.append(self._download(video_url, filename, mtime))
+        # Fall back to the thumbnail when the video url is missing, like Instaloader does
+        if not video_url or self.L.download_video_thumbnails:
+            files.append(self._download(item.url, filename, mtime))
+
+        # Caption file only with --storyitem-metadata-txt, like Instaloader writes it
+        if self.L.storyitem_metadata_txt_pattern:
+            metadata_string = (
+                _ArbitraryItemFormatter(item)
+                .format(self.L.storyitem_metadata_txt_pattern)
+                .strip()
+            )
+            if metadata_string:
+                self.L.save_caption(filename, mtime, metadata_string)
+        if self.L.save_metadata:
+            self.L.save_metadata_json(filename, item)
+
+        return files
+
+    def _host_semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).netloc
+        with self._host_lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(
+                    self.per_host_limit
+                )
+            return self._host_semaphores[host]
+
+    def _download(
+        self, url: str, filename: str, mtime: datetime
+    ) -> tuple[Path, str | None]:
+        # Same extension logic as Instaloader.download_pic
+        urlmatch = re.search("\\.[a-z0-9]*\\?", url)
+        file_extension = url[-3:] if urlmatch is None else urlmatch.group(0)[1:-1]
+        path = Path(f"{filename}.{file_extension}")
+
+        if path.is_file():
+            return path, None
+
+        temp_path = path.with_name(path.name + ".part")
+        written = 0
+        # Hashed as it streams in rather than read back for the index and the blob store
+        digest = hashlib.sha256()
+        try:
+            with DOWNLOAD_SECONDS.time(), self._host_semaphore(url):
+                with self.session.get(url, stream=True, timeout=60) as response:
+                    response.raise_for_status()
+                    with open(temp_path, "wb") as file:
+                        for chunk in response.iter_content(chunk_size=64 * 1024):
+                            written += file.write(chunk)
+                            digest.update(chunk)
+        except Exception:
+            DOWNLOADS.inc(result="error")
+            temp_path.unlink(missing_ok=True)
+            raise
+        finally:
+            DOWNLOAD_BYTES.inc(written)
+        DOWNLOADS.inc(result="ok")
+
+        os.replace(temp_path, path)
+        sha256 = digest.hexdigest()
+        if self.blob_store is not None:
+            self.blob_store.add(path, sha256)
+        os.utime(path, (datetime.now().timestamp(), mtime.timestamp()))
+        return path, sha256
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self.session.close()
@@ -0,0 +1,112 @@
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+
+
+class MediaIndex:
+    """
+    Persistent mediaid -> (path, size, hash, first_seen) index of the story and highlight items
+    downloaded for one profile. The path, size and hash are the ones of the item's first file,
+    the video of a video item.
+
+    The known mediaids are loaded into a set when the index is opened, so membership checks are
+    O(1) and only items that are not in the index have to be downloaded. Changes are persisted
+    on `commit`.
+    """
+
+    def __init__(self, db_file: Path) -> None:
+        self.db_file = db_file
+        self._lock = threading.RLock()
+
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS media (
+                mediaid INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                first_seen TEXT NOT NULL
+            )
+            """
+        )
+        # Item counts of the highlights, an unchanged count doesn't mean unchanged items
+        self.conn.execute("DROP TABLE IF EXISTS highlights")
+        self.conn.commit()
+
+        self._load()
+
+    def _load(self) -> None:
+        with self._lock:
+            self._mediaids = {
+                row[0] for row in self.conn.execute("SELECT mediaid FROM media")
+            }
+
+    def __contains__(self, mediaid: int) -> bool:
+        return mediaid in self._mediaids
+
+    def __len__(self) -> int:
+        return len(self._mediaids)
+
+    def get(self, mediaid: int) -> dict | None:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT path, size, sha256, first_seen FROM media WHERE mediaid = ?",
+                (mediaid,),
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("path", "size", "sha256", "first_seen"), row))
+
+    def add(
+        self,
+        mediaid: int,
+        kind: str,
+        files: list[tuple[Path, str | None]],
+        first_seen: str,
+    ) -> None:
+        """
+        Index a downloaded item, `files` are the media files written for it with their sha256,
+        None when it wasn't computed while downloading.
+        """
+        path, sha256 = files[0] if files else (None, None)
+        size = path.stat().st_size if path is not None else 0
+        if sha256 is None:
+            # Only read back files that were already there
+            digest = hashlib.sha256()
+            if path is not None:
+                with open(path, "rb") as media:
+                    while chunk := media.read(1024 * 1024):
+                        digest.update(chunk)
+            sha256 = digest.hexdigest()
+
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO media (mediaid, kind, path, size, sha256, first_seen) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    mediaid,
+                    kind,
+                    str(path) if path is not None else "",
+                    size,
+                    sha256,
+                    first_seen,
+                ),
+            )
+            self._mediaids.add(mediaid)
+
+    def commit(self) -> None:
+        with self._lock:
+            self.conn.commit()
+
+    def rollback(self) -> None:
+        with self._lock:
+            self.conn.rollback()
+            # Drop what was added in memory during the failed run
+            self._load()
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
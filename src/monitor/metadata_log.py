@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections.abc import Iterator
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+METADATA_CATEGORIES = ("highlights", "stories")
+
+
+class MetadataLog:
+    """
+    Append-only log of the highlight and story metadata records of a profile.
+
+    Each record is one JSON line in `metadata.jsonl`. Its category, timestamp, id and byte range
+    are kept in an SQLite index, so records can be read by category and time range without
+    parsing the rest of the log. Records appended during a run are written on `commit`. The
+    nested `metadata.json` layout is only produced on demand by `export`.
+    """
+
+    def __init__(self, log_file: Path, index_file: Path) -> None:
+        self.log_file = log_file
+        self.index_file = index_file
+        self._lock = threading.RLock()
+        self._pending: list[tuple[str, str, dict]] = []
+
+        self.conn = sqlite3.connect(index_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS records (
+                category TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                record_id TEXT,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS records_by_category ON records (category, timestamp)"
+        )
+        self.conn.commit()
+
+    @classmethod
+    def for_data_dir(cls, data_dir: Path) -> "MetadataLog":
+        return cls(data_dir / "metadata.jsonl", data_dir / "metadata_index.db")
+
+    def append(self, category: str, timestamp: str, record: dict) -> None:
+        with self._lock:
+            self._pending.append((category, timestamp, record))
+
+    def commit(self) -> None:
+        with self._lock:
+            if not self._pending:
+                return
+
+            rows = []
+            with open(self.log_file, "ab") as log:
+                offset = log.tell()
+                for category, timestamp, record in self._pending:
+                    line = (
+                        json.dumps(
+                            {"category": category, "timestamp": timestamp, **record}
+                        )
+                        + "\n"
+                    ).encode()
+                    log.write(line)
+                    rows.append(
+                        (category, timestamp, _record_id(record), offset, len(line))
+                    )
+                    offset += len(line)
+                log.flush()
+                os.fsync(log.fileno())
+
+            # A crash before this point leaves unindexed bytes at the end of the log,
+            # they are never read and are dropped by `compact`
+            self.conn.executemany(
+                "INSERT INTO records (category, timestamp, record_id, offset, length) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.conn.commit()
+            self._pending.clear()
+
+    def rollback(self) -> None:
+        with self._lock:
+            self._pending.clear()
+
+    def records(
+        self, category: str, start: str | None = None, end: str | None = None
+    ) -> Iterator[dict]:
+        """Yield the records of `category` with start <= timestamp <= end, oldest first."""
+        query = "SELECT offset, length FROM records WHERE category = ?"
+        params: list = [category]
+        if start is not None:
+            query += " AND timestamp >= ?"
+            params.append(start)
+        if end is not None:
+            query += " AND timestamp <= ?"
+            params.append(end)
+        query += " ORDER BY timestamp, offset"
+
+        with self._lock:
+            ranges = self.conn.execute(query, params).fetchall()
+
+        with open(self.log_file, "rb") as log:
+            for offset, length in ranges:
+                log.seek(offset)
+                yield json.loads(log.read(length))
+
+    def export(self, destination: Path) -> None:
+        """Write the records as the nested {category: {timestamp: {id: record}}} document."""
+        metadata: dict[str, dict] = {category: {} for category in METADATA_CATEGORIES}
+        if self.log_file.exists():
+            for category in METADATA_CATEGORIES:
+                for record in self.records(category):
+                    record.pop("category")
+                    entries = metadata[category].setdefault(record.pop("timestamp"), {})
+                    entries[_record_id(record) or str(len(entries))] = record
+
+        temp_file = destination.with_suffix(".tmp")
+        with open(temp_file, "w", encoding="utf-8") as file:
+            json.dump(metadata, file, indent=4)
+        os.replace(temp_file, destination)
+
+    def compact(self) -> None:
+        """Rewrite the log keeping only indexed records, dropping bytes left by crashed runs."""
+        with self._lock:
+            if not self.log_file.exists():
+                return
+
+            temp_file = self.log_file.with_suffix(".tmp")
+            rows = self.conn.execute(
+                "SELECT rowid, offset, length FROM records ORDER BY offset"
+            ).fetchall()
+
+            new_offsets = []
+            with open(self.log_file, "rb") as log, open(temp_file, "wb") as new_log:
+                for rowid, offset, length in rows:
+                    log.seek(offset)
+                    new_offsets.append((new_log.tell(), rowid))
+                    new_log.write(log.read(length))
+
+            self.conn.executemany(
+                "UPDATE records SET offset = ? WHERE rowid = ?", new_offsets
+            )
+            os.replace(temp_file, self.log_file)
+            self.conn.commit()
+
+    def import_legacy_file(self, metadata_file: Path) -> None:
+        """Import an old nested metadata.json, only done while the log is still empty."""
+        with self._lock:
+            if not metadata_file.exists() or self.conn.execute(
+                "SELECT 1 FROM records LIMIT 1"
+            ).fetchone():
+                return
+
+            try:
+                with open(metadata_file, "r", encoding="utf-8") as file:
+                    metadata = json.load(file)
+            except json.JSONDecodeError as exc:
+                logger.error(
+                    "Could not import the legacy metadata file %s: %s", metadata_file, exc
+                )
+                return
+
+            logger.info("Importing legacy metadata from %s", metadata_file)
+            for category in METADATA_CATEGORIES:
+                for timestamp, record in metadata.get(category, {}).items():
+                    self.append(category, timestamp, record)
+            self.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+
+def _record_id(record: dict) -> str | None:
+    return str(record["id"]) if "id" in record else None
@@ -1,16 +1,57 @@
 import json
 import logging
+import contextvars
 import os
-import shutil
-import tempfile
-from datetime import datetime
+import threading
+import time
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 from instaloader.instaloader import Instaloader
-from instaloader.structures import Highlight, Profile, Story
+from instaloader.lateststamps import LatestStamps
+from instaloader.structures import Highlight, Profile, Story, StoryItem
+
+from src.metrics import REGISTRY
+
+from .adaptive import PHASES, AdaptiveIntervals
+from .download_pipeline import DownloadPipeline
+from .media_index import MediaIndex
+from .metadata_log import MetadataLog
+from .profile_cache import ProfileCache
+from .relationship_diff import RENAME, ChangeRecord, diff_relationships
+from .resumable import ResumableEnumeration
+from .snapshot_store import SnapshotStore, open_snapshot_store
+from .user_set import UserSet, UsernameTable
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+PHASE_SECONDS = REGISTRY.histogram(
+    "instagram_monitor_phase_seconds",
+    "Seconds spent in each phase of the monitor runs, including failed ones.",
+    ("phase",),
+)
+
+
+def profile_data_dir(profile_username: str) -> Path:
+    return Path("output", f"{profile_username}_data")
+
+
+def _timed(phase: str, func: Callable[[], bool]) -> Callable[[], bool]:
+    def run() -> bool:
+        with PHASE_SECONDS.time(phase=phase):
+            return func()
+
+    return run
+
+
+def _url_basename(url: str) -> str:
+    # Profile pic urls are signed, the query changes on every request but the file name only
+    # changes with the picture, like Instaloader.download_profilepic_if_new compares them
+    return url.split("/")[-1].split("?")[0]
 
 
-# TODO: use latest stamps and setup the scheduling for the timing of the runs
 class InstagramMonitor:
     # Declare class attributes with optional types
     data_dir: Path
@@ -18,34 +59,48 @@ class InstagramMonitor:
     stories_dir: Path
     profile_dir: Path
     data_file: Path
-    highlights_file: Path
-    stories_file: Path
+    media_index_file: Path
+    stamps_file: Path
+    profile_id_file: Path
     metadata_file: Path
 
-    def __init__(self, profile_username: str, insta_loader: Instaloader, args) -> None:
+    def __init__(
+        self,
+        profile_username: str,
+        insta_loader: Instaloader,
+        args,
+        download_pipeline: DownloadPipeline | None = None,
+        profile_cache: ProfileCache | None = None,
+        interval_minutes: float = 60,
+    ) -> None:
         self.profile_username = profile_username
 
-        self.profile_id_file = f"{profile_username}_profile_id.json"
-
         # Define base directory using profile_username
-        self.data_dir = Path("output", f"{profile_username}_data")
+        self.data_dir = profile_data_dir(profile_username)
 
         # Set up directory and file variables, creating if needed
         self.setup_dirs()
 
-        # Setup metadata file
+        # Setup the metadata log, metadata.json is only written when exporting
         self.metadata_file = self.data_dir / "metadata.json"
-        self.setup_metadata_file()
-
-        self.data_file_mapping = {
-            "data": self.data_file,
-            "downloaded_highlights": self.highlights_file,
-            "downloaded_stories": self.stories_file,
-        }
-
-        self.downloaded_highlights_list: list = []
-        self.downloaded_stories_list: list = []
-        self.data = {}
+        self.metadata_log = MetadataLog.for_data_dir(self.data_dir)
+        self.metadata_log.import_legacy_file(self.metadata_file)
+
+        # Index of the downloaded story and highlight items, so they are never refetched
+        self.media_index = MediaIndex(self.media_index_file)
+
+        # Posts, tagged posts, profile pic and stories older than their stamp are not refetched,
+        # highlight items are covered by the media index
+        self.stamps = LatestStamps(str(self.stamps_file))
+        self._story_stamp: datetime | None = None
+
+        # Profile snapshots are appended to the store and committed once per run
+        self.snapshot_store: SnapshotStore = open_snapshot_store(
+            args.snapshot_store,
+            self.data_dir,
+            history_mode=args.history_mode,
+            base_interval=args.base_interval,
+        )
 
         # Setup logging
         logging.basicConfig(
@@ -56,8 +111,41 @@ class InstagramMonitor:
         # initialize Instaloader
         self.L = insta_loader
 
+        # Story and highlight items are downloaded concurrently by the shared pipeline
+        self.download_pipeline = download_pipeline or DownloadPipeline(insta_loader)
+
+        # The profile is resolved once per run and shared by every phase
+        self.profile_cache = profile_cache or ProfileCache()
+
         self.download_highlights: bool = args.download_highlights
         self.download_stories: bool = args.download_stories
+        # Stories are fetched for every profile at once by the StoryPoller instead
+        self.batch_stories: bool = args.batch_stories
+
+        # Skip follower enumeration when the cheap profile metadata didn't change
+        self.fast_path: bool = args.fast_path
+        self.full_audit_interval = timedelta(hours=args.full_audit_hours)
+
+        # Each phase runs on its own interval learned from how often it finds changes,
+        # otherwise every phase runs on every run
+        self.phases = {"followers", "posts"}
+        if self.download_highlights:
+            self.phases.add("highlights")
+        if self.download_stories and not self.batch_stories:
+            self.phases.add("stories")
+        self.adaptive: AdaptiveIntervals | None = None
+        # Run the phases of a run at the same time instead of one after the other
+        self.concurrent_phases: bool = args.concurrent_phases
+        if args.adaptive:
+            self.adaptive = AdaptiveIntervals(
+                self.data_dir / "adaptive.json",
+                min_seconds=interval_minutes * 60,
+                max_seconds=args.adaptive_max_hours * 60 * 60,
+                phases=[phase for phase in PHASES if phase in self.phases],
+            )
+
+        # A run and a batch of polled stories never write to the stores at the same time
+        self._run_lock = threading.Lock()
 
     def setup_dirs(self):
         # Define directory and file paths
@@ -66,12 +154,9 @@ class InstagramMonitor:
             "stories_dir": self.data_dir / "stories",
             "profile_dir": self.data_dir / "profile",
             "data_file": self.data_dir / "data.json",
-            "highlights_file": self.data_dir.joinpath(
-                "highlights", "downloaded_highlights.json"
-            ),
-            "stories_file": self.data_dir.joinpath(
-                "stories", "downloaded_stories.json"
-            ),
+            "media_index_file": self.data_dir / "media_index.db",
+            "stamps_file": self.data_dir / "latest_stamps.ini",
+            "profile_id_file": self.data_dir / "profile_id.json",
         }
 
         # Create attributes using setattr
@@ -81,88 +166,81 @@ class InstagramMonitor:
             if attr_name.endswith("_dir"):
                 path.mkdir(parents=True, exist_ok=True)
 
-    def setup_metadata_file(self):
-        # Setup the metadata file with the top level keys for the different types
-        if not self.metadata_file.exists():
-            initial_metadata = {
-                "highlights": {},
-                "stories": {},
-            }
-
-            with open(self.metadata_file, "w", encoding="utf-8") as file:
-                json.dump(initial_metadata, file, indent=4)
-
     def setup(self):
         os.makedirs(self.data_dir, exist_ok=True)
-        self.load_data()
 
-    def load_data(self):
-        for data_key, filename in self.data_file_mapping.items():
-            self.__dict__[data_key] = self.load_json(filename)
+    def commit(self):
+        self.snapshot_store.commit()
+        self.media_index.commit()
+        self.metadata_log.commit()
 
-    def save_data(self):
-        for data_key, filename in self.data_file_mapping.items():
-            self.save_json(filename, self.__dict__[data_key])
+        # Only move the story stamp once the items it covers are indexed
+        if self._story_stamp is not None:
+            self.stamps.set_last_story_timestamp(
+                self.profile_username, self._story_stamp
+            )
+            self._story_stamp = None
 
-    def load_json(self, filename):
-        if os.path.exists(filename):
-            with open(filename, "r", encoding="utf-8") as file:
-                return json.load(file)
-        return {}
+    def rollback(self):
+        self.snapshot_store.rollback()
+        self.media_index.rollback()
+        self.metadata_log.rollback()
+        self._story_stamp = None
 
-    def save_json(self, filename, json_data):
-        with open(filename, "w", encoding="utf-8") as file:
-            json.dump(json_data, file, indent=4)
+    def close(self):
+        self.snapshot_store.close()
+        self.media_index.close()
+        self.metadata_log.close()
 
     def update_metadata_file(self, category_key: str, new_metadata, timestamp: str):
-        """Update global metadata file with timestamped entry for a category key (highlights, stories)"""
-
-        try:
-            with open(self.metadata_file, "r+", encoding="utf-8") as file:
-                metadata = json.load(file)
-
-                if timestamp not in metadata[category_key]:
-                    metadata[category_key][timestamp] = {}
-                metadata[category_key][timestamp].update(new_metadata)
-                file.seek(0)
-                json.dump(metadata, file, indent=4)
-        except json.JSONDecodeError as exc:
-            logging.error(
-                "Error occured while updating the metadata for %s in the file %s, Error: %s",
-                category_key,
-                self.metadata_file,
-                exc,
-                exc_info=True,
-            )
+        """Record a timestamped entry for a category key (highlights, stories) in the metadata log"""
+        self.metadata_log.append(category_key, timestamp, new_metadata)
 
-    def compare_and_log_changes(self, old_list, new_list, list_name):
-        new_list_set = set(new_list)
-        old_list_set = set(old_list)
-        
-        added = new_list_set- old_list_set
-        removed = old_list_set - new_list_set
-        if added:
-            self.logger.info("New %s: %s", list_name, added)
-        if removed:
-            self.logger.info("Removed %s: %s", list_name, removed)
+    def log_changes(self, changes: list[ChangeRecord]):
+        for record in changes:
+            if record.change == RENAME:
+                self.logger.info(
+                    "%s: %s renamed to %s (userid %d)",
+                    self.profile_username,
+                    record.previous_username,
+                    record.username,
+                    record.userid,
+                )
+            else:
+                self.logger.info(
+                    "%s: %s %s (userid %d)",
+                    self.profile_username,
+                    record.change,
+                    record.username,
+                    record.userid,
+                )
 
     def download_new_highlights(self, target_profile: Profile, timestamp: str):
         new_downloads = []
-        downloaded_ids = set(self.downloaded_highlights_list)
 
         for highlight in self.L.get_highlights(target_profile.userid):
-            if highlight.unique_id not in downloaded_ids:
+            # Compare the items themselves, an item removed and another added leaves the
+            # count unchanged. Instaloader fetches the items for the count anyway
+            new_items = [
+                item
+                for item in highlight.get_items()
+                if item.mediaid not in self.media_index
+            ]
+            if new_items:
                 self.logger.info(
-                    "Downloading new highlight: %s with %d highlight members",
+                    "Downloading %d new items of highlight %s (%d highlight members)",
+                    len(new_items),
                     highlight.title,
                     highlight.itemcount,
                 )
-                self.download_highlights_with_metadata(highlight, timestamp)
-                new_downloads.append(highlight.unique_id)
+                self.download_highlights_with_metadata(highlight, new_items, timestamp)
+                new_downloads.extend(item.mediaid for item in new_items)
 
         return new_downloads
 
-    def download_highlights_with_metadata(self, highlight: Highlight, timestamp: str):
+    def download_highlights_with_metadata(
+        self, highlight: Highlight, items: list[StoryItem], timestamp: str
+    ):
         # Save metadata for the whole highlight
         highlights_metadata = {
             "id": highlight.unique_id,
@@ -176,10 +254,7 @@ class InstagramMonitor:
         }
 
         # get metadata for each highlight in the highlights
-        for item in highlight.get_items():
-            # Download the items within the highlight
-            self.L.download_storyitem(item, target=self.highlights_dir)
-
+        for item in items:
             item_metadata = {
                 "media_id": item.mediaid,
                 "url": item.url,
@@ -191,22 +266,55 @@ class InstagramMonitor:
             }
             highlights_metadata["stories"].append(item_metadata)
 
+        # Only record the highlight once all of its items landed
+        self.download_and_index(items, self.highlights_dir, "highlight", timestamp)
         self.update_metadata_file("highlights", highlights_metadata, timestamp)
 
+    def download_and_index(
+        self, items: list[StoryItem], target: Path, kind: str, timestamp: str
+    ):
+        downloaded_files = self.download_pipeline.download_items(
+            (item, target) for item in items
+        )
+        for item, files in zip(items, downloaded_files):
+            self.media_index.add(item.mediaid, kind, files, timestamp)
+
     def download_new_stories(self, target_profile: Profile, timestamp: str):
+        return self.download_new_story_items(
+            self.L.get_stories([target_profile.userid]), timestamp
+        )
+
+    def download_new_story_items(self, stories: Iterable[Story], timestamp: str):
         new_downloads = []
-        downloaded_ids = set(self.downloaded_stories_list)
+        last_story = self.stamps.get_last_story_timestamp(self.profile_username)
 
         # story is a Story object
-        for story in self.L.get_stories([target_profile.userid]):
+        for story in stories:
+            new_items = [
+                item
+                for item in story.get_items()
+                if item.date_local > last_story and item.mediaid not in self.media_index
+            ]
+            if not new_items:
+                continue
+
             self.logger.info(
-                "Downloading new story with the last created story at: %s",
+                "Downloading %d new story items with the last created story at: %s",
+                len(new_items),
                 story.latest_media_utc,
             )
-            self.download_stories_with_metadata(story, timestamp)
+            self.download_stories_with_metadata(story, new_items, timestamp)
+            new_downloads.extend(item.mediaid for item in new_items)
+
+            newest = max(item.date_local for item in new_items)
+            if self._story_stamp is None or newest > self._story_stamp:
+                self._story_stamp = newest
+
         return new_downloads
 
-    def download_stories_with_metadata(self, story: Story, timestamp: str):
+    def download_stories_with_metadata(
+        self, story: Story, items: list[StoryItem], timestamp: str
+    ):
         stories_metadata = {
             "id": story.unique_id,
             "last_seen": (
@@ -219,8 +327,7 @@ class InstagramMonitor:
             "stories": [],
         }
 
-        for story_item in story.get_items():
-            self.L.download_storyitem(story_item, target=self.stories_dir)
+        for story_item in items:
 
             story_item_metadata = {
                 "media_id": story_item.mediaid,
@@ -234,172 +341,356 @@ class InstagramMonitor:
             }
             stories_metadata["stories"].append(story_item_metadata)
 
+        self.download_and_index(items, self.stories_dir, "story", timestamp)
         self.update_metadata_file("stories", stories_metadata, timestamp)
 
-    # TODO: This isn't working the 'profile' dir is still downloaded in root directory, look into source code to figure out why
-    # in the meantime just shutil after download as a work-around
-    def download_profile_and_move(self, target_profile: Profile):
+    def download_new_posts(self, target_profile: Profile) -> bool:
         """
-        Downloads an Instagram profile, stores it in a temporary directory, and moves it to the output directory with
-        the rest of the username's data. This is a hack around the 'download_profiles' function not providing a way to
-        specify where to download, and thus downloading in the projects root directory.
+        Download the posts and tagged posts newer than their stamps straight into `profile_dir`,
+        stopping at the first post that was already seen.
 
-        Args:
-            target_profile (Profile): The Profile object representing the Instagram profile to download.
+        Returns:
+            Whether there were new posts or tagged posts.
         """
-        profile: set[Profile] = {target_profile}
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_dir_path = Path(temp_dir)
-            # Download profile in temporary directory
-            logging.info(
-                "Downloading the profile to the temporary directory: %s", temp_dir
-            )
-            self.L.download_profiles(
-                profiles=profile,
-                tagged=True,
+        # A Path target is used as the directory as-is instead of being sanitized into a name
+        last_post = self.stamps.get_last_post_timestamp(self.profile_username)
+        last_tagged = self.stamps.get_last_tagged_timestamp(self.profile_username)
+        posts = target_profile.get_posts()
+        self.L.posts_download_loop(
+            posts,
+            self.profile_dir,
+            total_count=target_profile.mediacount,
+            owner_profile=target_profile,
+            takewhile=lambda post: post.date_local > last_post,
+            # Pinned posts come first regardless of their date
+            possibly_pinned=3,
+        )
+        if posts.first_item is not None:
+            # An old pinned post must not move the stamp backwards
+            self.stamps.set_last_post_timestamp(
+                self.profile_username, max(posts.first_item.date_local, last_post)
             )
 
-            # Move files from temp_dir to self.profile_dir
-            for _, _, files in os.walk(temp_dir):
-                for filename in files:
-                    source_file = temp_dir_path / filename
-                    destination_file = self.profile_dir / filename
-                    shutil.move(source_file, destination_file)
+        # Not Instaloader.download_tagged, it keeps the stamp under the profile's current
+        # username instead of the configured one
+        tagged_posts = target_profile.get_tagged_posts()
+        self.L.posts_download_loop(
+            tagged_posts,
+            self.profile_dir / "tagged",
+            takewhile=lambda post: post.date_local > last_tagged,
+        )
+        if tagged_posts.first_item is not None:
+            self.stamps.set_last_tagged_timestamp(
+                self.profile_username,
+                max(tagged_posts.first_item.date_local, last_tagged),
+            )
 
-    def fetch_or_save_profile_id(self, return_id=False):
-        # If return_id is false (default) save to file
-        # If return_id is true return the id and don't save to file
+        new_posts = self.stamps.get_last_post_timestamp(self.profile_username)
+        new_tagged = self.stamps.get_last_tagged_timestamp(self.profile_username)
+        return new_posts > last_post or new_tagged > last_tagged
 
-        # Fetch profile ID from Instagram
-        target_profile = Profile.from_username(self.L.context, self.profile_username)
-        profile_id = target_profile.userid
+    def download_new_posts_and_profile_pic(self, target_profile: Profile) -> bool:
+        new_profile_pic = self.download_profile_pic_if_new(target_profile)
+        new_posts = self.download_new_posts(target_profile)
 
-        # Return ID if requested
-        if return_id:
-            return profile_id
+        blob_store = self.download_pipeline.blob_store
+        if blob_store is not None and (new_posts or new_profile_pic):
+            # Instaloader writes these itself, they are stored once they landed
+            for directory in (self.profile_dir, self.profile_dir / "tagged"):
+                blob_store.add_directory(directory)
 
-        # Save the profile ID otherwise
-        with open(self.profile_id_file, "w", encoding="utf-8") as file:
-            json.dump({"profile_id": profile_id}, file, indent=4)
+        return new_posts or new_profile_pic
 
-    def check_and_update_profile_id(self):
-        try:
-            # Check if the profile ID file exists
-            if not os.path.exists(self.profile_id_file):
-                self.logger.info(
-                    "Profile ID file not found. Fetching from Instagram..."
-                )
-                self.fetch_or_save_profile_id()
+    def download_profile_pic_if_new(self, target_profile: Profile) -> bool:
+        basename = _url_basename(target_profile.profile_pic_url_no_iphone)
+        if self.stamps.get_profile_pic(self.profile_username) == basename:
+            return False
 
-            # Load profile id from fille
-            with open(self.profile_id_file, "r", encoding="utf-8") as file:
-                stored_profile_id = json.load(file)["profile_id"]
+        now = datetime.now(timezone.utc)
+        self.L.download_pic(
+            str(self.profile_dir / f"{now:%Y-%m-%d_%H-%M-%S}_UTC_profile_pic"),
+            target_profile.profile_pic_url,
+            now,
+        )
+        self.stamps.set_profile_pic(self.profile_username, basename)
+        return True
 
-            # Fetch the current profile ID from Instagram
-            current_profile_id = self.fetch_or_save_profile_id(return_id=True)
+    def load_profile_id(self) -> int | None:
+        # Profile id files used to be written to the working directory
+        legacy_file = Path(f"{self.profile_username}_profile_id.json")
+        if not self.profile_id_file.exists() and legacy_file.exists():
+            legacy_file.replace(self.profile_id_file)
 
-            # Compare and update if neccessary
-            if stored_profile_id != current_profile_id:
-                self.logger.info("Profile ID has changed. Updating profile ID file...")
-                self.fetch_or_save_profile_id()
+        if not self.profile_id_file.exists():
+            return None
+        with open(self.profile_id_file, "r", encoding="utf-8") as file:
+            return json.load(file)["profile_id"]
 
-            self.logger.info("Profile ID is up-to-date")
-        except Exception as exc:
-            # TODO: more precise in the future
-            self.logger.error(
-                "Error checking or updating profile ID %s", exc, exc_info=True
-            )
-            raise
+    def save_profile_id(self, profile_id: int):
+        with open(self.profile_id_file, "w", encoding="utf-8") as file:
+            json.dump({"profile_id": profile_id}, file, indent=4)
 
-    def _get_following_not_following_back(
-        self, followers: list[tuple[int, str]], following: list[tuple[int, str]]
-    ):
+    def resolve_profile(self) -> Profile:
+        """
+        Fetch the monitored profile through the shared cache, by userid if the username
+        doesn't resolve anymore, and keep the stored profile id up to date.
         """
-        This function finds usernames in following but not in followers.
+        stored_profile_id = self.load_profile_id()
+        profile = self.profile_cache.get(
+            self.L.context, self.profile_username, stored_profile_id
+        )
 
-        Args:
-            current_followers: A list of tuples containing (user_id, username) for followers.
-            current_following: A list of tuples containing (user_id, username) for following.
+        if stored_profile_id is None:
+            self.logger.info("Saving profile ID of %s", self.profile_username)
+            self.save_profile_id(profile.userid)
+        elif stored_profile_id != profile.userid:
+            self.logger.info("Profile ID has changed. Updating profile ID file...")
+            self.save_profile_id(profile.userid)
+
+        if profile.username.lower() != self.profile_username.lower():
+            self.logger.warning(
+                "%s has been renamed to %s, still storing its data under %s",
+                self.profile_username,
+                profile.username,
+                self.data_dir,
+            )
+        return profile
+
+    def enumeration(self, name: str) -> ResumableEnumeration:
+        # Checkpoints survive crashes and rate limits so the next run resumes from the last page
+        return ResumableEnumeration(self.data_dir / "enumeration", name)
+
+    def _plan_enumeration(
+        self,
+        profile_info: dict,
+        previous_timestamp: str | None,
+        previous_snapshot: dict,
+        timestamp: str,
+    ) -> tuple[bool, bool]:
+        """
+        Decide whether the followers and the following lists have to be enumerated this run.
 
         Returns:
-            A list of usernames that are in following but not in followers.
+            A (enumerate_followers, enumerate_following) tuple.
         """
-        # Extract usernames from both lists
-        follower_usernames = [username for _, username in followers]
-        following_usernames = [username for _, username in following]
+        if (
+            not self.fast_path
+            or previous_timestamp is None
+            or "followers" not in previous_snapshot
+            or "following" not in previous_snapshot
+        ):
+            return True, True
+
+        # Periodic full audit catches followers swapped without the count moving
+        audited_at = datetime.strptime(
+            previous_snapshot.get("audited_at", previous_timestamp), TIMESTAMP_FORMAT
+        )
+        since_audit = datetime.strptime(timestamp, TIMESTAMP_FORMAT) - audited_at
+        if since_audit >= self.full_audit_interval:
+            self.logger.info(
+                "Running full follower audit for %s", self.profile_username
+            )
+            return True, True
 
-        # Find usernames not in followers but in following
-        usernames_not_following_back = [
-            username
-            for username in following_usernames
-            if username not in follower_usernames
-        ]
+        if profile_info["bio"] != previous_snapshot.get("bio") or _url_basename(
+            profile_info["profile_pic_url"]
+        ) != _url_basename(previous_snapshot.get("profile_pic_url", "")):
+            return True, True
 
-        return usernames_not_following_back
+        return (
+            profile_info["followers_count"] != previous_snapshot.get("followers_count"),
+            profile_info["following_count"] != previous_snapshot.get("following_count"),
+        )
 
     def update_profile_info(self, profile: Profile, timestamp: str):
         # Fetch information about the profile
-        current_followers_count = profile.followers
-        current_following_count = profile.followees
-        biography = profile.biography
-        profile_pic_url = profile.profile_pic_url
-
-        current_followers = [
-            (follower.userid, follower.username) for follower in profile.get_followers()
-        ]
-        current_following = [
-            (followee.userid, followee.username) for followee in profile.get_followees()
-        ]
-
-        not_following_back = self._get_following_not_following_back(
-            current_followers, current_following
-        )
-
-        # Save the data dictionary under the timestamp key
-        self.data[timestamp] = {
-            "followers_count": current_followers_count,
-            "following_count": current_following_count,
-            "bio": biography,
-            "profile_pic_url": profile_pic_url,
-            "followers": current_followers,
-            "following": current_following,
-            "not_following_back": not_following_back,
+        profile_info = {
+            "followers_count": profile.followers,
+            "following_count": profile.followees,
+            "bio": profile.biography,
+            "profile_pic_url": profile.profile_pic_url,
         }
 
-        # Save updated data
-        self.save_data()
+        previous = self.snapshot_store.latest()
+        previous_timestamp, previous_snapshot = previous if previous else (None, {})
 
-    def run_monitor(self):
-        try:
-            self.setup()
-            target_profile = Profile.from_username(
-                self.L.context, self.profile_username
+        previous_followers = previous_following = None
+        if "followers" in previous_snapshot and "following" in previous_snapshot:
+            previous_usernames = UsernameTable()
+            previous_followers = UserSet.from_users(
+                previous_snapshot["followers"], previous_usernames
+            )
+            previous_following = UserSet.from_users(
+                previous_snapshot["following"], previous_usernames
             )
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-            # Download new highlights
-            if self.download_highlights:
-                new_downloaded_highlights = self.download_new_highlights(
-                    target_profile, timestamp
+        enumerate_followers, enumerate_following = self._plan_enumeration(
+            profile_info, previous_timestamp, previous_snapshot, timestamp
+        )
+        if not (enumerate_followers and enumerate_following):
+            self.logger.info(
+                "Fast path for %s, enumerating followers: %s, following: %s",
+                self.profile_username,
+                enumerate_followers,
+                enumerate_following,
+            )
+
+        # Both lists share one username table so mutual accounts are only stored once,
+        # lists that are not enumerated are carried over from the previous snapshot
+        usernames = UsernameTable()
+        current_followers = UserSet.from_users(
+            (
+                self.enumeration("followers").iterate(profile.get_followers())
+                if enumerate_followers
+                else previous_followers
+            ),
+            usernames,
+        )
+        current_following = UserSet.from_users(
+            (
+                self.enumeration("following").iterate(profile.get_followees())
+                if enumerate_following
+                else previous_following
+            ),
+            usernames,
+        )
+
+        # Diff against the previous snapshot, keyed on userid
+        relationship_diff = diff_relationships(
+            timestamp,
+            current_followers,
+            current_following,
+            previous_followers,
+            previous_following,
+        )
+        self.log_changes(relationship_diff.changes)
+
+        # Append the snapshot under the timestamp key, it is committed at the end of the run
+        self.snapshot_store.append(
+            timestamp,
+            {
+                **profile_info,
+                "followers": current_followers,
+                "following": current_following,
+                "not_following_back": [
+                    username for _, username in relationship_diff.not_following_back
+                ],
+                "audited_at": (
+                    timestamp
+                    if enumerate_followers and enumerate_following
+                    else previous_snapshot.get("audited_at", previous_timestamp)
+                ),
+            },
+        )
+        self.snapshot_store.append_changes(relationship_diff.changes)
+
+        return relationship_diff
+
+    def save_polled_stories(self, stories: Iterable[Story], timestamp: str):
+        """Download and commit the new items of stories fetched by the `StoryPoller`."""
+        with self._run_lock:
+            try:
+                new_downloads = self.download_new_story_items(stories, timestamp)
+                self.commit()
+            except Exception as e:
+                self.rollback()
+                self.logger.error(
+                    "Error saving stories of %s: %s", self.profile_username, e
                 )
+                raise
+        return new_downloads
 
-                self.downloaded_highlights_list.extend(new_downloaded_highlights)
-                self.save_data()
+    def run_phases(self, phases: dict[str, Callable[[], bool]]) -> dict[str, bool]:
+        """
+        Run the phases of a run, one after the other or all at once with concurrent phases.
+
+        Concurrent phases share the already resolved profile and the run's pending store
+        changes, their requests still go through the same rate controller. Every phase is
+        waited for before the first exception is raised, so nothing is left running when the
+        run is rolled back.
+        """
+        phases = {phase: _timed(phase, func) for phase, func in phases.items()}
+        if not self.concurrent_phases or len(phases) < 2:
+            return {phase: func() for phase, func in phases.items()}
+
+        with ThreadPoolExecutor(
+            max_workers=len(phases),
+            thread_name_prefix=f"{self.profile_username}-phase",
+        ) as executor:
+            # Copy the context so requests are still accounted to this monitor
+            futures = {
+                phase: executor.submit(contextvars.copy_context().run, func)
+                for phase, func in phases.items()
+            }
+            wait(futures.values())
+
+        for phase, future in futures.items():
+            if future.exception() is not None:
+                self.logger.error("Phase %s of %s failed", phase, self.profile_username)
+                raise future.exception()
+        return {phase: future.result() for phase, future in futures.items()}
+
+    def run_monitor(self):
+        with self._run_lock:
+            self._run_monitor()
 
-            # Download new stories
-            if self.download_stories:
-                new_downloaded_stories = self.download_new_stories(
-                    target_profile, timestamp
+    def _run_monitor(self):
+        try:
+            self.setup()
+            with PHASE_SECONDS.time(phase="profile"):
+                target_profile = self.resolve_profile()
+            ran_at = time.time()
+            timestamp = datetime.fromtimestamp(ran_at).strftime(TIMESTAMP_FORMAT)
+
+            phases = self.phases
+            if self.adaptive is not None:
+                phases = self.adaptive.due_phases(ran_at)
+                self.logger.info(
+                    "Running %s for %s",
+                    ", ".join(sorted(phases)),
+                    self.profile_username,
                 )
-                self.downloaded_stories_list.extend(new_downloaded_stories)
-                self.save_data()
+            # Each phase returns whether it found anything new, in the order they run
+            # sequentially
+            phase_funcs = {
+                # Download new highlights
+                "highlights": lambda: bool(
+                    self.download_new_highlights(target_profile, timestamp)
+                ),
+                # Download new stories
+                "stories": lambda: bool(
+                    self.download_new_stories(target_profile, timestamp)
+                ),
+                # Update profile information
+                "followers": lambda: bool(
+                    self.update_profile_info(target_profile, timestamp).changes
+                ),
+                # Download new posts and the profile picture if it changed
+                "posts": lambda: self.download_new_posts_and_profile_pic(
+                    target_profile
+                ),
+            }
+            changed = self.run_phases(
+                {
+                    phase: func
+                    for phase, func in phase_funcs.items()
+                    if phase in phases
+                }
+            )
 
-            # Update profile information
-            self.update_profile_info(target_profile, timestamp)
+            # Persist everything gathered during this run in one go
+            with PHASE_SECONDS.time(phase="commit"):
+                self.commit()
 
-            # Download profile
-            self.download_profile_and_move(target_profile)
+            if self.adaptive is not None:
+                for phase, phase_changed in changed.items():
+                    self.adaptive.record(phase, phase_changed, ran_at)
+                self.adaptive.save()
 
         except Exception as e:
+            self.rollback()
+            if self.adaptive is not None:
+                self.adaptive.record_failure(time.time())
+                self.adaptive.save()
             self.logger.error("Error monitoring profile: %s", e)
             raise
@@ -1,37 +1,161 @@
 import logging
-from threading import Timer
+import time
+from collections.abc import Callable
+from contextlib import nullcontext
 
+from instaloader.exceptions import (
+    ConnectionException,
+    LoginRequiredException,
+    QueryReturnedNotFoundException,
+)
+
+from src.login import RequestGovernor, SessionPool
+from src.metrics import REGISTRY
+
+from .adaptive import AdaptiveJob
+from .download_pipeline import DownloadPipeline
 from .monitor import InstagramMonitor
+from .profile_cache import ProfileCache
+from .run_profiler import RunProfiler
+from .scheduler import ScheduledJob
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
 
+RUN_SECONDS = REGISTRY.histogram(
+    "instagram_monitor_run_seconds", "Seconds taken by each monitor run."
+)
+RUNS = REGISTRY.counter(
+    "instagram_monitor_runs_total",
+    "Monitor runs by username and result (ok or error).",
+    ("monitor", "result"),
+)
+RUN_REQUESTS = REGISTRY.gauge(
+    "instagram_monitor_last_run_requests",
+    "Requests made by the last run of each monitor.",
+    ("monitor",),
+)
+ERRORS = REGISTRY.counter(
+    "instagram_monitor_errors_total",
+    "Failed monitor runs by exception type.",
+    ("error",),
+)
+
 
 class MonitorInstance:
-    def __init__(self, username: str, insta_loader, interval_minutes, args):
+    def __init__(
+        self,
+        username: str,
+        insta_loader,
+        interval_minutes,
+        args,
+        governor: RequestGovernor | SessionPool,
+        download_pipeline: DownloadPipeline,
+        profile_cache: ProfileCache,
+        jitter_seconds=0,
+        on_result: Callable[..., None] | None = None,
+        run_profiler: RunProfiler | None = None,
+    ):
         self.username = username
         self.insta_loader = insta_loader
         self.interval_minutes = interval_minutes
-        self.monitor = InstagramMonitor(username, insta_loader, args)
-        self.timer: Timer | None = None
+        self.governor = governor
+        # Called with (username, ok, duration, requests, error) after every run
+        self.on_result = on_result
+        # Runs are numbered from 1 since startup to pick the ones to profile
+        self.run_profiler = run_profiler
+        self.runs = 0
+        self.monitor = InstagramMonitor(
+            username,
+            insta_loader,
+            args,
+            download_pipeline,
+            profile_cache,
+            interval_minutes,
+        )
+        if self.monitor.adaptive is not None:
+            # The interval is only the lower bound, the job wakes up when a phase is due
+            self.job = AdaptiveJob(
+                self.monitor.adaptive,
+                username,
+                self.run_monitor,
+                interval_minutes * 60,
+                jitter_seconds,
+            )
+        else:
+            self.job = ScheduledJob(
+                username, self.run_monitor, interval_minutes * 60, jitter_seconds
+            )
+
+    def requests_used(self) -> int:
+        return int(self.governor.usage().get(self.username, {}).get("requests", 0))
 
     def run_monitor(self):
         logging.info("Starting monitor for %s...", self.username)
-        self.monitor.run_monitor()
+        requests_before = self.requests_used()
+        started = time.monotonic()
+        self.runs += 1
+
+        try:
+            with self.governor.monitor(self.username) as session:
+                # With a session pool, run on whichever session the pool picked this time
+                if session is not None:
+                    self.monitor.L = session.instaloader
+                try:
+                    with self.profile_run():
+                        self.monitor.run_monitor()
+                except QueryReturnedNotFoundException:
+                    # A post, story or highlight that is gone, not a reason to slow down
+                    raise
+                except ConnectionException as exc:
+                    # Slow every monitor down, not just the one that hit the error
+                    self.governor.report_failure(f"Connection error: {exc}")
+                    raise
+                except LoginRequiredException as exc:
+                    self.governor.report_failure(f"Login required: {exc}")
+                    raise
+        except Exception as exc:
+            ERRORS.inc(error=type(exc).__name__)
+            self._report_result(False, started, requests_before, str(exc))
+            raise
+        self._report_result(True, started, requests_before)
+
         logging.info(
-            "Monitor for %s completed. Rescheduling in %d minutes",
+            "Monitor for %s completed using %d requests. Next run in %d minutes",
             self.username,
-            self.interval_minutes,
+            self.requests_used() - requests_before,
+            self.next_run_minutes(),
         )
 
-    def schedule_next_run(self):
-        interval_seconds = self.interval_minutes * 60
-        Timer(interval_seconds, self.run_monitor_and_reschedule).start()
+    def profile_run(self):
+        if self.run_profiler is None:
+            return nullcontext()
+        return self.run_profiler.capture(
+            self.username, self.runs, self.monitor.data_dir / "profiles"
+        )
+
+    def _report_result(
+        self,
+        ok: bool,
+        started: float,
+        requests_before: int,
+        error: str | None = None,
+    ):
+        duration = time.monotonic() - started
+        requests = self.requests_used() - requests_before
+        RUN_SECONDS.observe(duration)
+        RUNS.inc(monitor=self.username, result="ok" if ok else "error")
+        RUN_REQUESTS.set(requests, monitor=self.username)
+
+        if self.on_result is None:
+            return
+        self.on_result(self.username, ok, duration, requests, error)
 
-    def run_monitor_and_reschedule(self):
-        self.run_monitor()
-        self.schedule_next_run()
+    def next_run_minutes(self) -> float:
+        if self.monitor.adaptive is not None:
+            until_next = self.monitor.adaptive.seconds_until_next()
+            return max(until_next, AdaptiveJob.MIN_DELAY) / 60
+        return self.interval_minutes
 
-    def cancel_timer(self):
-        if self.timer:
-            self.timer.cancel()
+    def close(self):
+        self.monitor.close()
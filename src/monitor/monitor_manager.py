@@ -1,31 +1,81 @@
-from collections import deque
+from collections.abc import Callable
 
+from src.login import RequestGovernor, SessionPool
+
+from .download_pipeline import DownloadPipeline
 from .monitor_instance import MonitorInstance
+from .profile_cache import ProfileCache
+from .run_profiler import RunProfiler
+from .scheduler import ScheduledJob, Scheduler
+from .story_poller import StoryPoller
 
 
 class MonitorManager:
-    def __init__(self) -> None:
-        self.monitors: deque[MonitorInstance] = deque()
-        self.current_monitor = None
+    def __init__(
+        self,
+        governor: RequestGovernor | SessionPool,
+        download_pipeline: DownloadPipeline,
+        profile_cache: ProfileCache,
+        max_workers: int = 4,
+        jitter_seconds: float = 0,
+        story_poller: StoryPoller | None = None,
+        on_result: Callable[..., None] | None = None,
+        run_profiler: RunProfiler | None = None,
+    ) -> None:
+        self.monitors: dict[str, MonitorInstance] = {}
+        self.governor = governor
+        self.download_pipeline = download_pipeline
+        self.profile_cache = profile_cache
+        self.jitter_seconds = jitter_seconds
+        self.on_result = on_result
+        self.run_profiler = run_profiler
+
+        # One dispatcher and a bounded pool of workers run every monitor
+        self.scheduler = Scheduler(max_workers=max_workers)
+        self.scheduler.start()
+
+        # Stories of every profile are polled in batches by a job of their own
+        self.story_poller = story_poller
+        if story_poller is not None:
+            self.scheduler.add(story_poller.job)
 
     def add_monitor(self, username: str, insta_loader, interval_minutes, args):
         monitor_instance = MonitorInstance(
-            username, insta_loader, interval_minutes, args
+            username,
+            insta_loader,
+            interval_minutes,
+            args,
+            self.governor,
+            self.download_pipeline,
+            self.profile_cache,
+            self.jitter_seconds,
+            self.on_result,
+            self.run_profiler,
         )
-        self.monitors.append(monitor_instance)
+        self.monitors[username] = monitor_instance
+        if self.story_poller is not None and monitor_instance.monitor.download_stories:
+            self.story_poller.add(monitor_instance.monitor)
+
+        # First run as soon as a worker is free, then every interval
+        self.scheduler.add(monitor_instance.job)
 
-        if len(self.monitors) == 1:
-            self.current_monitor = monitor_instance
-            monitor_instance.run_monitor_and_reschedule()
+    def add_job(self, job: ScheduledJob, delay: float = 0):
+        """Run a maintenance job (like session health checks) on the monitors' scheduler."""
+        self.scheduler.add(job, delay)
 
-        monitor_instance.schedule_next_run()
+    def remove_monitor(self, username: str):
+        monitor_instance = self.monitors.pop(username)
+        if self.story_poller is not None:
+            self.story_poller.remove(username)
+        # Its databases stay open until a run in progress finished
+        self.scheduler.remove(monitor_instance.job, monitor_instance.close)
 
-    def rotate_and_run_next(self):
-        # Rotate the deque to run the next monitor
-        self.monitors.rotate(-1)
-        self.current_monitor = self.monitors[0]
-        self.current_monitor.schedule_next_run()
+    def request_usage(self) -> dict[str, dict[str, float]]:
+        """Requests made, time spent waiting for budget and requests per query type, per monitor."""
+        return self.governor.usage()
 
     def stop_all(self):
-        for monitor_instance in self.monitors:
-            monitor_instance.cancel_timer()
+        self.scheduler.shutdown()
+        self.download_pipeline.shutdown()
+        for monitor_instance in self.monitors.values():
+            monitor_instance.close()
@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+
+from instaloader.exceptions import ProfileNotExistsException
+from instaloader.instaloadercontext import InstaloaderContext
+from instaloader.structures import Profile
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileCache:
+    """
+    Username <-> userid resolution shared by all monitors.
+
+    A resolved `Profile` is reused for `ttl_seconds`, so every phase of a run (and any other
+    monitor looking up the same account) works on the same node instead of fetching it again.
+    When a username no longer resolves and the userid is known, the profile is looked up by id,
+    which keeps monitors working after an account is renamed.
+    """
+
+    def __init__(self, ttl_seconds: float = 300) -> None:
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # userid -> (fetched at, profile)
+        self._profiles: dict[int, tuple[float, Profile]] = {}
+        # lowercase username -> userid
+        self._userids: dict[str, int] = {}
+
+    def _cached(
+        self, context: InstaloaderContext, userid: int | None
+    ) -> Profile | None:
+        with self._lock:
+            entry = self._profiles.get(userid)
+        if entry is None or time.monotonic() - entry[0] > self.ttl_seconds:
+            return None
+        # A profile makes its requests through the session it was fetched with
+        if entry[1]._context is not context:
+            return None
+        return entry[1]
+
+    def _store(self, profile: Profile, *usernames: str) -> Profile:
+        with self._lock:
+            self._profiles[profile.userid] = (time.monotonic(), profile)
+            for username in (profile.username, *usernames):
+                self._userids[username.lower()] = profile.userid
+        return profile
+
+    def userid(self, username: str) -> int | None:
+        with self._lock:
+            return self._userids.get(username.lower())
+
+    def get(
+        self, context: InstaloaderContext, username: str, userid: int | None = None
+    ) -> Profile:
+        """
+        Return the profile of `username`, fetching it at most once per TTL.
+
+        Args:
+            userid (int | None): The last known userid of the account, used when the username
+                doesn't resolve anymore.
+
+        Raises:
+            ProfileNotExistsException: Neither the username nor the userid resolve.
+        """
+        profile = self._cached(context, self.userid(username) or userid)
+        if profile is not None:
+            return profile
+
+        try:
+            return self._store(Profile.from_username(context, username))
+        except ProfileNotExistsException:
+            if userid is None:
+                raise
+
+        profile = Profile.from_id(context, userid)
+        logger.warning(
+            "%s doesn't exist anymore, userid %d is now %s",
+            username,
+            userid,
+            profile.username,
+        )
+        # Keep the old name pointing at the account so the next lookups skip the failed request
+        return self._store(profile, username)
+
+    def invalidate(self, username: str) -> None:
+        with self._lock:
+            userid = self._userids.get(username.lower())
+            self._profiles.pop(userid, None)
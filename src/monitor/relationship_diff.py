@@ -0,0 +1,104 @@
+from collections.abc import Iterable
+from dataclasses import asdict, dataclass, field
+
+from .user_set import UserSet, UsernameTable
+
+# Kinds of change records emitted by `diff_relationships`
+NEW_FOLLOWER = "new_follower"
+LOST_FOLLOWER = "lost_follower"
+NEW_FOLLOWEE = "new_followee"
+LOST_FOLLOWEE = "lost_followee"
+RENAME = "rename"
+
+
+@dataclass(frozen=True)
+class ChangeRecord:
+    timestamp: str
+    change: str
+    userid: int
+    username: str
+    previous_username: str | None = None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+@dataclass
+class RelationshipDiff:
+    # (userid, username) of the accounts that are followed but don't follow back
+    not_following_back: list[tuple[int, str]]
+    changes: list[ChangeRecord] = field(default_factory=list)
+
+
+def diff_relationships(
+    timestamp: str,
+    followers: UserSet | Iterable[tuple[int, str]],
+    following: UserSet | Iterable[tuple[int, str]],
+    previous_followers: UserSet | Iterable[tuple[int, str]] | None = None,
+    previous_following: UserSet | Iterable[tuple[int, str]] | None = None,
+) -> RelationshipDiff:
+    """
+    Compare the current followers and following lists, and optionally the previous ones.
+
+    Everything is keyed on userid so renamed accounts are reported as renames instead of as an
+    unfollow and a follow. The set operations run on the sorted userid arrays of `UserSet`.
+
+    Args:
+        timestamp: Timestamp of the current snapshot, set on every change record.
+        followers: The (user_id, username) pairs of the followers.
+        following: The (user_id, username) pairs of the followees.
+        previous_followers: The followers of the previous snapshot, if there is one.
+        previous_following: The following of the previous snapshot, if there is one.
+
+    Returns:
+        A RelationshipDiff with the not following back list and the change records.
+    """
+    followers, following = _as_user_sets(followers, following)
+
+    diff = RelationshipDiff(
+        not_following_back=following.difference(followers).to_list()
+    )
+
+    if previous_followers is None or previous_following is None:
+        return diff
+
+    previous_followers, previous_following = _as_user_sets(
+        previous_followers, previous_following
+    )
+
+    for current, old, added_change, removed_change in (
+        (followers, previous_followers, NEW_FOLLOWER, LOST_FOLLOWER),
+        (following, previous_following, NEW_FOLLOWEE, LOST_FOLLOWEE),
+    ):
+        diff.changes.extend(
+            ChangeRecord(timestamp, added_change, userid, username)
+            for userid, username in current.difference(old)
+        )
+        diff.changes.extend(
+            ChangeRecord(timestamp, removed_change, userid, username)
+            for userid, username in old.difference(current)
+        )
+
+    # Renames, the username tables are shared by both lists so every account is only checked once
+    diff.changes.extend(
+        ChangeRecord(
+            timestamp, RENAME, userid, username, previous_username=old_username
+        )
+        for userid, username, old_username in followers.usernames.renamed(
+            previous_followers.usernames
+        )
+    )
+
+    return diff
+
+
+def _as_user_sets(followers, following) -> tuple[UserSet, UserSet]:
+    """Convert plain (userid, username) lists to user sets sharing one username table."""
+    if isinstance(followers, UserSet) and isinstance(following, UserSet):
+        return followers, following
+
+    usernames = UsernameTable()
+    return (
+        UserSet.from_users(followers, usernames),
+        UserSet.from_users(following, usernames),
+    )
@@ -0,0 +1,219 @@
+import json
+import sqlite3
+import threading
+from collections.abc import Iterable
+
+RELATIONSHIP_KINDS = ("followers", "following")
+
+# Sorts after every "%Y-%m-%d %H:%M:%S" timestamp
+_END_OF_TIME = "9999-12-31 23:59:59"
+
+
+class RelationshipHistory:
+    """
+    Delta encoded history of the followers and following lists of a profile.
+
+    Every run only stores the userids that were added or removed since the previous run. A full
+    base snapshot is written every `base_interval` runs so any point in time can be rebuilt from
+    the closest base plus the deltas recorded after it, without reading the rest of the history.
+    """
+
+    def __init__(
+        self, conn: sqlite3.Connection, lock: threading.RLock, base_interval: int = 96
+    ) -> None:
+        self.conn = conn
+        self._lock = lock
+        self.base_interval = base_interval
+
+        # Latest known state per kind, rebuilt from disk on first use
+        self._state: dict[str, set[int]] = {}
+        # Stored username per userid, read from disk for the userids not seen yet
+        self._usernames: dict[int, str] = {}
+
+        with self._lock:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS relationship_events (
+                    kind TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    members TEXT,
+                    added TEXT NOT NULL,
+                    removed TEXT NOT NULL,
+                    PRIMARY KEY (kind, timestamp)
+                )
+                """
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS usernames (userid INTEGER PRIMARY KEY, username TEXT NOT NULL)"
+            )
+            self.conn.commit()
+
+    def record(
+        self, kind: str, timestamp: str, users: Iterable[tuple[int, str]]
+    ) -> tuple[set[int], set[int]]:
+        """Record the relationship list of `kind` at `timestamp`, returns the (added, removed) userids."""
+        users = dict(users)
+        current = set(users)
+
+        with self._lock:
+            previous = self._latest_state(kind)
+            added = current - previous
+            removed = previous - current
+
+            deltas_since_base = self.conn.execute(
+                """
+                SELECT COUNT(*) FROM relationship_events
+                WHERE kind = ? AND timestamp > COALESCE(
+                    (SELECT MAX(timestamp) FROM relationship_events WHERE kind = ? AND members IS NOT NULL), ''
+                )
+                """,
+                (kind, kind),
+            ).fetchone()[0]
+            has_base = self.conn.execute(
+                "SELECT 1 FROM relationship_events WHERE kind = ? AND members IS NOT NULL LIMIT 1",
+                (kind,),
+            ).fetchone()
+            write_base = has_base is None or deltas_since_base + 1 >= self.base_interval
+
+            self.conn.execute(
+                "INSERT OR REPLACE INTO relationship_events (kind, timestamp, members, added, removed) VALUES (?, ?, ?, ?, ?)",
+                (
+                    kind,
+                    timestamp,
+                    _dump_ids(current) if write_base else None,
+                    _dump_ids(added),
+                    _dump_ids(removed),
+                ),
+            )
+            # Only new users and renames, not a row per user every run
+            changed = self._changed_usernames(users)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO usernames (userid, username) VALUES (?, ?)",
+                changed.items(),
+            )
+            self._usernames.update(changed)
+            self._state[kind] = current
+
+        return added, removed
+
+    def discard_cache(self) -> None:
+        """Forget the in-memory state, used after a rollback."""
+        with self._lock:
+            self._state.clear()
+            self._usernames.clear()
+
+    def _latest_state(self, kind: str) -> set[int]:
+        if kind not in self._state:
+            self._state[kind] = self._ids_at(kind, None)
+        return self._state[kind]
+
+    def _ids_at(self, kind: str, timestamp: str | None) -> set[int]:
+        upper = timestamp if timestamp is not None else _END_OF_TIME
+
+        base = self.conn.execute(
+            """
+            SELECT timestamp, members FROM relationship_events
+            WHERE kind = ? AND timestamp <= ? AND members IS NOT NULL
+            ORDER BY timestamp DESC LIMIT 1
+            """,
+            (kind, upper),
+        ).fetchone()
+        if base is None:
+            return set()
+
+        base_timestamp, members = base
+        ids = set(json.loads(members))
+        for added, removed in self.conn.execute(
+            """
+            SELECT added, removed FROM relationship_events
+            WHERE kind = ? AND timestamp > ? AND timestamp <= ?
+            ORDER BY timestamp
+            """,
+            (kind, base_timestamp, upper),
+        ):
+            ids.difference_update(json.loads(removed))
+            ids.update(json.loads(added))
+        return ids
+
+    def _changed_usernames(self, users: dict[int, str]) -> dict[int, str]:
+        unseen = [userid for userid in users if userid not in self._usernames]
+        self._usernames.update(self._stored_usernames(unseen))
+        return {
+            userid: username
+            for userid, username in users.items()
+            if self._usernames.get(userid) != username
+        }
+
+    def _stored_usernames(self, ids) -> dict[int, str]:
+        ids = sorted(ids)
+        usernames = {}
+        # Stay below SQLite's limit on the number of bound parameters
+        for start in range(0, len(ids), 500):
+            chunk = ids[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            usernames.update(
+                self.conn.execute(
+                    f"SELECT userid, username FROM usernames WHERE userid IN ({placeholders})",
+                    chunk,
+                )
+            )
+        return usernames
+
+    def _with_usernames(self, ids) -> list[tuple[int, str]]:
+        usernames = self._stored_usernames(ids)
+        return [(userid, usernames.get(userid, "")) for userid in sorted(ids)]
+
+    def relationships_at(
+        self, kind: str, timestamp: str | None = None
+    ) -> list[tuple[int, str]]:
+        """
+        Rebuild the `kind` list as it was at `timestamp` (latest if None).
+
+        Usernames are the most recent ones seen for each userid.
+        """
+        with self._lock:
+            if timestamp is None:
+                ids = self._latest_state(kind)
+            else:
+                ids = self._ids_at(kind, timestamp)
+            return self._with_usernames(ids)
+
+    def followers_at(self, timestamp: str | None = None) -> list[tuple[int, str]]:
+        return self.relationships_at("followers", timestamp)
+
+    def changes_between(
+        self, kind: str, start: str, end: str
+    ) -> tuple[list[tuple[int, str]], list[tuple[int, str]]]:
+        """
+        Return the net (added, removed) users of `kind` between the `start` and `end` timestamps.
+
+        Only the deltas recorded in that range are read.
+        """
+        added: set[int] = set()
+        removed: set[int] = set()
+
+        with self._lock:
+            for delta_added, delta_removed in self.conn.execute(
+                """
+                SELECT added, removed FROM relationship_events
+                WHERE kind = ? AND timestamp > ? AND timestamp <= ?
+                ORDER BY timestamp
+                """,
+                (kind, start, end),
+            ):
+                for userid in json.loads(delta_removed):
+                    if userid in added:
+                        added.discard(userid)
+                    else:
+                        removed.add(userid)
+                for userid in json.loads(delta_added):
+                    if userid in removed:
+                        removed.discard(userid)
+                    else:
+                        added.add(userid)
+
+            return self._with_usernames(added), self._with_usernames(removed)
+
+
+def _dump_ids(ids) -> str:
+    return json.dumps(sorted(ids), separators=(",", ":"))
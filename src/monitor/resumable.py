@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+from collections.abc import Iterator
+from datetime import datetime
+from pathlib import Path
+
+from instaloader.exceptions import InvalidArgumentException
+from instaloader.nodeiterator import FrozenNodeIterator, NodeIterator
+
+logger = logging.getLogger(__name__)
+
+
+class ResumableEnumeration:
+    """
+    Enumerate the (userid, username) pairs of a followers/followees NodeIterator so that an
+    interrupted run can pick up where it stopped.
+
+    Every node is streamed to a `<name>.partial.jsonl` file as it arrives and the frozen iterator
+    state is checkpointed to `<name>.checkpoint.json` every `checkpoint_every` nodes and when the
+    enumeration fails. The next run thaws the iterator, replays the nodes that were already
+    fetched and continues from the last page instead of starting over.
+    """
+
+    def __init__(self, state_dir: Path, name: str, checkpoint_every: int = 50) -> None:
+        self.checkpoint_file = state_dir / f"{name}.checkpoint.json"
+        self.partial_file = state_dir / f"{name}.partial.jsonl"
+        self.checkpoint_every = checkpoint_every
+
+        state_dir.mkdir(parents=True, exist_ok=True)
+
+    def iterate(self, iterator: NodeIterator) -> Iterator[tuple[int, str]]:
+        resumed_count = self._resume(iterator)
+
+        with open(self.partial_file, "a+", encoding="utf-8") as partial:
+            # Replay what the interrupted run already fetched
+            partial.seek(0)
+            for line in partial:
+                userid, username = json.loads(line)
+                yield userid, username
+
+            if resumed_count:
+                logger.info(
+                    "Resumed enumeration from %s after %d nodes",
+                    self.checkpoint_file,
+                    resumed_count,
+                )
+
+            try:
+                for count, node in enumerate(iterator, start=1):
+                    partial.write(json.dumps([node.userid, node.username]) + "\n")
+                    yield node.userid, node.username
+
+                    if count % self.checkpoint_every == 0:
+                        partial.flush()
+                        self._save_checkpoint(iterator)
+            except BaseException:
+                partial.flush()
+                self._save_checkpoint(iterator)
+                raise
+
+        self.clear()
+
+    def clear(self) -> None:
+        for file in (self.checkpoint_file, self.partial_file):
+            file.unlink(missing_ok=True)
+
+    def _resume(self, iterator: NodeIterator) -> int:
+        """Thaw `iterator` from the checkpoint, returns the number of nodes kept from the partial file."""
+        if not self.checkpoint_file.exists():
+            self.partial_file.unlink(missing_ok=True)
+            return 0
+
+        try:
+            with open(self.checkpoint_file, "r", encoding="utf-8") as file:
+                frozen = FrozenNodeIterator(**json.load(file))
+
+            if frozen.best_before and datetime.now().timestamp() > frozen.best_before:
+                raise InvalidArgumentException("checkpoint expired")
+            iterator.thaw(frozen)
+        except (InvalidArgumentException, json.JSONDecodeError, TypeError) as exc:
+            logger.info("Discarding checkpoint %s: %s", self.checkpoint_file, exc)
+            self.clear()
+            return 0
+
+        # The thawed iterator yields the last checkpointed node again, drop it and anything
+        # written after the checkpoint from the partial file
+        self._truncate_partial(frozen.total_index)
+        return frozen.total_index
+
+    def _truncate_partial(self, keep_lines: int) -> None:
+        if not self.partial_file.exists():
+            return
+
+        with open(self.partial_file, "rb+") as partial:
+            for _ in range(keep_lines):
+                if not partial.readline():
+                    break
+            partial.truncate(partial.tell())
+
+    def _save_checkpoint(self, iterator: NodeIterator) -> None:
+        temp_file = self.checkpoint_file.with_suffix(".tmp")
+        with open(temp_file, "w", encoding="utf-8") as file:
+            json.dump(iterator.freeze()._asdict(), file)
+        os.replace(temp_file, self.checkpoint_file)
@@ -0,0 +1,170 @@
+import cProfile
+import logging
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class RunProfiler:
+    """
+    Opt-in cProfile and tracemalloc capture of monitor runs.
+
+    A run is captured when it is one of the `runs` selected for its username (counted from 1
+    since startup), or when it takes longer than `slower_than_seconds`. To catch the slow runs
+    every run is profiled and the capture is dropped when the run was fast enough.
+
+    Captures are dumped to `profiles_dir` as `<time>_run<N>.prof` (load it with `pstats` or
+    snakeviz) and `<time>_run<N>.tracemalloc` (a `tracemalloc.Snapshot`), and the hottest
+    functions and the biggest allocation sites are logged. cProfile only sees the thread of the
+    run, time spent in concurrent phases and the download pipeline shows up as waits on them.
+    tracemalloc traces the whole process, so allocations of runs that overlap are mixed. Only one
+    run is captured at a time, runs starting while another one is captured are not profiled.
+    """
+
+    def __init__(
+        self,
+        runs: dict[str, set[int]] | None = None,
+        slower_than_seconds: float | None = None,
+        top: int = 10,
+    ) -> None:
+        self.runs = {
+            username.lower(): numbers for username, numbers in (runs or {}).items()
+        }
+        self.slower_than_seconds = slower_than_seconds
+        self.top = top
+
+        # tracemalloc is process-wide, it runs while any capture is in progress
+        self._tracing = 0
+        self._started_tracemalloc = False
+        self._lock = threading.Lock()
+        self._capturing = threading.Lock()
+
+    def selected(self, username: str, run_number: int) -> bool:
+        return run_number in self.runs.get(username.lower(), ())
+
+    def wants(self, username: str, run_number: int) -> bool:
+        return self.slower_than_seconds is not None or self.selected(
+            username, run_number
+        )
+
+    def _start_tracing(self) -> tracemalloc.Snapshot:
+        with self._lock:
+            if self._tracing == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+            self._tracing += 1
+            return tracemalloc.take_snapshot()
+
+    def _stop_tracing(self) -> tracemalloc.Snapshot:
+        with self._lock:
+            snapshot = tracemalloc.take_snapshot()
+            self._tracing -= 1
+            # Leave tracing on when it was started with PYTHONTRACEMALLOC
+            if self._tracing == 0 and self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+            return snapshot
+
+    @contextmanager
+    def capture(self, username: str, run_number: int, profiles_dir: Path):
+        """Profile the block if `wants` says so, dumping the capture when it is kept."""
+        if not self.wants(username, run_number):
+            yield
+            return
+        # cProfile refuses a second active profiler (Python 3.12+), one capture at a time
+        if not self._capturing.acquire(blocking=False):
+            logger.info(
+                "Not profiling run %d of %s, another run is being profiled",
+                run_number,
+                username,
+            )
+            yield
+            return
+
+        before = profile = None
+        started = time.monotonic()
+        try:
+            before = self._start_tracing()
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as e:
+                # Another profiler or debugger is active, run without profiling
+                logger.warning(
+                    "Not profiling run %d of %s: %s", run_number, username, e
+                )
+                profile = None
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            duration = time.monotonic() - started
+            after = self._stop_tracing() if before is not None else None
+            self._capturing.release()
+
+            if profile is not None and (
+                self.selected(username, run_number)
+                or duration > self.slower_than_seconds
+            ):
+                try:
+                    self._dump(
+                        username,
+                        run_number,
+                        duration,
+                        profiles_dir,
+                        profile,
+                        before,
+                        after,
+                    )
+                except Exception as e:
+                    # Keeps the run's own result or exception
+                    logger.warning(
+                        "Could not dump the profile of run %d of %s: %s",
+                        run_number,
+                        username,
+                        e,
+                    )
+
+    def _dump(
+        self,
+        username: str,
+        run_number: int,
+        duration: float,
+        profiles_dir: Path,
+        profile: cProfile.Profile,
+        before: tracemalloc.Snapshot,
+        after: tracemalloc.Snapshot,
+    ) -> None:
+        profiles_dir.mkdir(parents=True, exist_ok=True)
+        prefix = profiles_dir / f"{datetime.now():%Y-%m-%d_%H-%M-%S}_run{run_number}"
+        profile.dump_stats(f"{prefix}.prof")
+        after.dump(f"{prefix}.tracemalloc")
+
+        stats = pstats.Stats(profile)
+        # (file, line, function) -> (primitive calls, calls, own time, cumulative, callers)
+        hot_functions = sorted(
+            stats.stats.items(), key=lambda entry: entry[1][2], reverse=True
+        )[: self.top]
+        allocations = after.compare_to(before, "lineno")[: self.top]
+
+        logger.info(
+            "Profiled run %d of %s (%.1fs), dumped to %s.prof and .tracemalloc\n"
+            "Hot functions (own time, cumulative time, calls):\n%s\n"
+            "Allocation sites (growth during the run):\n%s",
+            run_number,
+            username,
+            duration,
+            prefix,
+            "\n".join(
+                f"  {own:8.3f}s {cumulative:8.3f}s {calls:8d}  "
+                f"{pstats.func_std_string(function)}"
+                for function, (_, calls, own, cumulative, _) in hot_functions
+            ),
+            "\n".join(f"  {allocation}" for allocation in allocations),
+        )
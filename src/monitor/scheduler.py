@@ -0,0 +1,181 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+from src.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+LAG = REGISTRY.histogram(
+    "instagram_monitor_scheduler_lag_seconds",
+    "Seconds between when a job was set to run and when a worker started it.",
+)
+JOB_LAG = REGISTRY.gauge(
+    "instagram_monitor_job_lag_seconds",
+    "Lag of the last run of each job.",
+    ("job",),
+)
+
+
+class ScheduledJob:
+    """
+    A callable run by the `Scheduler` every `interval_seconds`.
+
+    The cadence is kept relative to the scheduled time, not to when the previous run finished, so
+    a profile keeps a stable rhythm. Each run is shifted by up to `jitter_seconds`, drawn from a
+    random generator seeded with the job name so the offsets are reproducible per profile.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[], None],
+        interval_seconds: float,
+        jitter_seconds: float = 0,
+    ) -> None:
+        self.name = name
+        self.func = func
+        self.interval_seconds = interval_seconds
+        self.jitter_seconds = jitter_seconds
+        self.cancelled = False
+        self.running = False
+        # Set by `Scheduler.remove` while a run is in progress, called once it finished
+        self.on_removed: Callable[[], None] | None = None
+
+        # Slot of the current run, when it was set to fire (slot plus jitter) and how late
+        # it actually started
+        self.due_at: float = 0
+        self.run_at: float = 0
+        self.last_lag: float = 0
+
+        self._random = random.Random(name)
+
+    def next_delay(self) -> float:
+        """Seconds between this run's slot and the next one."""
+        return self.interval_seconds
+
+    def jitter(self) -> float:
+        if not self.jitter_seconds:
+            return 0
+        return self._random.uniform(0, self.jitter_seconds)
+
+
+class Scheduler:
+    """
+    Single dispatcher thread popping due jobs off a heap of next-run times and handing them to a
+    bounded worker pool.
+
+    A job is only put back on the heap once its run has finished, so the same job never runs
+    twice at the same time and the number of threads stays at `max_workers` regardless of the
+    number of jobs. Exceptions raised by a job are logged and the job keeps its schedule.
+    """
+
+    def __init__(self, max_workers: int = 4) -> None:
+        self._heap: list[tuple[float, int, ScheduledJob]] = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="monitor"
+        )
+        self._dispatcher = threading.Thread(
+            target=self._dispatch, name="scheduler", daemon=True
+        )
+        self._stopped = False
+
+    def start(self) -> None:
+        self._dispatcher.start()
+
+    def add(self, job: ScheduledJob, delay: float = 0) -> None:
+        """Schedule the first run of `job` in `delay` seconds (plus its jitter)."""
+        job.due_at = time.monotonic() + delay
+        self._push(job, job.due_at + job.jitter())
+
+    def remove(
+        self, job: ScheduledJob, on_removed: Callable[[], None] | None = None
+    ) -> None:
+        """
+        Unschedule `job`, then call `on_removed` right away or, when the job is running, once
+        that run finished.
+        """
+        with self._condition:
+            job.cancelled = True
+            self._condition.notify()
+            if job.running:
+                job.on_removed = on_removed
+                on_removed = None
+        JOB_LAG.remove(job=job.name)
+        if on_removed is not None:
+            on_removed()
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+        if self._dispatcher.is_alive():
+            self._dispatcher.join()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _push(self, job: ScheduledJob, run_at: float) -> None:
+        with self._condition:
+            if self._stopped or job.cancelled:
+                return
+            job.run_at = run_at
+            heapq.heappush(self._heap, (run_at, next(self._counter), job))
+            self._condition.notify()
+
+    def _dispatch(self) -> None:
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    if self._heap:
+                        delay = self._heap[0][0] - time.monotonic()
+                        if delay <= 0:
+                            break
+                        self._condition.wait(delay)
+                    else:
+                        self._condition.wait()
+
+                if self._stopped:
+                    return
+
+                _, _, job = heapq.heappop(self._heap)
+
+            if not job.cancelled:
+                self._executor.submit(self._run, job)
+
+    def _run(self, job: ScheduledJob) -> None:
+        with self._condition:
+            # Removed after it was handed to the pool
+            if job.cancelled:
+                return
+            job.running = True
+
+        job.last_lag = max(time.monotonic() - job.run_at, 0)
+        LAG.observe(job.last_lag)
+        JOB_LAG.set(job.last_lag, job=job.name)
+
+        try:
+            job.func()
+        except Exception as exc:
+            logger.error("Scheduled job %s failed: %s", job.name, exc, exc_info=True)
+        finally:
+            # Advance to the next slot after now, skipping the ones missed by a long run
+            next_due = job.due_at + job.next_delay()
+            now = time.monotonic()
+            while next_due <= now:
+                next_due += max(job.next_delay(), 1)
+
+            job.due_at = next_due
+            self._push(job, next_due + job.jitter())
+
+            with self._condition:
+                job.running = False
+                on_removed, job.on_removed = job.on_removed, None
+            if on_removed is not None:
+                on_removed()
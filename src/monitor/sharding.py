@@ -0,0 +1,252 @@
+import argparse
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import queue
+import time
+from collections.abc import Callable
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping usernames to `shards` shards.
+
+    Every shard is placed on the ring `replicas` times, a username belongs to the first shard
+    after its hash. The same username always lands on the same shard, and changing the number
+    of shards only moves about 1/N of the usernames.
+    """
+
+    def __init__(self, shards: int, replicas: int = 64) -> None:
+        self._ring = sorted(
+            (_hash(f"shard-{shard}-{replica}"), shard)
+            for shard in range(shards)
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in self._ring]
+
+    def shard_for(self, username: str) -> int:
+        index = bisect.bisect(self._hashes, _hash(username.lower()))
+        return self._ring[index % len(self._ring)][1]
+
+
+class ShardReporter:
+    """Worker side of the report queue: run results and periodic heartbeats."""
+
+    def __init__(self, shard: int, reports: multiprocessing.Queue) -> None:
+        self.shard = shard
+        self.reports = reports
+
+    def result(
+        self,
+        username: str,
+        ok: bool,
+        duration: float,
+        requests: int,
+        error: str | None = None,
+    ) -> None:
+        self.reports.put(
+            {
+                "type": "result",
+                "shard": self.shard,
+                "username": username,
+                "ok": ok,
+                "duration": duration,
+                "requests": requests,
+                "error": error,
+            }
+        )
+
+    def fatal(self, error: str) -> None:
+        """Tell the coordinator the worker stops because of `error`, restarting it won't help."""
+        self.reports.put({"type": "fatal", "shard": self.shard, "error": error})
+
+    def heartbeat(self, monitors: int, usage: dict[str, dict[str, float]]) -> None:
+        self.reports.put(
+            {
+                "type": "heartbeat",
+                "shard": self.shard,
+                "monitors": monitors,
+                "requests": sum(
+                    monitor_usage.get("requests", 0) for monitor_usage in usage.values()
+                ),
+            }
+        )
+
+
+# Called as target(shard, usernames_intervals, args, reports, stop_event) in every worker
+ShardTarget = Callable[..., None]
+
+
+class ShardCoordinator:
+    """
+    Runs the monitors in `shards` worker processes, each with its own session and scheduler.
+
+    Usernames are assigned with a `HashRing`, so a profile always runs in the same shard. Each
+    worker runs `target(shard, usernames_intervals, args, reports, stop_event)` and reports run
+    results and heartbeats over the `reports` queue. A worker that dies is restarted with the
+    same usernames, unless it reported a fatal error, one that stops sending heartbeats is
+    reported. The coordinator stops once every worker stopped on a fatal error.
+    """
+
+    def __init__(
+        self,
+        target: ShardTarget,
+        usernames_intervals: dict[str, int],
+        args: argparse.Namespace,
+        shards: int,
+        heartbeat_seconds: float = 60,
+        restart_delay: float = 60,
+    ) -> None:
+        self.target = target
+        self.args = args
+        self.heartbeat_seconds = heartbeat_seconds
+        self.restart_delay = restart_delay
+
+        ring = HashRing(shards)
+        self.assignments: dict[int, dict[str, int]] = {}
+        for username, interval in usernames_intervals.items():
+            self.assignments.setdefault(ring.shard_for(username), {})[username] = interval
+
+        # Spawned workers don't inherit the parent's threads, locks or open sessions
+        self._context = multiprocessing.get_context("spawn")
+        self.reports = self._context.Queue()
+        self.stop_event = self._context.Event()
+
+        self.workers: dict[int, multiprocessing.Process] = {}
+        # shard -> {"started": ..., "last_heartbeat": ..., "runs": ..., "failures": ...}
+        self.health: dict[int, dict] = {}
+
+    def start(self) -> None:
+        for shard, usernames_intervals in sorted(self.assignments.items()):
+            logger.info(
+                "Shard %d monitors %s", shard, ", ".join(sorted(usernames_intervals))
+            )
+            self._start_worker(shard)
+
+    def _start_worker(self, shard: int) -> None:
+        worker = self._context.Process(
+            target=self.target,
+            args=(
+                shard,
+                self.assignments[shard],
+                self.args,
+                self.reports,
+                self.stop_event,
+            ),
+            name=f"shard-{shard}",
+        )
+        worker.start()
+        self.workers[shard] = worker
+
+        health = self.health.setdefault(
+            shard,
+            {"runs": 0, "failures": 0, "restarts": -1, "monitors": 0, "fatal": None},
+        )
+        health["started"] = time.monotonic()
+        health["last_heartbeat"] = time.monotonic()
+        health["stalled"] = False
+        health["restarts"] += 1
+
+    def run(self) -> None:
+        """Handle reports and supervise the workers until `stop` is called."""
+        while not self.stop_event.is_set():
+            try:
+                report = self.reports.get(timeout=5)
+                # Everything a dead worker sent, its fatal error included, before supervising
+                while True:
+                    self._handle(report)
+                    report = self.reports.get_nowait()
+            except queue.Empty:
+                pass
+            self._supervise()
+
+    def _handle(self, report: dict) -> None:
+        health = self.health[report["shard"]]
+        health["last_heartbeat"] = time.monotonic()
+        health["stalled"] = False
+
+        if report["type"] == "fatal":
+            health["fatal"] = report["error"]
+            logger.critical(
+                "Shard %d stopped and won't be restarted: %s",
+                report["shard"],
+                report["error"],
+            )
+            return
+
+        if report["type"] == "heartbeat":
+            health["monitors"] = report["monitors"]
+            health["requests"] = report["requests"]
+            return
+
+        health["runs"] += 1
+        if report["ok"]:
+            logger.info(
+                "[shard %d] %s done in %.1fs using %d requests",
+                report["shard"],
+                report["username"],
+                report["duration"],
+                report["requests"],
+            )
+        else:
+            health["failures"] += 1
+            logger.error(
+                "[shard %d] %s failed after %.1fs: %s",
+                report["shard"],
+                report["username"],
+                report["duration"],
+                report["error"],
+            )
+
+    def _supervise(self) -> None:
+        if self.stop_event.is_set():
+            return
+
+        if all(
+            health["fatal"] is not None and not self.workers[shard].is_alive()
+            for shard, health in self.health.items()
+        ):
+            logger.critical("Every shard stopped on a fatal error, stopping")
+            self.stop_event.set()
+            return
+
+        now = time.monotonic()
+        for shard, worker in list(self.workers.items()):
+            health = self.health[shard]
+            if not worker.is_alive():
+                if health["fatal"] is not None:
+                    continue
+                # Don't restart a worker that crashes on startup in a tight loop
+                if now - health["started"] < self.restart_delay:
+                    continue
+                logger.error(
+                    "Shard %d exited with code %s, restarting it",
+                    shard,
+                    worker.exitcode,
+                )
+                self._start_worker(shard)
+            elif (
+                not health["stalled"]
+                and now - health["last_heartbeat"] > 3 * self.heartbeat_seconds
+            ):
+                health["stalled"] = True
+                logger.warning(
+                    "No heartbeat from shard %d for %d seconds",
+                    shard,
+                    now - health["last_heartbeat"],
+                )
+
+    def stop(self, timeout: float = 60) -> None:
+        self.stop_event.set()
+        for shard, worker in self.workers.items():
+            worker.join(timeout)
+            if worker.is_alive():
+                logger.warning("Shard %d didn't stop in time, terminating it", shard)
+                worker.terminate()
@@ -0,0 +1,261 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+from .relationship_diff import ChangeRecord
+from .relationship_history import RELATIONSHIP_KINDS, RelationshipHistory
+from .user_set import UserSet
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotStore:
+    """
+    Storage backend for the timestamped profile snapshots of a single monitored profile.
+
+    Snapshots appended during a run are only persisted once `commit` is called, so a run that
+    fails halfway leaves the store as it was before the run started.
+    """
+
+    # Delta encoded followers/following history, only available in the "delta" history mode
+    history: RelationshipHistory | None = None
+
+    def append(self, timestamp: str, snapshot: dict) -> None:
+        raise NotImplementedError
+
+    def append_changes(self, changes: list[ChangeRecord]) -> None:
+        """Record the relationship changes detected for the snapshots of this run."""
+        raise NotImplementedError
+
+    def latest(self) -> tuple[str, dict] | None:
+        """Return the most recent (timestamp, snapshot) pair, or None if the store is empty."""
+        raise NotImplementedError
+
+    def commit(self) -> None:
+        raise NotImplementedError
+
+    def rollback(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteSnapshotStore(SnapshotStore):
+    """
+    Append-only snapshot store backed by an embedded SQLite database.
+
+    Only the new snapshot is written on each run and the latest snapshot can be read without
+    touching the rest of the history. In "delta" history mode the followers and following lists
+    are kept out of the snapshots and recorded as deltas in a `RelationshipHistory` instead.
+    """
+
+    def __init__(
+        self,
+        db_file: Path,
+        legacy_file: Path | None = None,
+        history_mode: str = "full",
+        base_interval: int = 96,
+    ) -> None:
+        self.db_file = db_file
+        self.history_mode = history_mode
+        self._lock = threading.RLock()
+
+        # Runs are dispatched from different worker threads, access is serialized with the lock
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots (timestamp TEXT PRIMARY KEY, data TEXT NOT NULL)"
+        )
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS relationship_changes (
+                timestamp TEXT NOT NULL,
+                change TEXT NOT NULL,
+                userid INTEGER NOT NULL,
+                username TEXT NOT NULL,
+                previous_username TEXT
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS relationship_changes_by_change ON relationship_changes (change, timestamp)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS relationship_changes_by_userid ON relationship_changes (userid, timestamp)"
+        )
+        self.conn.commit()
+
+        if history_mode == "delta":
+            self.history = RelationshipHistory(self.conn, self._lock, base_interval)
+
+        if legacy_file is not None:
+            self._import_legacy_file(legacy_file)
+
+    def _import_legacy_file(self, legacy_file: Path):
+        # One-time migration of the old data.json, only done while the database is still empty
+        if not legacy_file.exists() or self.latest() is not None:
+            return
+
+        logger.info("Importing legacy snapshots from %s into %s", legacy_file, self.db_file)
+        with open(legacy_file, "r", encoding="utf-8") as file:
+            legacy_data = json.load(file)
+
+        for timestamp, snapshot in legacy_data.items():
+            self.append(timestamp, snapshot)
+        self.commit()
+
+    def append(self, timestamp: str, snapshot: dict) -> None:
+        with self._lock:
+            if self.history is not None:
+                snapshot = dict(snapshot)
+                # Derived from the followers and following lists, no need to keep it around
+                snapshot.pop("not_following_back", None)
+                for kind in RELATIONSHIP_KINDS:
+                    users = snapshot.pop(kind, None)
+                    if users is not None:
+                        self.history.record(kind, timestamp, users)
+
+            self.conn.execute(
+                "INSERT OR REPLACE INTO snapshots (timestamp, data) VALUES (?, ?)",
+                (
+                    timestamp,
+                    json.dumps(snapshot, separators=(",", ":"), default=_encode_json),
+                ),
+            )
+
+    def append_changes(self, changes: list[ChangeRecord]) -> None:
+        with self._lock:
+            self.conn.executemany(
+                "INSERT INTO relationship_changes (timestamp, change, userid, username, previous_username) VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        record.timestamp,
+                        record.change,
+                        record.userid,
+                        record.username,
+                        record.previous_username,
+                    )
+                    for record in changes
+                ),
+            )
+
+    def latest(self) -> tuple[str, dict] | None:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT timestamp, data FROM snapshots ORDER BY timestamp DESC LIMIT 1"
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            snapshot = json.loads(row[1])
+            if self.history is not None:
+                for kind in RELATIONSHIP_KINDS:
+                    snapshot[kind] = self.history.relationships_at(kind)
+            return row[0], snapshot
+
+    def commit(self) -> None:
+        with self._lock:
+            self.conn.commit()
+
+    def rollback(self) -> None:
+        with self._lock:
+            self.conn.rollback()
+            if self.history is not None:
+                self.history.discard_cache()
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+
+class JSONSnapshotStore(SnapshotStore):
+    """
+    Snapshot store using the original single `data.json` file.
+
+    Kept for compatibility with existing tooling, every commit rewrites the whole history.
+    """
+
+    def __init__(self, data_file: Path) -> None:
+        self.data_file = data_file
+        self._lock = threading.RLock()
+        self._data: dict | None = None
+        self._dirty = False
+
+    def _load(self) -> dict:
+        if self._data is None:
+            if os.path.exists(self.data_file):
+                with open(self.data_file, "r", encoding="utf-8") as file:
+                    self._data = json.load(file)
+            else:
+                self._data = {}
+        return self._data
+
+    def append(self, timestamp: str, snapshot: dict) -> None:
+        with self._lock:
+            self._load()[timestamp] = {
+                key: value.to_list() if isinstance(value, UserSet) else value
+                for key, value in snapshot.items()
+            }
+            self._dirty = True
+
+    def append_changes(self, changes: list[ChangeRecord]) -> None:
+        with self._lock:
+            data = self._load()
+            # Kept next to the snapshot they were detected in
+            for record in changes:
+                data[record.timestamp].setdefault("changes", []).append(record.to_dict())
+            self._dirty = True
+
+    def latest(self) -> tuple[str, dict] | None:
+        with self._lock:
+            data = self._load()
+            if not data:
+                return None
+            timestamp = max(data)
+            return timestamp, data[timestamp]
+
+    def commit(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            with open(self.data_file, "w", encoding="utf-8") as file:
+                json.dump(self._data, file, indent=4)
+            self._dirty = False
+
+    def rollback(self) -> None:
+        with self._lock:
+            # Drop the in-memory copy so the next access re-reads the committed file
+            self._data = None
+            self._dirty = False
+
+
+def _encode_json(value):
+    if isinstance(value, UserSet):
+        return value.to_list()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def open_snapshot_store(
+    kind: str, data_dir: Path, history_mode: str = "full", base_interval: int = 96
+) -> SnapshotStore:
+    legacy_file = data_dir / "data.json"
+
+    if kind == "json":
+        if history_mode != "full":
+            raise ValueError("The json snapshot store only supports the full history mode")
+        return JSONSnapshotStore(legacy_file)
+    if kind == "sqlite":
+        return SQLiteSnapshotStore(
+            data_dir / "snapshots.db",
+            legacy_file=legacy_file,
+            history_mode=history_mode,
+            base_interval=base_interval,
+        )
+
+    raise ValueError(f"Unknown snapshot store: {kind}")
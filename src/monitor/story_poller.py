@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from instaloader.exceptions import ConnectionException, QueryReturnedNotFoundException
+from instaloader.instaloader import Instaloader
+from instaloader.structures import Story
+
+from src.login import RequestGovernor, SessionPool
+
+from .monitor import PHASE_SECONDS, TIMESTAMP_FORMAT, InstagramMonitor
+from .scheduler import ScheduledJob
+from .story_schedule import StorySchedule
+
+logger = logging.getLogger(__name__)
+
+
+class StoryPollJob(ScheduledJob):
+    """Story poll job that wakes up when the next profile is due in its `StorySchedule`."""
+
+    # Never poll more often than this, even if a profile was due during the last poll
+    MIN_DELAY = 60
+
+    def __init__(self, schedule: StorySchedule, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.schedule = schedule
+
+    def next_delay(self) -> float:
+        until_next = self.schedule.seconds_until_next()
+        if until_next is None:
+            return self.interval_seconds
+        # The scheduler adds the delay to the slot of the run that just finished
+        return time.monotonic() - self.due_at + max(until_next, self.MIN_DELAY)
+
+
+class StoryPoller:
+    """
+    Fetches the stories of every registered monitor with one `get_stories` call per
+    `batch_size` userids, and hands each profile's stories to its monitor.
+
+    Polling costs one reel request per batch instead of one per profile. Monitors whose userid
+    isn't known yet (their first run hasn't finished) are picked up by the next poll.
+
+    Without a `schedule` every profile is polled every `interval_minutes`. With one, only the
+    profiles it reports as due are polled and the job wakes up when the next one is due.
+    """
+
+    def __init__(
+        self,
+        insta_loader: Instaloader,
+        governor: RequestGovernor | SessionPool,
+        interval_minutes: float,
+        batch_size: int = 50,
+        jitter_seconds: float = 0,
+        schedule: StorySchedule | None = None,
+    ) -> None:
+        self.L = insta_loader
+        self.governor = governor
+        self.batch_size = batch_size
+        self.schedule = schedule
+
+        self._monitors: dict[str, InstagramMonitor] = {}
+        self._lock = threading.Lock()
+
+        if schedule is None:
+            self.job = ScheduledJob(
+                "story-poller", self.poll, interval_minutes * 60, jitter_seconds
+            )
+        else:
+            self.job = StoryPollJob(
+                schedule,
+                "story-poller",
+                self.poll,
+                interval_minutes * 60,
+                jitter_seconds,
+            )
+
+    def add(self, monitor: InstagramMonitor) -> None:
+        with self._lock:
+            self._monitors[monitor.profile_username] = monitor
+        if self.schedule is not None:
+            self.schedule.add(monitor.profile_username)
+
+    def remove(self, username: str) -> None:
+        with self._lock:
+            self._monitors.pop(username, None)
+        if self.schedule is not None:
+            self.schedule.remove(username)
+
+    def _monitors_by_userid(self) -> dict[int, InstagramMonitor]:
+        with self._lock:
+            monitors = list(self._monitors.values())
+        if self.schedule is not None:
+            due = set(self.schedule.due())
+            monitors = [
+                monitor for monitor in monitors if monitor.profile_username in due
+            ]
+
+        by_userid = {}
+        for monitor in monitors:
+            userid = monitor.profile_cache.userid(monitor.profile_username)
+            if userid is None:
+                userid = monitor.load_profile_id()
+            if userid is None:
+                logger.debug(
+                    "Userid of %s not known yet, skipping its stories",
+                    monitor.profile_username,
+                )
+                continue
+            by_userid[userid] = monitor
+        return by_userid
+
+    def fetch(self, userids: list[int]) -> dict[int, list[Story]]:
+        """Fetch the current stories of `userids`, one request per batch, grouped by owner."""
+        stories: dict[int, list[Story]] = defaultdict(list)
+        with self.governor.monitor(self.job.name) as session:
+            instaloader = session.instaloader if session is not None else self.L
+            for start in range(0, len(userids), self.batch_size):
+                batch = userids[start : start + self.batch_size]
+                try:
+                    for story in instaloader.get_stories(batch):
+                        stories[story.owner_id].append(story)
+                except QueryReturnedNotFoundException:
+                    raise
+                except ConnectionException as exc:
+                    self.governor.report_failure(f"Connection error: {exc}")
+                    raise
+        return stories
+
+    def poll(self) -> None:
+        by_userid = self._monitors_by_userid()
+        if not by_userid:
+            return
+
+        polled_at = time.time()
+        timestamp = datetime.fromtimestamp(polled_at).strftime(TIMESTAMP_FORMAT)
+        with PHASE_SECONDS.time(phase="story_poll"):
+            stories = self.fetch(list(by_userid))
+        logger.info(
+            "Polled stories of %d profiles, %d have stories",
+            len(by_userid),
+            len(stories),
+        )
+
+        failed = set()
+        for userid, owner_stories in stories.items():
+            monitor = by_userid.get(userid)
+            if monitor is None:
+                continue
+            try:
+                monitor.save_polled_stories(owner_stories, timestamp)
+            except Exception:
+                # Already logged by the monitor, keep going with the other profiles
+                failed.add(userid)
+
+        if self.schedule is not None:
+            # Profiles without stories were polled as well, the ones that failed to save
+            # stay due so their items are retried
+            for userid, monitor in by_userid.items():
+                if userid in failed:
+                    continue
+                self.schedule.observe(
+                    monitor.profile_username, stories.get(userid, []), polled_at
+                )
+            self.schedule.save()
+            self.schedule.log_report()
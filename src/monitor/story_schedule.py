@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from instaloader.structures import Story
+
+from .monitor import TIMESTAMP_FORMAT
+
+logger = logging.getLogger(__name__)
+
+STORY_LIFETIME = 24 * 60 * 60
+DAY = 24 * 60 * 60
+
+# Posting times older than this don't count towards a profile's posting rate
+RATE_WINDOW = 7 * DAY
+
+
+class StorySchedule:
+    """
+    Decides when the stories of each profile have to be polled again.
+
+    A story posted right after a poll expires 24 hours after that poll, so as long as the gap
+    between two polls stays under 24 hours minus `margin_seconds`, every story is captured. Each
+    profile gets that many polls, the rest of the daily budget (`polls_per_day` profile polls) is
+    shared out by how often the profile posted stories over the last week, down to
+    `min_interval_seconds` between polls. If the budget can't even cover one poll per 24 hours
+    for every profile, the budget wins and `report` flags the profiles that aren't covered.
+
+    The last poll and the recent posting times of each profile are kept in `state_file`.
+    """
+
+    def __init__(
+        self,
+        state_file: Path,
+        polls_per_day: float,
+        margin_seconds: float = 60 * 60,
+        min_interval_seconds: float = 30 * 60,
+    ) -> None:
+        self.state_file = state_file
+        self.polls_per_day = polls_per_day
+        self.max_gap = STORY_LIFETIME - margin_seconds
+        self.min_interval = min(min_interval_seconds, self.max_gap)
+        self._lock = threading.Lock()
+
+        # username -> {"last_poll": ..., "covered_since": ..., "posted": [...]}, epoch seconds
+        self._profiles: dict[str, dict] = {}
+        # Saved state of the profiles, only scheduled once they are added. Profiles that are no
+        # longer monitored (or moved to another shard) are dropped on the next save.
+        self._stored: dict[str, dict] = {}
+        if state_file.exists():
+            with open(state_file, "r", encoding="utf-8") as file:
+                self._stored = json.load(file)
+        self._intervals: dict[str, float] = {}
+
+    def add(self, username: str) -> None:
+        with self._lock:
+            if username not in self._profiles:
+                self._profiles[username] = self._stored.pop(
+                    username,
+                    {"last_poll": None, "covered_since": None, "posted": []},
+                )
+            self._allocate()
+
+    def remove(self, username: str) -> None:
+        with self._lock:
+            self._profiles.pop(username, None)
+            self._allocate()
+
+    def posting_rate(self, username: str, now: float | None = None) -> float:
+        """Stories posted per day over the last week."""
+        now = now or time.time()
+        posted = self._profiles[username]["posted"]
+        return sum(1 for posted_at in posted if now - posted_at <= RATE_WINDOW) / (
+            RATE_WINDOW / DAY
+        )
+
+    def _allocate(self) -> None:
+        if not self._profiles:
+            self._intervals = {}
+            return
+
+        # Polls per day needed to never leave a gap longer than max_gap
+        needed = DAY / self.max_gap
+        spare = self.polls_per_day - needed * len(self._profiles)
+        if spare < 0:
+            # Not enough budget to cover everyone, spread what there is evenly
+            interval = DAY * len(self._profiles) / self.polls_per_day
+            self._intervals = dict.fromkeys(self._profiles, interval)
+            return
+
+        # A small prior so quiet profiles still get a share of the spare polls
+        now = time.time()
+        weights = {
+            username: self.posting_rate(username, now) + 0.1
+            for username in self._profiles
+        }
+        total = sum(weights.values())
+        self._intervals = {
+            username: min(
+                max(DAY / (needed + spare * weight / total), self.min_interval),
+                self.max_gap,
+            )
+            for username, weight in weights.items()
+        }
+
+    def interval(self, username: str) -> float:
+        with self._lock:
+            return self._intervals[username]
+
+    def next_poll(self, username: str) -> float:
+        """Epoch time the stories of `username` should be polled next."""
+        with self._lock:
+            last_poll = self._profiles[username]["last_poll"]
+            if last_poll is None:
+                return 0
+            return last_poll + self._intervals[username]
+
+    def due(self, now: float | None = None) -> list[str]:
+        """
+        Profiles to poll now. Profiles due within the next quarter of their interval are
+        polled early so they share a batched request with the ones that are due.
+        """
+        now = now or time.time()
+        with self._lock:
+            usernames = list(self._profiles)
+        return [
+            username
+            for username in usernames
+            if self.next_poll(username) - now <= self.interval(username) / 4
+        ]
+
+    def seconds_until_next(self, now: float | None = None) -> float | None:
+        now = now or time.time()
+        with self._lock:
+            usernames = list(self._profiles)
+        if not usernames:
+            return None
+        return max(min(self.next_poll(username) for username in usernames) - now, 0)
+
+    def observe(self, username: str, stories: list[Story], polled_at: float) -> None:
+        """Record a poll of `username` and the posting times of the items it returned."""
+        with self._lock:
+            state = self._profiles.get(username)
+            if state is None:
+                return
+
+            # A poll captures everything posted in the 24 hours before it, coverage is only
+            # unbroken while the gaps stay shorter than that
+            last_poll = state["last_poll"]
+            if last_poll is None or polled_at - last_poll >= STORY_LIFETIME:
+                state["covered_since"] = polled_at - STORY_LIFETIME
+            state["last_poll"] = polled_at
+
+            posted = set(state["posted"])
+            for story in stories:
+                for item in story.get_items():
+                    posted.add(item.date_utc.replace(tzinfo=timezone.utc).timestamp())
+            state["posted"] = sorted(
+                posted_at for posted_at in posted if polled_at - posted_at <= RATE_WINDOW
+            )
+
+    def save(self) -> None:
+        with self._lock:
+            self._allocate()
+            temp_file = self.state_file.with_suffix(".tmp")
+            with open(temp_file, "w", encoding="utf-8") as file:
+                json.dump(self._profiles, file, indent=4)
+            os.replace(temp_file, self.state_file)
+
+    def report(self) -> dict[str, dict]:
+        """
+        The guaranteed-capture window of each profile: every story posted since
+        `covered_since` has been captured, and the window stays open as long as the next poll
+        happens before `poll_deadline`.
+        """
+        now = time.time()
+        report = {}
+        for username in list(self._profiles):
+            with self._lock:
+                state = dict(self._profiles[username])
+            interval = self.interval(username)
+            report[username] = {
+                "covered_since": _format(state["covered_since"]),
+                "last_poll": _format(state["last_poll"]),
+                "next_poll": _format(self.next_poll(username) or now),
+                "poll_deadline": _format(
+                    state["last_poll"] + STORY_LIFETIME
+                    if state["last_poll"] is not None
+                    else None
+                ),
+                "interval_minutes": round(interval / 60, 1),
+                "stories_per_day": round(self.posting_rate(username, now), 2),
+                "guaranteed": interval <= self.max_gap,
+            }
+        return report
+
+    def log_report(self) -> None:
+        for username, window in self.report().items():
+            if not window["guaranteed"]:
+                logger.warning(
+                    "Story budget too small to capture every story of %s, polling every %s minutes",
+                    username,
+                    window["interval_minutes"],
+                )
+            elif window["covered_since"] is not None:
+                logger.info(
+                    "Every story of %s posted since %s is captured, next poll at %s (deadline %s)",
+                    username,
+                    window["covered_since"],
+                    window["next_poll"],
+                    window["poll_deadline"],
+                )
+
+
+def _format(epoch: float | None) -> str | None:
+    if epoch is None:
+        return None
+    return datetime.fromtimestamp(epoch).strftime(TIMESTAMP_FORMAT)
@@ -0,0 +1,200 @@
+from array import array
+from bisect import bisect_left
+from collections.abc import Iterable, Iterator
+from itertools import accumulate
+
+# NumPy is optional, set operations fall back to Python sets without it
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+class UsernameTable:
+    """
+    Compact userid -> username table shared by the user sets of a snapshot.
+
+    Usernames are stored back to back as UTF-8 in a single buffer next to sorted int64 userid and
+    offset arrays, so each entry costs a few dozen bytes instead of a dict entry and a str object.
+    An account that is both a follower and a followee is only stored once.
+    """
+
+    def __init__(self) -> None:
+        self._ids = array("q")
+        self._offsets = array("q", [0])
+        self._names = bytearray()
+        self._sorted = True
+
+    def add(self, userid: int, username: str) -> None:
+        ids = self._ids
+        if ids and userid <= ids[-1]:
+            self._sorted = False
+        ids.append(userid)
+        self._names += username.encode()
+        self._offsets.append(len(self._names))
+
+    def __len__(self) -> int:
+        if not self._sorted:
+            self._sort()
+        return len(self._ids)
+
+    def get(self, userid: int, default: str | None = None) -> str | None:
+        if not self._sorted:
+            self._sort()
+        index = bisect_left(self._ids, userid)
+        if index == len(self._ids) or self._ids[index] != userid:
+            return default
+        return self._names[self._offsets[index] : self._offsets[index + 1]].decode()
+
+    def get_sorted(self, userids: Iterable[int]) -> Iterator[tuple[int, str]]:
+        """Yield (userid, username) for ascending `userids`, each lookup resumes from the last one."""
+        if not self._sorted:
+            self._sort()
+        ids, offsets, names = self._ids, self._offsets, self._names
+        index = 0
+        length = len(ids)
+
+        for userid in userids:
+            index = bisect_left(ids, userid, index)
+            if index < length and ids[index] == userid:
+                yield userid, names[offsets[index] : offsets[index + 1]].decode()
+            else:
+                yield userid, ""
+
+    def renamed(self, other: "UsernameTable") -> Iterator[tuple[int, str, str]]:
+        """
+        Yield (userid, username, other_username) for the userids present in both tables under a
+        different username. Both tables are walked once, only renamed entries are decoded.
+        """
+        for table in (self, other):
+            if not table._sorted:
+                table._sort()
+
+        ids, offsets, names = self._ids, self._offsets, self._names
+        other_ids, other_offsets, other_names = other._ids, other._offsets, other._names
+        other_index = 0
+        other_length = len(other_ids)
+
+        for index, userid in enumerate(ids):
+            while other_index < other_length and other_ids[other_index] < userid:
+                other_index += 1
+            if other_index == other_length:
+                break
+            if other_ids[other_index] != userid:
+                continue
+
+            username = names[offsets[index] : offsets[index + 1]]
+            other_username = other_names[
+                other_offsets[other_index] : other_offsets[other_index + 1]
+            ]
+            if username != other_username:
+                yield userid, username.decode(), other_username.decode()
+
+    def _sort(self) -> None:
+        """Sort the entries by userid, keeping the last username added for duplicated ids."""
+        if self._sorted:
+            return
+
+        old_ids, old_offsets, old_names = self._ids, self._offsets, self._names
+
+        # Later entries overwrite earlier ones, so the last username added for an id wins
+        latest_index = dict(zip(old_ids, range(len(old_ids))))
+        sorted_ids = sorted(latest_index)
+        chunks = [
+            old_names[old_offsets[index] : old_offsets[index + 1]]
+            for index in map(latest_index.__getitem__, sorted_ids)
+        ]
+
+        self._ids = array("q", sorted_ids)
+        self._names = bytearray().join(chunks)
+        self._offsets = array("q", [0])
+        self._offsets.extend(accumulate(map(len, chunks)))
+        self._sorted = True
+
+
+class UserSet:
+    """
+    Immutable set of accounts stored as a sorted int64 userid array plus a shared `UsernameTable`.
+
+    Iterating yields (userid, username) tuples like the lists it replaces. Difference and
+    intersection are computed on the userid arrays, vectorized with NumPy when it is installed
+    and with hash sets otherwise. Results stay sorted.
+    """
+
+    __slots__ = ("ids", "usernames")
+
+    def __init__(self, ids: array, usernames: UsernameTable) -> None:
+        # `ids` must be sorted and free of duplicates
+        self.ids = ids
+        self.usernames = usernames
+
+    @classmethod
+    def from_users(
+        cls, users: Iterable[tuple[int, str]], usernames: UsernameTable | None = None
+    ) -> "UserSet":
+        """Build a set from (userid, username) pairs, registering the usernames in `usernames`."""
+        if usernames is None:
+            usernames = UsernameTable()
+
+        ids = array("q")
+        add_username = usernames.add
+        add_id = ids.append
+        for userid, username in users:
+            add_username(userid, username)
+            add_id(userid)
+
+        return cls(_sorted_unique(ids), usernames)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, userid: int) -> bool:
+        index = bisect_left(self.ids, userid)
+        return index < len(self.ids) and self.ids[index] == userid
+
+    def __iter__(self) -> Iterator[tuple[int, str]]:
+        return self.usernames.get_sorted(self.ids)
+
+    def difference(self, other: "UserSet") -> "UserSet":
+        if np is not None:
+            ids = np.setdiff1d(
+                _as_numpy(self.ids), _as_numpy(other.ids), assume_unique=True
+            )
+            return UserSet(array("q", ids.tobytes()), self.usernames)
+        return UserSet(
+            _filter_ids(self.ids, other.ids, keep_common=False), self.usernames
+        )
+
+    def intersection(self, other: "UserSet") -> "UserSet":
+        if np is not None:
+            ids = np.intersect1d(
+                _as_numpy(self.ids), _as_numpy(other.ids), assume_unique=True
+            )
+            return UserSet(array("q", ids.tobytes()), self.usernames)
+        return UserSet(
+            _filter_ids(self.ids, other.ids, keep_common=True), self.usernames
+        )
+
+    def to_list(self) -> list[tuple[int, str]]:
+        return list(self)
+
+
+def _as_numpy(ids: array):
+    return np.frombuffer(ids, dtype=np.int64)
+
+
+def _sorted_unique(ids: array) -> array:
+    if np is not None:
+        return array("q", np.unique(_as_numpy(ids)).tobytes())
+    return array("q", sorted(set(ids)))
+
+
+def _filter_ids(left: array, right: array, keep_common: bool) -> array:
+    """
+    Return the ids of `left` that are in `right` (`keep_common`) or that aren't, still sorted.
+    Without numpy, one lookup per id in a set of `right`.
+    """
+    right_ids = set(right)
+    if keep_common:
+        return array("q", [userid for userid in left if userid in right_ids])
+    return array("q", [userid for userid in left if userid not in right_ids])
@@ -0,0 +1 @@
+from .history_index import END_OF_TIME, KINDS, PERIODS, HistoryIndex
@@ -0,0 +1,430 @@
+import json
+import logging
+import sqlite3
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Relationships recorded in the snapshots, not following back is derived from them
+RELATIONSHIP_KINDS = ("followers", "following")
+NOT_FOLLOWING_BACK = "not_following_back"
+KINDS = (*RELATIONSHIP_KINDS, NOT_FOLLOWING_BACK)
+
+ADDED = "added"
+REMOVED = "removed"
+
+# Sorts after every "%Y-%m-%d %H:%M:%S" timestamp
+END_OF_TIME = "9999-12-31 23:59:59"
+
+# SQL expressions grouping a timestamp column into periods
+PERIODS = {
+    "day": "substr({column}, 1, 10)",
+    "week": "strftime('%Y-W%W', {column})",
+    "month": "substr({column}, 1, 7)",
+}
+
+
+def _connect_read_only(db_file: Path) -> sqlite3.Connection:
+    # The monitor may be writing to it, WAL lets us read a consistent state meanwhile
+    return sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+
+
+class HistoryIndex:
+    """
+    Query index over the history of one monitored profile, kept in `history_index.db`.
+
+    Built incrementally from the monitor's output: the snapshots in `snapshots.db` (full or delta
+    history mode) are replayed one at a time into membership spans (when an account started and
+    stopped following, being followed or not following back) and per-snapshot change events,
+    and the story and highlight items of the metadata log are indexed by date. `update` only
+    reads what was added since the last update, every query is answered from indexed tables
+    without reading the history itself.
+
+    The first indexed snapshot only opens spans, its members are not counted as changes.
+    """
+
+    def __init__(self, data_dir: Path, index_file: Path | None = None) -> None:
+        self.data_dir = data_dir
+        self.index_file = index_file or data_dir / "history_index.db"
+
+        self.conn = sqlite3.connect(self.index_file)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS positions (
+                source TEXT PRIMARY KEY,
+                position TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS spans (
+                kind TEXT NOT NULL,
+                userid INTEGER NOT NULL,
+                first_seen TEXT NOT NULL,
+                last_seen TEXT,
+                ended TEXT
+            );
+            CREATE INDEX IF NOT EXISTS spans_by_userid ON spans (userid, kind, ended);
+            CREATE INDEX IF NOT EXISTS spans_by_kind ON spans (kind, ended);
+            CREATE TABLE IF NOT EXISTS events (
+                kind TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                change TEXT NOT NULL,
+                userid INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS events_by_time ON events (kind, timestamp);
+            CREATE TABLE IF NOT EXISTS usernames (
+                userid INTEGER PRIMARY KEY,
+                username TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS usernames_by_name ON usernames (username);
+            CREATE TABLE IF NOT EXISTS media (
+                category TEXT NOT NULL,
+                mediaid TEXT NOT NULL,
+                at TEXT NOT NULL,
+                posted_at TEXT,
+                seen_at TEXT NOT NULL,
+                PRIMARY KEY (category, mediaid)
+            );
+            CREATE INDEX IF NOT EXISTS media_by_time ON media (category, at);
+            """
+        )
+        self.conn.commit()
+
+    def _position(self, source: str) -> str | None:
+        row = self.conn.execute(
+            "SELECT position FROM positions WHERE source = ?", (source,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set_position(self, source: str, position: str) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO positions (source, position) VALUES (?, ?)",
+            (source, position),
+        )
+
+    def update(self) -> None:
+        """
+        Index the snapshots and metadata records added since the last update.
+
+        Raises:
+            FileNotFoundError: The profile has no `snapshots.db`, its history is only in the
+                legacy data.json of the json snapshot store.
+        """
+        snapshots_file = self.data_dir / "snapshots.db"
+        if not snapshots_file.exists():
+            raise FileNotFoundError(
+                f"No snapshots.db in {self.data_dir}, run the monitor with the sqlite "
+                "snapshot store (the default) once to import data.json"
+            )
+
+        source = _connect_read_only(snapshots_file)
+        try:
+            self._update_relationships(source)
+        finally:
+            source.close()
+
+        if (self.data_dir / "metadata_index.db").exists():
+            source = _connect_read_only(self.data_dir / "metadata_index.db")
+            try:
+                self._update_media(source, self.data_dir / "metadata.jsonl")
+            finally:
+                source.close()
+
+        self.conn.commit()
+
+    def _open_ids(self, kind: str) -> set[int]:
+        return {
+            userid
+            for (userid,) in self.conn.execute(
+                "SELECT userid FROM spans WHERE kind = ? AND ended IS NULL", (kind,)
+            )
+        }
+
+    def _update_relationships(self, source: sqlite3.Connection) -> None:
+        position = self._position("snapshots")
+        # Only the current members are kept in memory, never the history
+        members = {kind: self._open_ids(kind) for kind in KINDS}
+        source_tables = {
+            name
+            for (name,) in source.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+        }
+
+        previous_timestamp = position
+        indexed = 0
+        for timestamp, data in source.execute(
+            "SELECT timestamp, data FROM snapshots WHERE timestamp > ? ORDER BY timestamp",
+            (position or "",),
+        ):
+            snapshot = json.loads(data)
+            # The first snapshot is the starting point, not a change
+            record_events = previous_timestamp is not None
+            changed: set[int] = set()
+
+            for kind in RELATIONSHIP_KINDS:
+                delta = self._snapshot_delta(
+                    source, source_tables, kind, timestamp, snapshot, members[kind]
+                )
+                if delta is None:
+                    continue
+                added, removed = delta
+                self._apply(
+                    kind, timestamp, previous_timestamp, added, removed, record_events
+                )
+                members[kind] |= added
+                members[kind] -= removed
+                changed |= added | removed
+
+            # Not following back changes only where followers or following changed
+            followers, following = members["followers"], members["following"]
+            not_following_back = members[NOT_FOLLOWING_BACK]
+            now_not_following_back = {
+                userid
+                for userid in changed
+                if userid in following and userid not in followers
+            }
+            added = now_not_following_back - not_following_back
+            removed = (changed & not_following_back) - now_not_following_back
+            self._apply(
+                NOT_FOLLOWING_BACK,
+                timestamp,
+                previous_timestamp,
+                added,
+                removed,
+                record_events,
+            )
+            not_following_back |= added
+            not_following_back -= removed
+
+            if "relationship_changes" in source_tables:
+                self._set_usernames(
+                    source.execute(
+                        """
+                        SELECT userid, username FROM relationship_changes
+                        WHERE change = 'rename' AND timestamp = ?
+                        """,
+                        (timestamp,),
+                    )
+                )
+
+            previous_timestamp = timestamp
+            indexed += 1
+
+        if previous_timestamp is not None and indexed:
+            self._set_position("snapshots", previous_timestamp)
+            logger.info("Indexed %d new snapshots of %s", indexed, self.data_dir)
+
+    def _snapshot_delta(
+        self,
+        source: sqlite3.Connection,
+        source_tables: set[str],
+        kind: str,
+        timestamp: str,
+        snapshot: dict,
+        current: set[int],
+    ) -> tuple[set[int], set[int]] | None:
+        """The (added, removed) userids of `kind` at `timestamp`, None if it wasn't recorded."""
+        if kind in snapshot:
+            # Full history mode, the snapshot holds the whole list
+            users = snapshot[kind]
+            ids = {userid for userid, _ in users}
+            added = ids - current
+            self._set_usernames(
+                (userid, username) for userid, username in users if userid in added
+            )
+            return added, current - ids
+
+        if "relationship_events" not in source_tables:
+            return None
+        # Delta history mode, the deltas are recorded next to the snapshot
+        row = source.execute(
+            "SELECT added, removed FROM relationship_events WHERE kind = ? AND timestamp = ?",
+            (kind, timestamp),
+        ).fetchone()
+        if row is None:
+            return None
+
+        added, removed = set(json.loads(row[0])), set(json.loads(row[1]))
+        ids = sorted(added)
+        # Stay below SQLite's limit on the number of bound parameters
+        for start in range(0, len(ids), 500):
+            chunk = ids[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            self._set_usernames(
+                source.execute(
+                    f"SELECT userid, username FROM usernames WHERE userid IN ({placeholders})",
+                    chunk,
+                )
+            )
+        return added, removed
+
+    def _apply(
+        self,
+        kind: str,
+        timestamp: str,
+        previous_timestamp: str | None,
+        added: set[int],
+        removed: set[int],
+        record_events: bool,
+    ) -> None:
+        self.conn.executemany(
+            "INSERT INTO spans (kind, userid, first_seen) VALUES (?, ?, ?)",
+            ((kind, userid, timestamp) for userid in added),
+        )
+        # Last seen in the previous snapshot, gone in this one
+        self.conn.executemany(
+            """
+            UPDATE spans SET last_seen = ?, ended = ?
+            WHERE userid = ? AND kind = ? AND ended IS NULL
+            """,
+            ((previous_timestamp, timestamp, userid, kind) for userid in removed),
+        )
+        if record_events:
+            self.conn.executemany(
+                "INSERT INTO events (kind, timestamp, change, userid) VALUES (?, ?, ?, ?)",
+                [(kind, timestamp, ADDED, userid) for userid in added]
+                + [(kind, timestamp, REMOVED, userid) for userid in removed],
+            )
+
+    def _set_usernames(self, users: Iterable[tuple[int, str]]) -> None:
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO usernames (userid, username) VALUES (?, ?)", users
+        )
+
+    def _update_media(self, source: sqlite3.Connection, log_file: Path) -> None:
+        position = int(self._position("metadata") or 0)
+        rows = source.execute(
+            """
+            SELECT rowid, category, timestamp, offset, length FROM records
+            WHERE rowid > ? ORDER BY rowid
+            """,
+            (position,),
+        ).fetchall()
+        if not rows:
+            return
+
+        with open(log_file, "rb") as log:
+            for rowid, category, timestamp, offset, length in rows:
+                log.seek(offset)
+                record = json.loads(log.read(length))
+                self.conn.executemany(
+                    """
+                    INSERT OR IGNORE INTO media (category, mediaid, at, posted_at, seen_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    """,
+                    (
+                        (
+                            category,
+                            str(item.get("media_id")),
+                            item.get("created_at") or timestamp,
+                            item.get("created_at"),
+                            timestamp,
+                        )
+                        for item in record.get("stories", [])
+                    ),
+                )
+                position = rowid
+
+        self._set_position("metadata", str(position))
+
+    def latest_timestamp(self) -> str | None:
+        return self._position("snapshots")
+
+    def userid(self, account: str) -> int | None:
+        """Userid of `account`, a username or a userid."""
+        if account.isdigit():
+            return int(account)
+        row = self.conn.execute(
+            "SELECT userid FROM usernames WHERE username = ? LIMIT 1", (account,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def churn(
+        self,
+        kind: str,
+        start: str | None = None,
+        end: str | None = None,
+        period: str = "day",
+    ) -> list[tuple[str, int, int]]:
+        """(period, added, removed) counts of `kind` between `start` and `end`."""
+        group = PERIODS[period].format(column="timestamp")
+        return self.conn.execute(
+            f"""
+            SELECT {group} AS period, SUM(change = ?), SUM(change = ?) FROM events
+            WHERE kind = ? AND timestamp >= ? AND timestamp <= ?
+            GROUP BY period ORDER BY period
+            """,
+            (ADDED, REMOVED, kind, start or "", end or END_OF_TIME),
+        ).fetchall()
+
+    def changes(
+        self,
+        kind: str,
+        start: str | None = None,
+        end: str | None = None,
+        change: str | None = None,
+    ) -> Iterator[tuple[str, str, int, str | None]]:
+        """(timestamp, change, userid, username) of the `kind` changes, oldest first."""
+        query = """
+            SELECT events.timestamp, events.change, events.userid, usernames.username
+            FROM events LEFT JOIN usernames USING (userid)
+            WHERE events.kind = ? AND events.timestamp >= ? AND events.timestamp <= ?
+        """
+        params: list = [kind, start or "", end or END_OF_TIME]
+        if change is not None:
+            query += " AND events.change = ?"
+            params.append(change)
+        yield from self.conn.execute(
+            query + " ORDER BY events.timestamp, events.change, usernames.username",
+            params,
+        )
+
+    def current(self, kind: str) -> Iterator[tuple[int, str | None, str]]:
+        """(userid, username, first seen) of the accounts currently in `kind`."""
+        yield from self.conn.execute(
+            """
+            SELECT spans.userid, usernames.username, spans.first_seen
+            FROM spans LEFT JOIN usernames USING (userid)
+            WHERE spans.kind = ? AND spans.ended IS NULL
+            ORDER BY spans.first_seen, usernames.username
+            """,
+            (kind,),
+        )
+
+    def spans(self, userid: int) -> list[tuple[str, str, str | None, str | None]]:
+        """
+        (kind, first seen, last seen, ended) of every span of `userid`, oldest first. The last
+        seen timestamp of an ongoing span is the latest indexed snapshot.
+        """
+        return self.conn.execute(
+            """
+            SELECT kind, first_seen, COALESCE(last_seen, ?), ended FROM spans
+            WHERE userid = ? ORDER BY first_seen, kind
+            """,
+            (self.latest_timestamp(), userid),
+        ).fetchall()
+
+    def activity(
+        self,
+        category: str,
+        start: str | None = None,
+        end: str | None = None,
+        period: str = "day",
+    ) -> list[tuple[str, int]]:
+        """
+        (period, items) of `category` (stories or highlights) between `start` and `end`. Items
+        are dated by their creation time when it is known, otherwise by the run that saw them.
+        """
+        group = PERIODS[period].format(column="at")
+        return self.conn.execute(
+            f"""
+            SELECT {group} AS period, COUNT(*) FROM media
+            WHERE category = ? AND at >= ? AND at <= ?
+            GROUP BY period ORDER BY period
+            """,
+            (category, start or "", end or END_OF_TIME),
+        ).fetchall()
+
+    def close(self) -> None:
+        self.conn.close()